@@ -5,18 +5,43 @@
 # license that can be found in the LICENSE file.
 
 import os
+import random
+import re
 import sys
 import argparse
+import BaseHTTPServer
+import bisect
+import calendar
+import collections
+import contextlib
+import fnmatch
+import functools
+import heapq
+import itertools
+import json
+import math
 import socket
+import threading
 import time
+import types
 
 from urlparse import urlparse
 
-try:
-    from tsuruclient import client
-except:
-    sys.stderr.write("This plugin requires tsuruclient module: https://pypi.python.org/pypi/tsuruclient\n")
-    sys.exit(1)
+# requests, which tsuruclient imports, takes most of the startup time of the
+# plugin: both are only imported, by import_tsuruclient, once tsuru is called
+requests = base = client = None
+
+
+def import_tsuruclient():
+    global requests, base, client
+    if client is None:
+        try:
+            import requests
+            from tsuruclient import base, client
+        except ImportError:
+            sys.stderr.write("This plugin requires tsuruclient module: "
+                             "https://pypi.python.org/pypi/tsuruclient\n")
+            sys.exit(1)
 
 
 class NewNodeError(Exception):
@@ -39,123 +64,1951 @@ class RemoveNodeFromPoolError(Exception):
     def __str__(self):
         return 'Error removing node from pool: "{}"'.format(self.name)
 
-    def __unicode__(self):
-        return unicode(str(self))
+    def __unicode__(self):
+        return unicode(str(self))
+
+
+class PoolRecycleError(Exception):
+    def __init__(self, name):
+        super(Exception, self).__init__(name)
+        self.name = name
+
+    def __str__(self):
+        return 'Error recycling pool: "{}"'.format(self.name)
+
+    def __unicode__(self):
+        return unicode(str(self))
+
+
+class EventTimeoutError(Exception):
+    def __init__(self, name):
+        super(Exception, self).__init__(name)
+        self.name = name
+
+    def __str__(self):
+        return 'Timeout waiting for event: "{}"'.format(self.name)
+
+    def __unicode__(self):
+        return unicode(str(self))
+
+
+class PollingPolicy(object):
+    """
+    Exponential backoff with jitter used between event polls and retries.
+
+    The first poll happens after `initial_interval` seconds and each following
+    one waits `multiplier` times longer, up to a maximum interval that can be
+    set per event kind through `kind_max_intervals`. Intervals are randomized
+    by +/- `jitter` (a fraction of the interval) so concurrent waits do not
+    poll tsuru in lockstep. If `deadline` is set, a wait that takes longer
+    than `deadline` seconds is aborted.
+    """
+
+    KIND_MAX_INTERVALS = {
+        "node.create": 30,
+        "node.delete": 60,
+    }
+
+    def __init__(self, initial_interval=2, multiplier=2, max_interval=15,
+                 kind_max_intervals=None, jitter=0.2, deadline=None):
+        self.initial_interval = initial_interval
+        self.multiplier = multiplier
+        self.max_interval = max_interval
+        if kind_max_intervals is None:
+            kind_max_intervals = self.KIND_MAX_INTERVALS
+        self.kind_max_intervals = kind_max_intervals
+        self.jitter = jitter
+        self.deadline = deadline
+
+    def interval(self, attempt, kind=None, max_interval=None):
+        if max_interval is None:
+            max_interval = self.kind_max_intervals.get(kind, self.max_interval)
+        interval = min(max_interval, self.initial_interval * (self.multiplier ** attempt))
+        if self.jitter:
+            interval *= random.uniform(1 - self.jitter, 1 + self.jitter)
+        return min(interval, max_interval)
+
+    def expired(self, started):
+        return self.deadline is not None and time.time() - started >= self.deadline
+
+
+class Retry(object):
+    """
+    Retries of one node operation, attempted in a loop: the error of each
+    failed attempt is given to `backoff`, which returns how long to sleep
+    before the next attempt. Errors that would only happen again, as tsuru
+    rejecting the request or any of the `fatal_errors` of the operation, end
+    it at once, as does running out of its `max_retry` retries or of the
+    `budget` seconds it may take. It then fails with `error_class`.
+    """
+
+    def __init__(self, operation, msg, error_class, max_retry=10, retry_interval=60, budget=None,
+                 polling_policy=None, stats=None, fatal_errors=()):
+        self.operation = operation
+        self.msg = msg
+        self.error_class = error_class
+        self.fatal_errors = fatal_errors
+        self.max_retry = max_retry
+        self.retry_interval = retry_interval
+        self.budget = budget
+        if polling_policy is None:
+            polling_policy = PollingPolicy()
+        self.polling_policy = polling_policy
+        if stats is None:
+            stats = RunStats()
+        self.stats = stats
+        self.attempt = 0
+        self.started = time.time()
+
+    @staticmethod
+    def transient(error):
+        """
+        Tells whether `error` may not happen again: tsuru failures, throttled
+        calls, lost connections, timeouts and failed events are transient,
+        requests tsuru rejected are not.
+        """
+        response = getattr(error, "response", None)
+        if response is None:
+            return True
+        return response.status_code >= 500 or response.status_code in (408, 429)
+
+    def backoff(self, error):
+        if isinstance(error, self.fatal_errors) or not self.transient(error):
+            self.stats.count("fatal.node." + self.operation)
+            raise self.error_class("Not retrying: {}".format(error))
+        if self.attempt == self.max_retry:
+            raise self.error_class("Maximum number of retries exceeded: {}".format(error))
+        interval = self.polling_policy.interval(self.attempt, max_interval=self.retry_interval)
+        if self.budget is not None and time.time() - self.started + interval > self.budget:
+            raise self.error_class("Retry budget of {} seconds exceeded: {}".format(self.budget, error))
+        self.attempt += 1
+        sys.stderr.write("{} failed: {}. Retrying in {:.1f} seconds.\n".format(self.msg, error, interval))
+        self.stats.count("retries.node." + self.operation)
+        return interval
+
+
+class RunStats(object):
+    """
+    Timings and counters of a run, shared by every TsuruPool in it, telling
+    where the time of the run went.
+
+    Phases are timed with `timer`: tsuru API calls ("api.nodes.create",
+    "api.events.list", ...), event waits ("wait.node.create" and
+    "wait.node.delete", which includes draining the containers of the node),
+    waits for new nodes to be ready ("wait.node.ready") and for the drain
+    budget to admit a removal ("wait.drain"), retry sleeps
+    ("sleep.retry") and, for each recycled node, its creation, removal and
+    whole recycle ("node.create", "node.remove", "node.recycle").
+    Failed phases and retries are counted.
+    """
+
+    BUCKETS = (0.1, 0.25, 0.5, 1, 2.5, 5, 10, 30, 60, 120, 300, 600, 1800, 3600)
+
+    def __init__(self):
+        self.lock = threading.Lock()
+        self.started = time.time()
+        self.durations = collections.defaultdict(list)
+        self.counters = collections.defaultdict(int)
+        self.nodes = collections.OrderedDict()
+        self.planned = collections.OrderedDict()
+
+    @contextlib.contextmanager
+    def timer(self, phase, pool=None, node=None):
+        started = time.time()
+        try:
+            yield
+        except Exception:
+            self.count(phase + ".errors")
+            raise
+        finally:
+            self.add(phase, time.time() - started, pool, node)
+
+    def add(self, phase, duration, pool=None, node=None):
+        with self.lock:
+            self.durations[phase].append(duration)
+            if node is not None:
+                phases = self._node(pool, node)["phases"]
+                phases[phase] = phases.get(phase, 0) + duration
+
+    def count(self, name, value=1):
+        with self.lock:
+            self.counters[name] += value
+
+    def plan(self, pool, count):
+        with self.lock:
+            self.planned[pool] = self.planned.get(pool, 0) + count
+
+    def start_node(self, pool, node):
+        with self.lock:
+            self._node(pool, node).setdefault("started", time.time())
+
+    def update_node(self, pool, node, **fields):
+        with self.lock:
+            self._node(pool, node).update(fields)
+
+    def finish_node(self, pool, node):
+        with self.lock:
+            record = self._node(pool, node)
+            if "started" in record and "finished" not in record:
+                record["finished"] = time.time()
+                duration = record["finished"] - record["started"]
+                self.durations["node.recycle"].append(duration)
+                record["phases"]["node.recycle"] = duration
+
+    def _node(self, pool, node):
+        return self.nodes.setdefault((pool, node), {"pool": pool, "node": node, "phases": {}})
+
+    def summary(self, durations):
+        durations = sorted(durations)
+        histogram = [0] * (len(self.BUCKETS) + 1)
+        for duration in durations:
+            histogram[bisect.bisect_left(self.BUCKETS, duration)] += 1
+
+        def percentile(fraction):
+            return durations[max(0, int(math.ceil(fraction * len(durations))) - 1)]
+        return {"count": len(durations), "total": sum(durations),
+                "mean": sum(durations) / len(durations),
+                "min": durations[0], "max": durations[-1],
+                "p50": percentile(0.5), "p90": percentile(0.9), "p99": percentile(0.99),
+                "histogram": [{"le": bucket, "count": count}
+                              for bucket, count in zip(self.BUCKETS + ("+Inf",), histogram)]}
+
+    def progress(self):
+        """
+        Returns the nodes planned, recycled and in flight on each pool, and
+        the estimated seconds left to recycle the remaining ones, from the
+        mean duration of the nodes recycled so far and the number of nodes
+        recycled at once since the first one started, or None before any
+        node is recycled.
+        """
+        with self.lock:
+            pools = collections.OrderedDict((pool, {"planned": planned, "recycled": 0, "in_flight": 0})
+                                            for pool, planned in self.planned.items())
+            first_started = None
+            for (pool, node), record in self.nodes.items():
+                if "started" not in record:
+                    continue
+                first_started = min(first_started or record["started"], record["started"])
+                counts = pools.setdefault(pool, {"planned": 0, "recycled": 0, "in_flight": 0})
+                counts["recycled" if "finished" in record else "in_flight"] += 1
+            durations = self.durations["node.recycle"]
+            eta = None
+            if durations:
+                remaining = sum(max(0, counts["planned"] - counts["recycled"])
+                                for counts in pools.values())
+                concurrency = sum(durations) / max(time.time() - first_started, 1e-6)
+                eta = remaining * (sum(durations) / len(durations)) / max(concurrency, 1e-6)
+            return pools, eta
+
+    def report(self):
+        with self.lock:
+            finished = time.time()
+            return {"started": self.started, "finished": finished,
+                    "wall_time": finished - self.started,
+                    "counters": dict(self.counters),
+                    "phases": dict((phase, self.summary(durations))
+                                   for phase, durations in self.durations.items() if durations),
+                    "nodes": [dict(record, phases=dict(record["phases"]))
+                              for record in self.nodes.values()]}
+
+    def write_report(self, path):
+        with open(path, "w") as report_file:
+            json.dump(self.report(), report_file, indent=2, sort_keys=True)
+            report_file.write("\n")
+
+
+class MetricsExporter(object):
+    """
+    Publishes the RunStats of a run as Prometheus metrics while it runs, on
+    an HTTP endpoint at `port` of the local `address` and/or on a
+    node_exporter `textfile` that is rewritten every `interval` seconds.
+    """
+
+    def __init__(self, stats, port=None, textfile=None, interval=15, address="127.0.0.1"):
+        self.stats = stats
+        self.port = port
+        self.address = address
+        self.textfile = textfile
+        self.interval = interval
+        self.server = None
+        self.stopped = threading.Event()
+
+    def start(self):
+        if self.port is not None:
+            exporter = self
+
+            class Handler(BaseHTTPServer.BaseHTTPRequestHandler):
+
+                def do_GET(self):
+                    if self.path.split("?")[0] not in ("/", "/metrics"):
+                        self.send_error(404)
+                        return
+                    body = exporter.render()
+                    self.send_response(200)
+                    self.send_header("Content-Type", "text/plain; version=0.0.4")
+                    self.send_header("Content-Length", str(len(body)))
+                    self.end_headers()
+                    self.wfile.write(body)
+
+                def log_message(self, *args):
+                    pass
+
+            self.server = BaseHTTPServer.HTTPServer((self.address, self.port), Handler)
+            self._spawn(self.server.serve_forever)
+        if self.textfile is not None:
+            self._spawn(self._write_textfile_loop)
+        return self
+
+    def stop(self):
+        self.stopped.set()
+        if self.server is not None:
+            self.server.shutdown()
+            self.server.server_close()
+        if self.textfile is not None:
+            self.write_textfile()
+
+    def _spawn(self, target):
+        thread = threading.Thread(target=target)
+        thread.daemon = True
+        thread.start()
+
+    def _write_textfile_loop(self):
+        while not self.stopped.is_set():
+            try:
+                self.write_textfile()
+            except Exception as ex:
+                sys.stderr.write("Failed to write metrics: {}\n".format(ex))
+            self.stopped.wait(self.interval)
+
+    def write_textfile(self):
+        # node_exporter may read the file at any time, replace it at once
+        tmp_path = "{}.{}.tmp".format(self.textfile, os.getpid())
+        with open(tmp_path, "w") as metrics_file:
+            metrics_file.write(self.render())
+        os.rename(tmp_path, self.textfile)
+
+    def render(self):
+        pools, eta = self.stats.progress()
+        report = self.stats.report()
+        lines = []
+
+        def metric(name, kind, help_text, samples):
+            lines.append("# HELP pool_recycle_{} {}".format(name, help_text))
+            lines.append("# TYPE pool_recycle_{} {}".format(name, kind))
+            for labels, value in samples:
+                labels = ",".join('{}="{}"'.format(key, value) for key, value in labels)
+                lines.append("pool_recycle_{}{} {}".format(name, "{" + labels + "}" if labels else "",
+                                                           self._format(value)))
+
+        metric("started_timestamp_seconds", "gauge", "Time the run started.",
+               [((), report["started"])])
+        metric("nodes_planned", "gauge", "Nodes to recycle.",
+               [((("pool", pool),), counts["planned"]) for pool, counts in pools.items()])
+        metric("nodes_recycled", "gauge", "Nodes already recycled.",
+               [((("pool", pool),), counts["recycled"]) for pool, counts in pools.items()])
+        metric("nodes_remaining", "gauge", "Nodes not recycled yet.",
+               [((("pool", pool),), max(0, counts["planned"] - counts["recycled"]))
+                for pool, counts in pools.items()])
+        metric("nodes_in_flight", "gauge", "Nodes being recycled.",
+               [((("pool", pool),), counts["in_flight"]) for pool, counts in pools.items()])
+        metric("eta_seconds", "gauge", "Estimated time left to recycle the remaining nodes.",
+               [((), eta if eta is not None else float("nan"))])
+        lines.append("# HELP pool_recycle_phase_duration_seconds Duration of each phase of the run.")
+        lines.append("# TYPE pool_recycle_phase_duration_seconds histogram")
+        for phase, summary in sorted(report["phases"].items()):
+            cumulative = 0
+            for bucket in summary["histogram"]:
+                cumulative += bucket["count"]
+                lines.append('pool_recycle_phase_duration_seconds_bucket{{phase="{}",le="{}"}} {}'
+                             .format(phase, bucket["le"], cumulative))
+            lines.append('pool_recycle_phase_duration_seconds_sum{{phase="{}"}} {}'
+                         .format(phase, self._format(summary["total"])))
+            lines.append('pool_recycle_phase_duration_seconds_count{{phase="{}"}} {}'
+                         .format(phase, summary["count"]))
+        counters = report["counters"]
+        metric("errors_total", "counter", "Failed phases, as tsuru API calls.",
+               [((("phase", name[:-len(".errors")]),), value)
+                for name, value in sorted(counters.items()) if name.endswith(".errors")])
+        metric("retries_total", "counter", "Retried node operations.",
+               [((("kind", name[len("retries."):]),), value)
+                for name, value in sorted(counters.items()) if name.startswith("retries.")])
+        metric("breaker_trips_total", "counter", "Times tsuru API calls were paused after too many errors.",
+               [((), counters.get("breaker.opened", 0))])
+        return "\n".join(lines) + "\n"
+
+    @staticmethod
+    def _format(value):
+        if isinstance(value, float):
+            if math.isnan(value):
+                return "NaN"
+            return repr(value)
+        return str(value)
+
+
+class Future(object):
+    """
+    Result of an operation that finishes later, possibly on another thread.
+    It is resolved once, with a value or with an exception.
+    """
+
+    def __init__(self):
+        self.value = None
+        self.error = None
+        self._callbacks = []
+        self._done = threading.Event()
+        self._lock = threading.Lock()
+
+    def done(self):
+        return self._done.is_set()
+
+    def add_done_callback(self, fn):
+        with self._lock:
+            if not self.done():
+                self._callbacks.append(fn)
+                return
+        fn(self)
+
+    def set_result(self, value):
+        self._resolve(value=value)
+
+    def set_exception(self, error):
+        self._resolve(error=error)
+
+    def _resolve(self, value=None, error=None):
+        with self._lock:
+            self.value = value
+            self.error = error
+            self._done.set()
+            callbacks, self._callbacks = self._callbacks, []
+        for fn in callbacks:
+            fn(self)
+
+    def result(self):
+        # wait with timeout so KeyboardInterrupt reaches the main thread
+        while not self._done.wait(1):
+            pass
+        if self.error is not None:
+            raise self.error
+        return self.value
+
+
+class EventFuture(Future):
+    """
+    Outcome of a node operation watched by an EventTracker. It is resolved with
+    the finished tsuru event, or with an exception if the event failed or
+    could not be watched.
+    """
+
+    def __init__(self, msg, kind, target=None):
+        super(EventFuture, self).__init__()
+        self.msg = msg
+        self.kind = kind
+        self.target = target
+        self.ignore = set()
+        self.event_id = None
+        self.exact = False
+        self.sending = False
+        self.failures = 0
+        self.started = time.time()
+
+
+class EventTracker(object):
+    """
+    Watches the events of every pending node operation with a single
+    events.list query per tick, so the number of API calls does not grow
+    with the number of operations in flight.
+
+    Each operation is registered before its request is sent. When tsuru
+    answers the request with the id of the event it started, that event is
+    matched by id in the listing. Only an event the listing misses, as when
+    newer events pushed it out, is looked up with events.get, and failing to
+    look it up only fails that operation. Otherwise events already known at
+    registration time are ignored, and each event is claimed by one
+    operation only: node.delete events are matched by target address and
+    node.create events are handed out oldest first, in registration order.
+    The listing is narrowed down to the kind and target of the operations
+    waiting on it.
+    """
+
+    def __init__(self, client, owner, polling_policy, max_retry=10, stats=None):
+        self.client = client
+        self.owner = owner
+        self.polling_policy = polling_policy
+        self.max_retry = max_retry
+        if stats is None:
+            stats = RunStats()
+        self.stats = stats
+        self.cond = threading.Condition(threading.RLock())
+        self.pending = []
+        self.seen = set()
+        self.claimed = set()
+        self.thread = None
+        self.poll = 0
+
+    def watch_create(self, msg="Node create", sending=False):
+        return self._watch(EventFuture(msg, "node.create"), sending)
+
+    def watch_delete(self, address, msg="Node delete", sending=False):
+        return self._watch(EventFuture(msg, "node.delete", target=address), sending)
+
+    def sent(self, future, event_id=None):
+        """
+        Tells the operation of a future watched with `sending` was requested,
+        starting the event `event_id` if tsuru told it. Until then no event
+        is claimed for it, so it never takes the event of another operation.
+        """
+        with self.cond:
+            future.sending = False
+            if event_id:
+                future.event_id = event_id
+                future.exact = True
+                self.claimed.add(event_id)
+
+    def cancel(self, future):
+        with self.cond:
+            if future in self.pending:
+                self.pending.remove(future)
+
+    def recover(self, future):
+        """
+        Looks for the event of a future watched with `sending` whose request
+        failed without telling whether tsuru started the operation, as on a
+        timeout. Returns whether the event was found, the future then waiting
+        for it; otherwise the future is cancelled.
+        """
+        params = {"ownername": self.owner, "kindname": future.kind, "limit": 100}
+        if future.target is not None:
+            params["target.value"] = future.target
+        try:
+            with self.stats.timer("api.events.list"):
+                events = list(reversed(self.client.events.list(**params)))
+        except Exception:
+            events = []
+        with self.cond:
+            future.sending = False
+            for event in events:
+                self.seen.add(event["UniqueID"])
+                if self._claim(event) is future:
+                    return True
+        self.cancel(future)
+        return False
+
+    def _watch(self, future, sending=False):
+        future.sending = sending
+        with self.cond:
+            if not self.pending:
+                # nothing polled events lately, refresh what is already known
+                self.tick()
+            future.ignore = set(self.seen)
+            self.pending.append(future)
+            self.poll = 0
+            if self.thread is None:
+                self.thread = threading.Thread(target=self._run)
+                self.thread.daemon = True
+                self.thread.start()
+        return future
+
+    def tick(self):
+        with self.cond:
+            pending = list(self.pending)
+            # operations told their event id after the listing wait for the next tick
+            exact = [future for future in pending if future.exact]
+        params = {"ownername": self.owner, "limit": max(100, 4 * len(pending))}
+        kinds = set(future.kind for future in pending)
+        targets = set(future.target for future in pending)
+        if len(kinds) == 1:
+            params["kindname"] = kinds.pop()
+        if len(targets) == 1 and None not in targets:
+            params["target.value"] = targets.pop()
+        with self.stats.timer("api.events.list"):
+            events = list(reversed(self.client.events.list(**params)))
+        listed = set(event["UniqueID"] for event in events)
+        failed = []
+        # events pushed out of the listing by newer ones are looked up one by one
+        for future in exact:
+            if future.event_id in listed:
+                continue
+            try:
+                with self.stats.timer("api.events.get"):
+                    events.append(self.client.events.get(future.event_id))
+                future.failures = 0
+            except Exception as ex:
+                future.failures += 1
+                if future.failures > self.max_retry or not Retry.transient(ex):
+                    failed.append((future, ex))
+                else:
+                    sys.stderr.write("Failed to get event {}: {}.\n".format(future.event_id, ex))
+        resolved = []
+        with self.cond:
+            for future, error in failed:
+                if future in self.pending:
+                    self.pending.remove(future)
+                    resolved.append((future, None, error))
+            for event in events:
+                event_id = event["UniqueID"]
+                self.seen.add(event_id)
+                future = self._claim(event)
+                if future is None or event["Running"]:
+                    continue
+                self.pending.remove(future)
+                if event["Error"] != "":
+                    resolved.append((future, None, Exception(event["Error"])))
+                else:
+                    resolved.append((future, event, None))
+            for future in list(self.pending):
+                if self.polling_policy.expired(future.started):
+                    self.pending.remove(future)
+                    error = EventTimeoutError("{} still running after {} seconds"
+                                              .format(future.msg, self.polling_policy.deadline))
+                    resolved.append((future, None, error))
+        for future, event, error in resolved:
+            self.stats.add("wait." + future.kind, time.time() - future.started)
+            if error is not None:
+                future.set_exception(error)
+            else:
+                future.set_result(event)
+
+    def _claim(self, event):
+        event_id = event["UniqueID"]
+        for future in self.pending:
+            if future.event_id is not None:
+                if future.event_id == event_id:
+                    return future
+                continue
+            if future.sending:
+                continue
+            if (event_id in future.ignore or event_id in self.claimed or
+                    event["Kind"]["Name"] != future.kind):
+                continue
+            if future.target is not None and event["Target"]["Value"] != future.target:
+                continue
+            future.event_id = event_id
+            self.claimed.add(event_id)
+            return future
+        return None
+
+    def _run(self):
+        failures = 0
+        while True:
+            with self.cond:
+                if not self.pending:
+                    self.thread = None
+                    return
+            try:
+                self.tick()
+                failures = 0
+            except Exception as ex:
+                failures += 1
+                if failures > self.max_retry or not Retry.transient(ex):
+                    sys.stderr.write("Failed to retrieve events.\n")
+                    self._fail_pending(ex)
+                else:
+                    sys.stderr.write("Failed to get events: {}.\n".format(ex))
+            with self.cond:
+                if not self.pending:
+                    continue
+                interval = min(self.polling_policy.interval(self.poll, future.kind)
+                               for future in self.pending)
+                self.poll += 1
+                msgs = sorted(set(future.msg for future in self.pending))
+            sys.stdout.write("{} still running. Sleeping for {:.1f} seconds.\n"
+                             .format(", ".join(msgs), interval))
+            time.sleep(interval)
+
+    def _fail_pending(self, error):
+        with self.cond:
+            pending, self.pending = self.pending, []
+        for future in pending:
+            future.set_exception(error)
+
+
+class ReadinessWatcher(object):
+    """
+    Waits for new nodes to be ready to run containers, so their replaced
+    nodes are only drained onto nodes able to take the containers. A node is
+    ready once tsuru lists it with the ready status and a LastSuccess not
+    older than its creation. Every node waited on, by the TsuruPool of any
+    pool sharing the watcher, is checked against the same nodes listing,
+    fetched once per tick.
+    """
+
+    def __init__(self, inventory, polling_policy, stats=None):
+        self.inventory = inventory
+        self.polling_policy = polling_policy
+        if stats is None:
+            stats = RunStats()
+        self.stats = stats
+        self.cond = threading.Condition(threading.RLock())
+        self.pending = []
+        self.thread = None
+        self.poll = 0
+
+    def watch(self, address, since):
+        """
+        Returns a Future resolved with the node at `address` once it is ready,
+        `since` being the time its creation was requested.
+        """
+        future = Future()
+        future.address = address
+        future.since = since
+        future.started = time.time()
+        with self.cond:
+            self.pending.append(future)
+            self.poll = 0
+            if self.thread is None:
+                self.thread = threading.Thread(target=self._run)
+                self.thread.daemon = True
+                self.thread.start()
+        return future
+
+    @staticmethod
+    def ready(node, since):
+        if node is None or node.get('Status') != 'ready':
+            return False
+        last_success = node.get('LastSuccess') or node.get('Metadata', {}).get('LastSuccess')
+        try:
+            # LastSuccess has a precision of seconds
+            return last_success is not None and parse_timestamp(last_success) >= int(since)
+        except ValueError:
+            return False
+
+    def tick(self):
+        self.inventory.invalidate_nodes()
+        with self.cond:
+            pending = list(self.pending)
+        resolved = []
+        for future in pending:
+            node = self.inventory.node(future.address)
+            if self.ready(node, future.since):
+                resolved.append((future, node, None))
+            elif self.polling_policy.expired(future.started):
+                error = EventTimeoutError("Node {} not ready after {} seconds"
+                                          .format(future.address, self.polling_policy.deadline))
+                resolved.append((future, None, error))
+        with self.cond:
+            for future, _, _ in resolved:
+                self.pending.remove(future)
+        for future, node, error in resolved:
+            self.stats.add("wait.node.ready", time.time() - future.started)
+            if error is not None:
+                future.set_exception(error)
+            else:
+                future.set_result(node)
+
+    def _run(self):
+        failures = 0
+        while True:
+            with self.cond:
+                if not self.pending:
+                    self.thread = None
+                    return
+            try:
+                self.tick()
+                failures = 0
+            except Exception as ex:
+                failures += 1
+                sys.stderr.write("Failed to check new nodes: {}.\n".format(ex))
+                if failures > 10 or not Retry.transient(ex):
+                    with self.cond:
+                        pending, self.pending = self.pending, []
+                    for future in pending:
+                        future.set_exception(ex)
+            with self.cond:
+                if not self.pending:
+                    continue
+                interval = self.polling_policy.interval(self.poll)
+                self.poll += 1
+                addresses = ", ".join(sorted(future.address for future in self.pending))
+            sys.stdout.write("Waiting for node(s) {} to be ready. Sleeping for {:.1f} seconds.\n"
+                             .format(addresses, interval))
+            time.sleep(interval)
+
+
+class Return(Exception):
+    """
+    Raised by a generator based coroutine to return a value, as generators
+    can not use return with a value.
+    """
+
+    def __init__(self, value=None):
+        super(Return, self).__init__(value)
+        self.value = value
+
+
+class Sleep(object):
+    """
+    Yielded by a coroutine to be resumed after `seconds`, without blocking
+    the EventLoop.
+    """
+
+    def __init__(self, seconds):
+        self.seconds = seconds
+
+
+def coroutine(func):
+    """
+    Makes a plain function usable as a coroutine: its return value is
+    delivered through Return. Generator functions are kept as they are.
+    """
+    @functools.wraps(func)
+    def wrapper(*args, **kwargs):
+        result = func(*args, **kwargs)
+        if isinstance(result, types.GeneratorType):
+            return result
+        return _immediate(result)
+    return wrapper
+
+
+def _immediate(value):
+    raise Return(value)
+    yield
+
+
+class Task(Future):
+    """
+    A coroutine scheduled on an EventLoop, resolved with its return value.
+    """
+
+    def __init__(self, loop, coro):
+        super(Task, self).__init__()
+        self.loop = loop
+        self.coro = coro
+        self.running = False
+        self.waiting = None
+
+    def step(self, value=None, error=None):
+        if self.done():
+            return
+        self.running = True
+        try:
+            if error is not None:
+                yielded = self.coro.throw(error)
+            else:
+                yielded = self.coro.send(value)
+        except Return as ret:
+            self.set_result(ret.value)
+            return
+        except StopIteration:
+            self.set_result(None)
+            return
+        except Exception as ex:
+            self.set_exception(ex)
+            return
+        finally:
+            self.running = False
+        self.loop.wait_for(self, yielded)
+
+
+class EventLoop(object):
+    """
+    Single threaded scheduler for generator based coroutines.
+
+    A coroutine may yield a Sleep, another coroutine, a Future (such as an
+    EventFuture resolved by the EventTracker thread) or a list of those to
+    wait for all of them; it is resumed with the result. Any other value is
+    sent right back, so plain methods returning values can be used where a
+    coroutine is expected. API calls still block the loop while they run, but
+    waiting and retry sleeps do not, so one thread drives many operations.
+    """
+
+    def __init__(self):
+        self.cond = threading.Condition()
+        self.ready = collections.deque()
+        self.timers = []
+        self.seq = itertools.count()
+
+    def spawn(self, coro):
+        task = Task(self, coro)
+        self.call_soon(task.step)
+        return task
+
+    def call_soon(self, fn, *args):
+        with self.cond:
+            self.ready.append((fn, args))
+            self.cond.notify()
+
+    def call_later(self, delay, fn, *args):
+        with self.cond:
+            heapq.heappush(self.timers, (self.time() + delay, next(self.seq), fn, args))
+            self.cond.notify()
+
+    def time(self):
+        return time.time()
+
+    def run_until_complete(self, coro):
+        task = self.spawn(coro)
+        while not task.done():
+            try:
+                self._run_once()
+            except KeyboardInterrupt:
+                if task.running or task.done():
+                    raise
+                # let the main coroutine clean up, as the sync code does
+                task.waiting = None
+                task.step(error=KeyboardInterrupt())
+        return task.result()
+
+    def wait_for(self, task, yielded):
+        if isinstance(yielded, types.GeneratorType):
+            yielded = self.spawn(yielded)
+        elif isinstance(yielded, list):
+            yielded = self.spawn(self._gather(yielded))
+        # a task whose wait was interrupted must ignore the stale result
+        token = task.waiting = object()
+        if isinstance(yielded, Sleep):
+            self.call_later(yielded.seconds, self._send, task, token)
+        elif isinstance(yielded, Future):
+            yielded.add_done_callback(
+                lambda future: self.call_soon(self._send, task, token, future.value, future.error))
+        else:
+            self.call_soon(self._send, task, token, yielded)
+
+    def _send(self, task, token, value=None, error=None):
+        if task.waiting is not token:
+            return
+        task.waiting = None
+        task.step(value, error)
+
+    def _gather(self, items):
+        tasks = [self.spawn(self._await(item)) for item in items]
+        results = []
+        errors = []
+        for task in tasks:
+            try:
+                results.append((yield task))
+            except Exception as ex:
+                errors.append(ex)
+        if errors:
+            raise errors[0]
+        raise Return(results)
+
+    def _await(self, item):
+        result = yield item
+        raise Return(result)
+
+    def _run_once(self):
+        with self.cond:
+            while not self.ready:
+                now = self.time()
+                if self.timers and self.timers[0][0] <= now:
+                    _, _, fn, args = heapq.heappop(self.timers)
+                    self.ready.append((fn, args))
+                    break
+                timeout = 1
+                if self.timers:
+                    timeout = min(timeout, self.timers[0][0] - now)
+                self.cond.wait(timeout)
+            fn, args = self.ready.popleft()
+        fn(*args)
+
+
+class SimulatedEventLoop(EventLoop):
+    """
+    EventLoop on a virtual clock starting at zero: whenever no coroutine is
+    ready it jumps to the next timer instead of waiting for it, so a whole
+    recycle made of sleeps runs in no time.
+    """
+
+    def __init__(self):
+        super(SimulatedEventLoop, self).__init__()
+        self.now = 0
+
+    def time(self):
+        return self.now
+
+    def _run_once(self):
+        with self.cond:
+            if not self.ready:
+                if not self.timers:
+                    raise Exception("Simulation stalled with nothing left to run")
+                self.now = max(self.now, self.timers[0][0])
+                _, _, fn, args = heapq.heappop(self.timers)
+                self.ready.append((fn, args))
+            fn, args = self.ready.popleft()
+        fn(*args)
+
+
+_JSON_DELIMITER = re.compile(r'["{}\[\],:]')
+_JSON_STRING_END = re.compile(r'(?:[^"\\]|\\.)*"')
+_JSON_SPACE = re.compile(r'\s*')
+
+
+def iter_json_items(chunks, key):
+    """
+    Yields, one at a time, the items of the array under `key` of the JSON
+    object read from `chunks`. Every other member is skipped without being
+    decoded and only the item being decoded is kept in memory, however large
+    the whole document is.
+    """
+    decoder = json.JSONDecoder()
+    chunks = iter(chunks)
+    state = {"buf": "", "pos": 0, "eof": False}
+
+    def fill():
+        buf = state["buf"][state["pos"]:]
+        for chunk in chunks:
+            if chunk:
+                state["buf"], state["pos"] = buf + chunk, 0
+                return True
+        state["buf"], state["pos"], state["eof"] = buf, 0, True
+        return False
+
+    def skip_space():
+        while True:
+            state["pos"] = _JSON_SPACE.match(state["buf"], state["pos"]).end()
+            if state["pos"] < len(state["buf"]) or not fill():
+                return
+
+    depth = 0
+    expect_key = False
+    current = None
+    while True:
+        match = _JSON_DELIMITER.search(state["buf"], state["pos"])
+        if match is None:
+            state["pos"] = len(state["buf"])
+            if not fill():
+                return
+            continue
+        start, char = match.start(), match.group()
+        if char == '"':
+            end = _JSON_STRING_END.match(state["buf"], start + 1)
+            if end is None:
+                state["pos"] = start
+                if not fill():
+                    raise ValueError("Unterminated JSON string")
+                continue
+            if depth == 1 and expect_key:
+                current = json.loads(state["buf"][start:end.end()])
+            state["pos"] = end.end()
+            continue
+        state["pos"] = start + 1
+        if char == "[" and depth == 1 and not expect_key and current == key:
+            while True:
+                skip_space()
+                if state["eof"] and state["pos"] == len(state["buf"]):
+                    raise ValueError("Unterminated JSON array")
+                if state["buf"][state["pos"]] == "]":
+                    state["pos"] += 1
+                    break
+                try:
+                    item, end = decoder.raw_decode(state["buf"], state["pos"])
+                    # a number cut at the end of a chunk decodes, but wrongly
+                    if end == len(state["buf"]) and not state["eof"]:
+                        raise ValueError("Incomplete JSON item")
+                except ValueError:
+                    if not fill():
+                        raise
+                    continue
+                state["pos"] = end
+                yield item
+                skip_space()
+                if state["buf"][state["pos"]:state["pos"] + 1] == ",":
+                    state["pos"] += 1
+        elif char in "{[":
+            depth += 1
+            expect_key = depth == 1
+        elif char in "}]":
+            depth -= 1
+        elif char == ":" and depth == 1:
+            expect_key = False
+        elif char == "," and depth == 1:
+            expect_key = True
+            current = None
+
+
+def iter_nodes(response):
+    """
+    Yields the nodes of a streamed nodes.list `response` keeping only the
+    fields used by the recycle: address, status, pool and last success.
+    """
+    response.raise_for_status()
+    for node in iter_json_items(response.iter_content(64 * 1024), "nodes"):
+        metadata = node.get("Metadata") or {}
+        yield {"Address": node.get("Address"), "Status": node.get("Status"),
+               "Metadata": dict((name, metadata[name]) for name in ("pool", "LastSuccess")
+                                if name in metadata)}
+
+
+class Inventory(object):
+    """
+    Cached cluster-wide nodes.list and templates.list results, shared by the
+    TsuruPool of every pool in a run. Each listing is downloaded at most once
+    per `ttl` seconds and indexed by pool in a single pass, so repeated
+    lookups do not hit tsuru. The nodes listing is parsed as it streams in,
+    keeping only the few fields used of each node. Listings are invalidated
+    after our own node creations and removals.
+    """
+
+    def __init__(self, client, ttl=60, stats=None):
+        self.client = client
+        self.ttl = ttl
+        if stats is None:
+            stats = RunStats()
+        self.stats = stats
+        self.lock = threading.Lock()
+        self.nodes_by_pool = None
+        self.nodes_fetched = 0
+        self.templates_by_pool = None
+        self.templates_fetched = 0
+
+    def nodes(self, pool):
+        return list(self._nodes_index().get(pool, []))
+
+    def pools(self):
+        return sorted(self._nodes_index().keys())
+
+    def node(self, address):
+        """
+        Returns the node at `address`, given as an URL or a bare host, on any
+        pool, or None.
+        """
+        host = urlparse(address).hostname or address
+        for nodes in self._nodes_index().values():
+            for node in nodes:
+                if (urlparse(node['Address']).hostname or node['Address']) == host:
+                    return node
+        return None
+
+    def templates(self, pool):
+        return list(self._templates_index().get(pool, []))
+
+    def invalidate_nodes(self):
+        with self.lock:
+            self.nodes_by_pool = None
+
+    def invalidate_templates(self):
+        with self.lock:
+            self.templates_by_pool = None
+
+    def _expired(self, fetched):
+        return time.time() - fetched >= self.ttl
+
+    def _nodes_index(self):
+        with self.lock:
+            if self.nodes_by_pool is not None and not self._expired(self.nodes_fetched):
+                return self.nodes_by_pool
+        try:
+            with self.stats.timer("api.nodes.list"):
+                index = self.client.nodes.request("get", "/node", version=1.2, stream=True,
+                                                  handle_response=self._index_nodes)
+        except Exception as ex:
+            raise Exception('Error get nodes from tsuru: "{}"'.format(ex))
+        with self.lock:
+            self.nodes_by_pool = index
+            self.nodes_fetched = time.time()
+        return index
+
+    def _index_nodes(self, response):
+        index = {}
+        for node in iter_nodes(response):
+            if 'pool' in node['Metadata']:
+                index.setdefault(node['Metadata']['pool'], []).append(node)
+        return index
+
+    def _templates_index(self):
+        with self.lock:
+            if self.templates_by_pool is not None and not self._expired(self.templates_fetched):
+                return self.templates_by_pool
+        try:
+            with self.stats.timer("api.templates.list"):
+                machines_templates = self.client.templates.list()
+        except Exception as ex:
+            raise Exception('Error getting machines templates on tsuru: {}'
+                            .format(ex))
+        index = {}
+        for template in machines_templates:
+            for item in template['Data']:
+                if 'pool' == item['Name']:
+                    index.setdefault(item['Value'], []).append(template['Name'])
+        with self.lock:
+            self.templates_by_pool = index
+            self.templates_fetched = time.time()
+        return index
+
+
+class Journal(object):
+    """
+    Append-only JSON lines record of the progress of each recycle, so an
+    interrupted recycle can be resumed instead of starting from scratch.
+
+    Every run of a pool starts with a "started" record and ends with a
+    "done" one. In between, each old node goes through "creating" (tsuru
+    started the event creating its replacement), "created" (its replacement
+    exists and is ready), "removal-started" and "removed". Records are
+    flushed to disk as they are written.
+    """
+
+    STARTED = "started"
+    CREATING = "creating"
+    CREATED = "created"
+    REMOVAL_STARTED = "removal-started"
+    REMOVED = "removed"
+    DONE = "done"
+
+    def __init__(self, path):
+        self.path = path
+        self.lock = threading.Lock()
+
+    def start(self, pool):
+        self.record(pool, self.STARTED)
+
+    def finish(self, pool):
+        self.record(pool, self.DONE)
+
+    def record(self, pool, state, node=None, new_node=None, event_id=None):
+        entry = {"time": time.time(), "pool": pool, "state": state}
+        if node is not None:
+            entry["node"] = node
+        if new_node is not None:
+            entry["new_node"] = new_node
+        if event_id is not None:
+            entry["event_id"] = event_id
+        line = json.dumps(entry) + "\n"
+        with self.lock:
+            with open(self.path, "a+") as journal_file:
+                journal_file.seek(0, os.SEEK_END)
+                if journal_file.tell() > 0:
+                    # don't glue the record to a line half written by a crash
+                    journal_file.seek(-1, os.SEEK_END)
+                    if journal_file.read(1) != "\n":
+                        line = "\n" + line
+                    journal_file.seek(0, os.SEEK_END)
+                journal_file.write(line)
+                journal_file.flush()
+                os.fsync(journal_file.fileno())
+
+    def replay(self, pool):
+        """
+        Returns the last known state of each old node of the last unfinished
+        run of `pool`, as a dict of node address to record.
+        """
+        states = {}
+        if not os.path.exists(self.path):
+            return states
+        with open(self.path) as journal_file:
+            for line in journal_file:
+                try:
+                    entry = json.loads(line)
+                except ValueError:
+                    # a crash may leave the last line half written
+                    continue
+                if entry.get("pool") != pool:
+                    continue
+                if entry["state"] in (self.STARTED, self.DONE):
+                    states = {}
+                    continue
+                record = states.setdefault(entry["node"], {})
+                record["state"] = entry["state"]
+                for key in ("new_node", "event_id"):
+                    if key in entry:
+                        record[key] = entry[key]
+        return states
+
+    def resume(self, pool, nodes):
+        """
+        Reconciles the journal with the current `nodes` of `pool`. Returns the
+        nodes still to be recycled and a dict of those whose replacement was
+        already created to their replacement.
+        """
+        states = self.replay(pool)
+        new_nodes = set(record["new_node"] for record in states.values()
+                        if "new_node" in record)
+        remaining = []
+        replaced = {}
+        for node in nodes:
+            if node in new_nodes:
+                continue
+            record = states.get(node)
+            if record is not None and record["state"] == self.REMOVED:
+                continue
+            remaining.append(node)
+            if record is not None and record.get("new_node") in nodes:
+                replaced[node] = record["new_node"]
+        return remaining, replaced
+
+
+class TemplateScheduler(object):
+    """
+    Chooses the IaaS template of each new node from the create latency and
+    failure rate observed on each template during the run.
+
+    Each template is scored by the expected time to get a node out of it: its
+    mean create latency, in whole seconds, divided by its success rate, plus
+    the `retry_interval` paid on every failed attempt. New nodes go to the
+    template with the lowest score weighted by the nodes already assigned to
+    it, so with equal scores templates are used in turn. Every template gets
+    at least `min_share` of the nodes, rounded down, half an even split by
+    default.
+    """
+
+    def __init__(self, templates, min_share=None, retry_interval=60):
+        self.templates = list(templates)
+        if min_share is None:
+            min_share = 0.5 / len(self.templates)
+        self.min_share = min_share
+        self.retry_interval = retry_interval
+        self.lock = threading.Lock()
+        self.assigned = dict((template, 0) for template in self.templates)
+        self.attempts = dict((template, 0) for template in self.templates)
+        self.failures = dict((template, 0) for template in self.templates)
+        self.latency = dict((template, 0) for template in self.templates)
+
+    def choose(self):
+        with self.lock:
+            total = sum(self.assigned.values()) + 1
+            behind = [template for template in self.templates
+                      if self.assigned[template] < int(self.min_share * total)]
+            if behind:
+                template = min(behind, key=lambda template: self.assigned[template])
+            else:
+                template = min(self.templates,
+                               key=lambda template: (self.assigned[template] + 1) * self._score(template))
+            self.assigned[template] += 1
+            return template
+
+    def record(self, template, latency, failed=False):
+        with self.lock:
+            self.attempts[template] += 1
+            if failed:
+                self.failures[template] += 1
+                self.assigned[template] -= 1
+            else:
+                self.latency[template] += max(1, int(round(latency)))
+
+    def _mean_latency(self, template):
+        successes = self.attempts[template] - self.failures[template]
+        if successes:
+            return float(self.latency[template]) / successes
+        observed = [self._mean_latency(other) for other in self.templates
+                    if self.attempts[other] > self.failures[other]]
+        return sum(observed) / len(observed) if observed else 1.0
+
+    def _score(self, template):
+        successes = self.attempts[template] - self.failures[template]
+        success_rate = (successes + 1.0) / (self.attempts[template] + 1)
+        return (self._mean_latency(template) / success_rate +
+                self.retry_interval * (1 - success_rate) / success_rate)
+
+
+class RateLimiter(object):
+    """
+    Token buckets bounding the rate of tsuru API calls of a run, per endpoint.
+    `rates` maps endpoints among ENDPOINTS to calls per second; endpoints
+    without a rate are not limited. Each bucket holds up to one second worth
+    of calls, and callers over budget wait their turn.
+    """
+
+    ENDPOINTS = ("create", "delete", "events")
+
+    def __init__(self, rates=None):
+        self.rates = dict(rates or {})
+        self.lock = threading.Lock()
+        self.buckets = {}
+
+    @staticmethod
+    def endpoint(method, path):
+        if method.lower() == "post" and path == "/node":
+            return "create"
+        if method.lower() == "delete" and path.startswith("/node/"):
+            return "delete"
+        if path.startswith("/events"):
+            return "events"
+        return None
+
+    def acquire(self, endpoint):
+        """
+        Takes a call from the bucket of `endpoint`, sleeping until the bucket
+        has one. Returns the time slept.
+        """
+        rate = float(self.rates.get(endpoint) or 0)
+        if not rate:
+            return 0
+        with self.lock:
+            now = time.time()
+            tokens, updated = self.buckets.get(endpoint, (max(1, rate), now))
+            tokens = min(max(1, rate), tokens + (now - updated) * rate) - 1
+            self.buckets[endpoint] = (tokens, now)
+        if tokens >= 0:
+            return 0
+        # the call is already taken from the bucket, so callers queue up in order
+        wait = -tokens / rate
+        time.sleep(wait)
+        return wait
+
+
+class CircuitBreaker(object):
+    """
+    Pauses every tsuru API call of a run when too many of the recent ones
+    failed. Once at least `min_calls` calls finished in the last `window`
+    seconds and the fraction of failures reaches `threshold`, calls wait for
+    `cooldown` seconds. Then a single call probes tsuru: if it succeeds calls
+    go on, otherwise they wait for another `cooldown`.
+    """
+
+    CLOSED, OPEN, PROBING = "closed", "open", "probing"
+
+    def __init__(self, threshold=0.5, window=60, min_calls=10, cooldown=30, stats=None):
+        self.threshold = threshold
+        self.window = window
+        self.min_calls = min_calls
+        self.cooldown = cooldown
+        if stats is None:
+            stats = RunStats()
+        self.stats = stats
+        self.cond = threading.Condition()
+        self.state = self.CLOSED
+        self.opened = 0
+        self.calls = collections.deque()
+
+    def acquire(self):
+        """
+        Waits until calls are allowed. Returns whether the call is the probe,
+        whose outcome must be recorded with `probe` set.
+        """
+        with self.cond:
+            if self.state == self.CLOSED:
+                return False
+            started = time.time()
+            while True:
+                if self.state == self.CLOSED:
+                    self.stats.add("throttle.breaker", time.time() - started)
+                    return False
+                wait = self.opened + self.cooldown - time.time()
+                if self.state == self.OPEN and wait <= 0:
+                    self.state = self.PROBING
+                    self.stats.add("throttle.breaker", time.time() - started)
+                    return True
+                # wait with timeout so KeyboardInterrupt reaches the main thread
+                self.cond.wait(min(1, max(wait, 0.01)))
+
+    def record(self, failed, probe=False):
+        with self.cond:
+            now = time.time()
+            if probe:
+                if failed:
+                    self._open(now)
+                else:
+                    self.state = self.CLOSED
+                    self.cond.notify_all()
+                return
+            if self.state != self.CLOSED:
+                return
+            self.calls.append((now, failed))
+            while self.calls and self.calls[0][0] < now - self.window:
+                self.calls.popleft()
+            failures = sum(1 for _, call_failed in self.calls if call_failed)
+            if len(self.calls) >= self.min_calls and failures >= self.threshold * len(self.calls):
+                self._open(now)
+
+    def _open(self, now):
+        self.state = self.OPEN
+        self.opened = now
+        self.calls.clear()
+        self.stats.count("breaker.opened")
+        sys.stderr.write("Too many tsuru API errors, pausing API calls for {} seconds.\n"
+                         .format(self.cooldown))
+
+
+class TsuruSession(object):
+    """
+    Keep-alive connections to tsuru shared by every TsuruPool of a run.
+
+    tsuruclient sends each request with requests.request, opening a new
+    connection every time. `bind` makes the managers of a client send their
+    requests through a pooled requests.Session instead, using at most
+    `max_connections` connections at once. Streamed requests, as node
+    creations, whose response is left unread while the node is created, keep
+    using their own connection so they never hold a pooled one. Streamed
+    responses read by a `handle_response` are pooled, and closed once handled
+    so a failed read gives its connection back.
+
+    Every call goes through the `limiter` and the `breaker` of the session,
+    and the time calls wait on them is recorded on `stats` as "throttle.*".
+    """
+
+    EVENT_ID_HEADER = "X-Tsuru-Eventid"
+
+    def __init__(self, max_connections=10, limiter=None, breaker=None, stats=None):
+        if stats is None:
+            stats = RunStats()
+        self.stats = stats
+        if limiter is None:
+            limiter = RateLimiter()
+        self.limiter = limiter
+        if breaker is None:
+            breaker = CircuitBreaker(stats=stats)
+        self.breaker = breaker
+        self.local = threading.local()
+        self.max_connections = max_connections
+        self.lock = threading.Lock()
+        self._session = None
+
+    @property
+    def session(self):
+        with self.lock:
+            if self._session is None:
+                import_tsuruclient()
+                self._session = requests.Session()
+                adapter = requests.adapters.HTTPAdapter(pool_connections=1,
+                                                        pool_maxsize=self.max_connections,
+                                                        pool_block=True)
+                self._session.mount("http://", adapter)
+                self._session.mount("https://", adapter)
+            return self._session
+
+    def bind(self, tsuru_client):
+        for manager in vars(tsuru_client).values():
+            if isinstance(manager, base.Manager):
+                manager.request = functools.partial(self.request, manager)
+        return tsuru_client
+
+    @contextlib.contextmanager
+    def started_event(self):
+        """
+        Captures the id of the tsuru event started by the request sent, from
+        this thread, within the block, when tsuru tells it.
+        """
+        started = {"id": None}
+        self.local.started = started
+        try:
+            yield started
+        finally:
+            self.local.started = None
+
+    def request(self, manager, method, path, version=None, handle_response=None, **kwargs):
+        # tsuruclient's Manager.request, on the pooled session
+        url = manager.target
+        if version is not None:
+            url = "{}/{}".format(url, version)
+        url = "{}{}".format(url, path)
+        kwargs["headers"] = manager.headers
+        endpoint = self.limiter.endpoint(method, path)
+        probe = self.breaker.acquire()
+        try:
+            waited = self.limiter.acquire(endpoint)
+            if waited:
+                self.stats.add("throttle." + endpoint, waited)
+            if kwargs.get("stream") and handle_response is None:
+                response = requests.request(method, url, **kwargs)
+            else:
+                response = self.session.request(method, url, **kwargs)
+        except Exception:
+            self.breaker.record(True, probe)
+            raise
+        # client errors are answers to a bad request, not signs of an overloaded tsuru
+        self.breaker.record(response.status_code >= 500 or response.status_code == 429, probe)
+        started = getattr(self.local, "started", None)
+        if started is not None and response.headers.get(self.EVENT_ID_HEADER):
+            started["id"] = response.headers[self.EVENT_ID_HEADER]
+        if handle_response is not None:
+            with contextlib.closing(response):
+                return handle_response(response)
+        try:
+            response.raise_for_status()
+        except requests.exceptions.HTTPError as error:
+            raise base.TsuruAPIError("{}: {}".format(error, error.response.text), response=response)
+        if response.headers.get("content-type") == "application/x-json-stream":
+            return manager.json_stream(response)
+        return manager.json(response)
+
+
+class LazyClient(object):
+    """
+    tsuru API client created, with the tsuruclient import, on its first API
+    call, so building a TsuruPool is cheap and code paths that never call
+    tsuru do not pay for them. Dry runs still list templates, nodes and
+    healing, they only skip the user lookup.
+    """
+
+    def __init__(self, target, token, session):
+        self.target = target
+        self.token = token
+        self.session = session
+        self.lock = threading.Lock()
+        self.client = None
+
+    def __getattr__(self, name):
+        with self.lock:
+            if self.client is None:
+                import_tsuruclient()
+                self.client = self.session.bind(client.Client(self.target, self.token))
+        return getattr(self.client, name)
+
+
+class TsuruPool(object):
+
+    # users of each tsuru target and token, looked up once per process
+    users = {}
+    users_lock = threading.Lock()
+
+    # a node creation still running may yet add its node, creating another
+    # one would leave it in the pool untracked
+    FATAL_ERRORS = {"create": (EventTimeoutError,)}
+
+    def __init__(self, pool=None, polling_policy=None, inventory=None, stats=None, session=None,
+                 readiness=None, retry_budgets=None, drain_budget=None, event_tracker=None):
+        if stats is None:
+            stats = RunStats()
+        self.stats = stats
+        try:
+            self.tsuru_target = os.environ['TSURU_TARGET'].rstrip("/")
+            self.tsuru_token = os.environ['TSURU_TOKEN']
+        except KeyError:
+            raise KeyError("TSURU_TARGET or TSURU_TOKEN envs not set")
+        if session is None:
+            session = TsuruSession(stats=self.stats)
+        self.session = session
+        self.client = LazyClient(self.tsuru_target, self.tsuru_token, session)
+        self.pool = pool
+        if polling_policy is None:
+            polling_policy = PollingPolicy()
+        self.polling_policy = polling_policy
+        self.lock = threading.Lock()
+        self._event_tracker = event_tracker
+        if inventory is None:
+            inventory = Inventory(self.client, stats=self.stats)
+        self.inventory = inventory
+        if readiness is None:
+            readiness = ReadinessWatcher(self.inventory, self.polling_policy, stats=self.stats)
+        self.readiness = readiness
+        self.retry_budgets = retry_budgets or {}
+        self.drain_budget = drain_budget
+
+    @property
+    def user(self):
+        key = (self.tsuru_target, self.tsuru_token)
+        with self.users_lock:
+            if key not in self.users:
+                try:
+                    self.users[key] = self.client.users.info()
+                except Exception as ex:
+                    raise Exception("Failed to get current user info: {}".format(ex))
+            return self.users[key]
+
+    @property
+    def event_tracker(self):
+        with self.lock:
+            if self._event_tracker is None:
+                self._event_tracker = EventTracker(self.client, self.user["Email"], self.polling_policy,
+                                                   stats=self.stats)
+            return self._event_tracker
+
+    def get_nodes(self):
+        return [node['Address'] for node in self.inventory.nodes(self.pool)]
+
+    def get_pools(self):
+        return self.inventory.pools()
+
+    def get_node_info(self, address):
+        for node in self.inventory.nodes(self.pool):
+            if node['Address'] == address:
+                return node
+        return {}
+
+    def get_node_containers(self, address):
+        try:
+            with self.stats.timer("api.node.containers"):
+                containers = self.client.nodes.request(
+                    "get", "/docker/node/{}/containers".format(self.get_address(address)))
+        except Exception as ex:
+            raise Exception('Error getting containers of node "{}": {}'.format(address, ex))
+        # tsuru answers with no content when there is no container on the node
+        return containers or []
+
+    def create_new_node(self, iaas_template, max_retry=10, retry_interval=60, templates=None,
+                        requested=None):
+        """
+        Creates a node from `iaas_template` and returns its address once it is
+        ready. `requested` is called with the id of each creation event tsuru
+        starts, as soon as it is known.
+        """
+        retry = self.retry("create", "Node creation", NewNodeError, max_retry, retry_interval)
+        while True:
+            started = time.time()
+            try:
+                future = self.notify_requested(self.start_create(iaas_template), requested)
+                try:
+                    event = self.wait_event(future)
+                except EventTimeoutError:
+                    self.abandon_creation(future)
+                    raise
+                break
+            except Exception as ex:
+                if templates is not None:
+                    templates.record(iaas_template, time.time() - started, failed=True)
+                interval = retry.backoff(ex)
+                with self.stats.timer("sleep.retry"):
+                    time.sleep(interval)
+                if templates is not None:
+                    iaas_template = templates.choose()
+        if templates is not None:
+            templates.record(iaas_template, time.time() - started)
+        self.wait_ready([event["Target"]["Value"]], started)
+        return event["Target"]["Value"]
+
+    @staticmethod
+    def notify_requested(future, requested=None, *args):
+        if requested is not None and future.event_id:
+            requested(*(args + (future.event_id,)))
+        return future
+
+    def retry(self, operation, msg, error_class, max_retry, retry_interval):
+        return Retry(operation, msg, error_class, max_retry=max_retry, retry_interval=retry_interval,
+                     budget=self.retry_budgets.get(operation), polling_policy=self.polling_policy,
+                     stats=self.stats, fatal_errors=self.FATAL_ERRORS.get(operation, ()))
+
+    def start_create(self, iaas_template, msg="Node create"):
+        """
+        Requests a new node and returns the future of its creation event. If
+        the request failed in a way that tsuru may have created the node
+        anyway, its event is looked up so the node is not created twice.
+        """
+        future = self.event_tracker.watch_create(msg, sending=True)
+        try:
+            event_id = self.request_new_node(iaas_template)
+        except Exception as ex:
+            if Retry.transient(ex) and self.event_tracker.recover(future):
+                sys.stderr.write("Node creation request failed: {}, but tsuru is creating it.\n"
+                                 .format(ex))
+                return future
+            self.event_tracker.cancel(future)
+            raise
+        self.event_tracker.sent(future, event_id)
+        return future
+
+    def request_new_node(self, iaas_template):
+        data = {
+            "register": "false",
+            "Metadata.template": iaas_template
+        }
+        try:
+            with self.stats.timer("api.nodes.create"), self.session.started_event() as started:
+                self.client.nodes.create(**data)
+        finally:
+            self.inventory.invalidate_nodes()
+        return started["id"]
+
+    def create_new_nodes(self, iaas_templates, max_retry=10, retry_interval=60, requested=None):
+        """
+        Creates a node from each of `iaas_templates` at once and returns their
+        addresses once all are ready. `requested` is called with the position
+        of each node and the id of its creation event, as soon as it is known.
+        """
+        started = time.time()
+        futures = []
+        for idx, iaas_template in enumerate(iaas_templates):
+            retry = self.retry("create", "Node creation", NewNodeError, max_retry, retry_interval)
+            while True:
+                try:
+                    future = self.start_create(iaas_template, "Nodes create")
+                    futures.append(self.notify_requested(future, requested, idx))
+                    break
+                except Exception as ex:
+                    try:
+                        interval = retry.backoff(ex)
+                    except NewNodeError:
+                        self.abandon_creations(futures)
+                        raise
+                    with self.stats.timer("sleep.retry"):
+                        time.sleep(interval)
+        try:
+            events = self.wait_events(futures)
+        except Exception as ex:
+            self.abandon_creations(futures)
+            raise NewNodeError(ex)
+        self.wait_ready([event["Target"]["Value"] for event in events], started)
+        return [event["Target"]["Value"] for event in events]
+
+    def get_machines_templates(self):
+        return self.inventory.templates(self.pool)
+
+    def resume_creation(self, event_id):
+        """
+        Waits for the node creation event `event_id` requested by an
+        interrupted run and returns the address of the node it created, once
+        ready. Returns None if no node is left of it.
+        """
+        future = self.event_tracker.watch_create("Node create", sending=True)
+        self.event_tracker.sent(future, event_id)
+        try:
+            event = self.wait_event(future)
+        except Exception as ex:
+            sys.stderr.write("Node creation {} failed: {}\n".format(event_id, ex))
+            return None
+        address = self.created_node(event)
+        if address is None:
+            return None
+        try:
+            self.wait_ready([address], self.event_started(event))
+        except NewNodeError:
+            return None
+        return address
+
+    def created_node(self, event):
+        address = event["Target"]["Value"]
+        self.inventory.invalidate_nodes()
+        if self.inventory.node(address) is None:
+            # removed since, as when it never got ready
+            return None
+        return address
+
+    @staticmethod
+    def event_started(event):
+        try:
+            return parse_timestamp(event.get("StartTime") or "")
+        except ValueError:
+            return 0
+
+    def wait_event(self, future):
+        return future.result()
+
+    def wait_ready(self, addresses, since):
+        """
+        Waits for the new nodes at `addresses`, created since `since`, to be
+        ready before their replaced nodes get removed. If any of them is not,
+        they are all removed, as no node is replaced by them.
+        """
+        futures = [self.readiness.watch(address, since) for address in addresses]
+        try:
+            return self.wait_events(futures)
+        except Exception as ex:
+            self.wait_discarded(self.discard_nodes(addresses))
+            raise NewNodeError(ex)
+
+    def discard_nodes(self, addresses):
+        """
+        Starts removing the new nodes at `addresses`, so they are not left in
+        the pool without anything tracking them, and returns the futures of
+        their removals.
+        """
+        futures = []
+        for address in addresses:
+            sys.stdout.write('Removing new node "{}".\n'.format(address))
+            try:
+                futures.append(self.start_remove(address))
+            except Exception as ex:
+                sys.stderr.write('Failed to remove new node "{}": {}\n'.format(address, ex))
+        return futures
+
+    def wait_discarded(self, futures):
+        try:
+            self.wait_events(futures)
+        except Exception as ex:
+            sys.stderr.write("Failed to remove new node(s): {}\n".format(ex))
+
+    def abandon_creations(self, futures):
+        """
+        Waits for the creations of a failed batch, watched by `futures`, and
+        removes the nodes they created, as no node is replaced by them.
+        """
+        addresses = []
+        for future in futures:
+            try:
+                addresses.append(future.result()["Target"]["Value"])
+            except Exception:
+                pass
+        self.wait_discarded(self.discard_nodes(addresses))
 
+    def abandon_creation(self, future):
+        """
+        Keeps following the creation event of `future`, which timed out, and
+        removes the node it creates once it finishes, as no node is replaced
+        by it.
+        """
+        follow = self.follow_creation(future)
+        if follow is not None:
+            self.abandon_creations([follow])
 
-class TsuruPool(object):
+    def follow_creation(self, future):
+        if not future.event_id:
+            sys.stderr.write("Lost track of a timed out node creation.\n")
+            return None
+        follow = self.event_tracker.watch_create(future.msg, sending=True)
+        self.event_tracker.sent(follow, future.event_id)
+        return follow
 
-    def __init__(self, pool):
-        try:
-            self.tsuru_target = os.environ['TSURU_TARGET'].rstrip("/")
-            self.tsuru_token = os.environ['TSURU_TOKEN']
-            self.client = client.Client(self.tsuru_target, self.tsuru_token)
-        except KeyError:
-            raise KeyError("TSURU_TARGET or TSURU_TOKEN envs not set")
+    def wait_events(self, futures):
+        errors = []
+        events = []
+        for future in futures:
+            try:
+                events.append(future.result())
+            except Exception as ex:
+                errors.append(str(ex))
+        if errors:
+            raise Exception("; ".join(errors))
+        return events
+
+    def remove_node(self, node, max_retry=10, retry_interval=60):
+        retry = self.retry("delete", "Node delete", RemoveNodeFromPoolError, max_retry, retry_interval)
+        containers = self.admit_drain(node)
         try:
-            self.user = self.client.users.info()
-        except Exception as ex:
-            raise Exception("Failed to get current user info: {}".format(ex))
-        self.pool = pool
+            while True:
+                try:
+                    self.wait_event(self.start_remove(node))
+                    return True
+                except Exception as ex:
+                    if self.removed(node):
+                        return True
+                    interval = retry.backoff(ex)
+                    with self.stats.timer("sleep.retry"):
+                        time.sleep(interval)
+        finally:
+            self.release_drain(containers)
 
-    def get_nodes(self):
+    def drain_size(self, node):
+        """
+        Containers tsuru will move off `node` when removing it, or 1 if they
+        can not be listed.
+        """
+        if self.drain_budget is None or self.drain_budget.max_containers is None:
+            return 0
         try:
-            docker_nodes = self.client.nodes.list()
+            return len(self.get_node_containers(node))
         except Exception as ex:
-            raise Exception('Error get nodes from tsuru: "{}"'.format(ex))
+            sys.stderr.write("{}, counting it as 1 container.\n".format(ex))
+            return 1
 
-        pool_nodes = []
-        if 'nodes' in docker_nodes and docker_nodes['nodes'] is not None:
-            for node in docker_nodes['nodes']:
-                if ('pool' in node['Metadata'] and
-                   node['Metadata']['pool'] == self.pool):
-                    pool_nodes.append(node['Address'])
-        return pool_nodes
-
-    def create_new_node(self, iaas_template, curr_try=0, max_retry=10,
-                        retry_interval=60):
-        try:
-            data = {
-                "register": "false",
-                "Metadata.template": iaas_template
-            }
-            self.client.nodes.create(**data)
-            eventArgs = {
-                "ownername": self.user["Email"],
-                "kindname": "node.create",
-            }
-            event = self.wait_event("Node create", max_retry=max_retry, **eventArgs)
-        except Exception as ex:
-            if curr_try == max_retry:
-                raise NewNodeError("Maximum number of retries exceeded: {}"
-                                   .format(ex))
-            sys.stderr.write("Node creation failed: {}. Retrying in {} seconds\n"
-                             .format(ex, retry_interval))
-            time.sleep(retry_interval)
-            return self.create_new_node(iaas_template=iaas_template,
-                                        curr_try=curr_try+1,
-                                        max_retry=max_retry,
-                                        retry_interval=retry_interval)
-        return event["Target"]["Value"]
+    def admit_drain(self, node):
+        """
+        Waits for the drain budget to admit the drain of `node` and returns
+        the containers it holds of the budget.
+        """
+        containers = self.drain_size(node)
+        if self.drain_budget is not None:
+            with self.stats.timer("wait.drain"):
+                self.drain_budget.admit(containers).result()
+        return containers
 
-    def get_machines_templates(self):
-        try:
-            machines_templates = self.client.templates.list()
-        except Exception as ex:
-            raise Exception('Error getting machines templates on tsuru: {}'
-                            .format(ex))
-        iaas_templates = []
-        for template in machines_templates:
-            for item in template['Data']:
-                if 'pool' == item['Name'] and self.pool == item['Value']:
-                    iaas_templates.append(template['Name'])
-        return iaas_templates
-
-    def wait_event(self, msg, max_retry=10, **kwargs):
-        running = True
-        curr_try = 0
-        while running:
-            try:
-                event = self.client.events.list(**kwargs)[0]
-            except Exception, ex:
-                if curr_try == max_retry:
-                    sys.stderr.write("Failed to retrieve event.")
-                    raise ex
-                curr_try = curr_try + 1
-                sys.stderr.write("Failed to get event. Retrying in 15 seconds.")
-                time.sleep(15)
-                continue
-            curr_try = 0
-            running = event["Running"]
-            if event["Error"] != "":
-                raise Exception(event["Error"])
-            if running:
-                sys.stdout.write("{} still running. Sleeping for 15 seconds.\n"
-                                 .format(msg))
-                time.sleep(15)
-        return event
-
-    def remove_node(self, node, curr_try=0, max_retry=10, retry_interval=60):
+    def release_drain(self, containers):
+        if self.drain_budget is not None:
+            self.drain_budget.release(containers)
+
+    def start_remove(self, node):
         params = {"remove-iaas": "true", "address": node}
+        future = self.event_tracker.watch_delete(node, sending=True)
+        try:
+            with self.stats.timer("api.nodes.remove"), self.session.started_event() as started:
+                self.client.nodes.remove(**params)
+        except Exception:
+            self.event_tracker.cancel(future)
+            raise
+        else:
+            self.event_tracker.sent(future, started["id"])
+        finally:
+            self.inventory.invalidate_nodes()
+        return future
+
+    def removed(self, node):
+        """
+        Tells whether `node`, whose removal failed, is gone anyway, as when
+        tsuru removed it but the request timed out.
+        """
+        self.inventory.invalidate_nodes()
         try:
-            self.client.nodes.remove(**params)
-            eventArgs = {
-                "kindname": "node.delete",
-                "target.type": "node",
-                "target.value": node,
-            }
-            self.wait_event("Node delete", max_retry=max_retry, **eventArgs)
-        except Exception as ex:
-            if curr_try == max_retry:
-                raise RemoveNodeFromPoolError("Maximum number of retries exceeded: {}".format(ex))
-            sys.stderr.write("Node delete failed: {}. Retrying in {} seconds.\n"
-                             .format(ex, retry_interval))
-            time.sleep(retry_interval)
-            return self.remove_node(node, curr_try=curr_try+1,
-                                    max_retry=max_retry,
-                                    retry_interval=retry_interval)
-
-        return True
+            return self.inventory.node(node) is None
+        except Exception:
+            return False
 
     @staticmethod
     def get_address(node_name):
@@ -181,63 +2034,1606 @@ class TsuruPool(object):
         return clean_up
 
 
-def pool_recycle(pool_name, dry_mode=False, max_retry=10, retry_interval=60):
-    pool_handler = TsuruPool(pool_name)
+class AsyncTsuruPool(TsuruPool):
+    """
+    TsuruPool whose methods are coroutines to be run on an EventLoop. Event
+    waits and retry sleeps yield to the loop instead of blocking a thread.
+    """
+
+    @coroutine
+    def get_nodes(self):
+        return super(AsyncTsuruPool, self).get_nodes()
+
+    @coroutine
+    def get_machines_templates(self):
+        return super(AsyncTsuruPool, self).get_machines_templates()
+
+    @coroutine
+    def disable_healing(self):
+        return super(AsyncTsuruPool, self).disable_healing()
+
+    def create_new_node(self, iaas_template, max_retry=10, retry_interval=60, templates=None,
+                        requested=None):
+        retry = self.retry("create", "Node creation", NewNodeError, max_retry, retry_interval)
+        while True:
+            started = time.time()
+            try:
+                future = self.notify_requested(self.start_create(iaas_template), requested)
+                try:
+                    event = yield self.wait_event(future)
+                except EventTimeoutError as error:
+                    yield self.abandon_creation(future)
+                    raise error
+                break
+            except Exception as ex:
+                if templates is not None:
+                    templates.record(iaas_template, time.time() - started, failed=True)
+                interval = retry.backoff(ex)
+                with self.stats.timer("sleep.retry"):
+                    yield Sleep(interval)
+                if templates is not None:
+                    iaas_template = templates.choose()
+        if templates is not None:
+            templates.record(iaas_template, time.time() - started)
+        yield self.wait_ready([event["Target"]["Value"]], started)
+        raise Return(event["Target"]["Value"])
+
+    def create_new_nodes(self, iaas_templates, max_retry=10, retry_interval=60, requested=None):
+        started = time.time()
+        futures = []
+        for idx, iaas_template in enumerate(iaas_templates):
+            retry = self.retry("create", "Node creation", NewNodeError, max_retry, retry_interval)
+            while True:
+                try:
+                    future = self.start_create(iaas_template, "Nodes create")
+                    futures.append(self.notify_requested(future, requested, idx))
+                    break
+                except Exception as ex:
+                    try:
+                        interval = retry.backoff(ex)
+                    except NewNodeError as error:
+                        yield self.abandon_creations(futures)
+                        raise error
+                    with self.stats.timer("sleep.retry"):
+                        yield Sleep(interval)
+        try:
+            events = yield self.wait_events(futures)
+        except Exception as ex:
+            yield self.abandon_creations(futures)
+            raise NewNodeError(ex)
+        yield self.wait_ready([event["Target"]["Value"] for event in events], started)
+        raise Return([event["Target"]["Value"] for event in events])
+
+    def wait_event(self, future):
+        event = yield future
+        raise Return(event)
+
+    def resume_creation(self, event_id):
+        future = self.event_tracker.watch_create("Node create", sending=True)
+        self.event_tracker.sent(future, event_id)
+        try:
+            event = yield self.wait_event(future)
+        except Exception as ex:
+            sys.stderr.write("Node creation {} failed: {}\n".format(event_id, ex))
+            raise Return(None)
+        address = self.created_node(event)
+        if address is None:
+            raise Return(None)
+        try:
+            yield self.wait_ready([address], self.event_started(event))
+        except NewNodeError:
+            raise Return(None)
+        raise Return(address)
+
+    def wait_ready(self, addresses, since):
+        futures = [self.readiness.watch(address, since) for address in addresses]
+        try:
+            nodes = yield self.wait_events(futures)
+        except Exception as ex:
+            yield self.wait_discarded(self.discard_nodes(addresses))
+            raise NewNodeError(ex)
+        raise Return(nodes)
+
+    def wait_discarded(self, futures):
+        try:
+            yield self.wait_events(futures)
+        except Exception as ex:
+            sys.stderr.write("Failed to remove new node(s): {}\n".format(ex))
+
+    def abandon_creations(self, futures):
+        addresses = []
+        for future in futures:
+            try:
+                event = yield future
+                addresses.append(event["Target"]["Value"])
+            except Exception:
+                pass
+        yield self.wait_discarded(self.discard_nodes(addresses))
+
+    def abandon_creation(self, future):
+        follow = self.follow_creation(future)
+        if follow is not None:
+            yield self.abandon_creations([follow])
+
+    def wait_events(self, futures):
+        errors = []
+        events = []
+        for future in futures:
+            try:
+                events.append((yield future))
+            except Exception as ex:
+                errors.append(str(ex))
+        if errors:
+            raise Exception("; ".join(errors))
+        raise Return(events)
+
+    def remove_node(self, node, max_retry=10, retry_interval=60):
+        retry = self.retry("delete", "Node delete", RemoveNodeFromPoolError, max_retry, retry_interval)
+        containers = yield self.admit_drain(node)
+        try:
+            while True:
+                try:
+                    yield self.wait_event(self.start_remove(node))
+                    break
+                except Exception as ex:
+                    if self.removed(node):
+                        break
+                    interval = retry.backoff(ex)
+                    with self.stats.timer("sleep.retry"):
+                        yield Sleep(interval)
+        finally:
+            self.release_drain(containers)
+        raise Return(True)
+
+    def admit_drain(self, node):
+        containers = self.drain_size(node)
+        if self.drain_budget is not None:
+            with self.stats.timer("wait.drain"):
+                yield self.drain_budget.admit(containers)
+        raise Return(containers)
+
+
+def parse_timestamp(value):
+    """
+    Returns the Unix time of an RFC 3339 timestamp, as sent by tsuru.
+    """
+    match = re.match(r"(\d{4})-(\d\d)-(\d\d)T(\d\d):(\d\d):(\d\d)(?:\.\d+)?"
+                     r"(Z|[+-]\d\d:?\d\d)?$", value)
+    if match is None:
+        raise ValueError('Invalid timestamp "{}"'.format(value))
+    seconds = calendar.timegm([int(field) for field in match.groups()[:6]] + [0, 0, 0])
+    offset = match.group(7)
+    if offset and offset != "Z":
+        sign = -1 if offset[0] == "-" else 1
+        offset = offset[1:].replace(":", "")
+        seconds -= sign * (int(offset[:2]) * 3600 + int(offset[2:]) * 60)
+    return seconds
+
+
+def node_status_cost(pool_handler, node):
+    """
+    Nodes not ready on tsuru are already unhealthy, recycle them first.
+    """
+    return 0 if pool_handler.get_node_info(node).get('Status') != 'ready' else 1
+
+
+def node_age_cost(pool_handler, node):
+    """
+    Nodes whose last successful heartbeat is older go first, nodes that never
+    had one before them.
+    """
+    info = pool_handler.get_node_info(node)
+    last_success = info.get('LastSuccess') or info.get('Metadata', {}).get('LastSuccess')
+    try:
+        return parse_timestamp(last_success)
+    except (TypeError, ValueError):
+        return 0
+
+
+def node_containers_cost(pool_handler, node):
+    """
+    Nodes running fewer containers are quicker to drain.
+    """
+    return len(pool_handler.get_node_containers(node))
+
+
+NODE_COSTS = collections.OrderedDict([("status", node_status_cost),
+                                      ("age", node_age_cost),
+                                      ("containers", node_containers_cost)])
+
+
+def order_nodes(pool_handler, nodes, costs, parallel=1):
+    """
+    Orders `nodes` by their cost, a tuple with the result of each of `costs`,
+    so cheaper nodes are recycled first. When recycling more than one node at
+    once, nodes sharing every cost but the last are dealt so each wave of
+    `parallel` nodes takes the most expensive one left along with the
+    cheapest ones, spreading expensive nodes across the run instead of
+    draining all of them at once at its end.
+    """
+    keys = dict((node, tuple(cost(pool_handler, node) for cost in costs)) for node in nodes)
+    ordered = sorted(nodes, key=keys.get)
+    if parallel <= 1:
+        return ordered
+    spread = []
+    for _, group in itertools.groupby(ordered, key=lambda node: keys[node][:-1]):
+        group = list(group)
+        low, high = 0, len(group) - 1
+        while low <= high:
+            for _ in range(parallel - 1):
+                if low <= high:
+                    spread.append(group[low])
+                    low += 1
+            if low <= high:
+                spread.append(group[high])
+                high -= 1
+    return spread
+
+
+def recycle_node(pool_handler, node, template, max_retry=10, retry_interval=60,
+                 journal=None, new_node=None, templates=None):
+    stats = pool_handler.stats
+    stats.start_node(pool_handler.pool, node)
+    if new_node is None:
+        requested = None
+        if journal is not None:
+            requested = lambda event_id: journal.record(pool_handler.pool, Journal.CREATING, node,
+                                                        event_id=event_id)
+        with stats.timer("node.create", pool_handler.pool, node):
+            new_node = pool_handler.create_new_node(template, max_retry=max_retry,
+                                                    retry_interval=retry_interval,
+                                                    templates=templates, requested=requested)
+        sys.stdout.write('Node {} successfully created.\n'.format(new_node))
+        stats.update_node(pool_handler.pool, node, new_node=new_node)
+        if journal is not None:
+            journal.record(pool_handler.pool, Journal.CREATED, node, new_node)
+    sys.stdout.write('Removing node "{}" from pool "{}"\n'
+                     .format(node, pool_handler.pool))
+    if journal is not None:
+        journal.record(pool_handler.pool, Journal.REMOVAL_STARTED, node)
+    with stats.timer("node.remove", pool_handler.pool, node):
+        pool_handler.remove_node(node, max_retry=max_retry,
+                                 retry_interval=retry_interval)
+    stats.finish_node(pool_handler.pool, node)
+    if journal is not None:
+        journal.record(pool_handler.pool, Journal.REMOVED, node)
+    return new_node
+
+
+class NodeBudget(object):
+    """
+    Limit of nodes being recycled at once, shared by the schedulers of every
+    pool in a run. A node takes a slot when its replacement starts being
+    created (or when its removal starts, if it was pre-provisioned) and gives
+    it back once it is removed. Schedulers waiting for a slot are notified
+    through their listeners, which are also called when the run is cancelled.
+    """
+
+    def __init__(self, limit=None):
+        self.limit = limit
+        self.in_use = 0
+        self.cancelled = False
+        self.lock = threading.Lock()
+        self.listeners = []
+
+    def acquire(self):
+        with self.lock:
+            if self.cancelled:
+                return False
+            if self.limit is not None and self.in_use >= self.limit:
+                return False
+            self.in_use += 1
+            return True
+
+    def release(self):
+        with self.lock:
+            self.in_use -= 1
+        self._notify()
+
+    def cancel(self):
+        with self.lock:
+            self.cancelled = True
+        self._notify()
+
+    def add_listener(self, fn):
+        with self.lock:
+            self.listeners.append(fn)
+
+    def remove_listener(self, fn):
+        with self.lock:
+            self.listeners.remove(fn)
+
+    def _notify(self):
+        # listeners take their scheduler lock, so never call them holding ours
+        with self.lock:
+            listeners = list(self.listeners)
+        for fn in listeners:
+            fn()
+
+
+class DrainBudget(object):
+    """
+    Limit of node drains, the containers tsuru moves off a node being
+    removed, running at once across every pool of a run: at most
+    `max_drains` nodes and, if set, at most `max_containers` containers in
+    motion. Drains are admitted in the order they asked for it. A node with
+    more containers than `max_containers` is only drained alone.
+    """
+
+    def __init__(self, max_drains=None, max_containers=None):
+        self.max_drains = max_drains
+        self.max_containers = max_containers
+        self.lock = threading.Lock()
+        self.waiting = collections.deque()
+        self.drains = 0
+        self.containers = 0
+
+    def admit(self, containers):
+        """
+        Returns a Future resolved once a drain of `containers` containers may
+        start. It must be released once the node is removed.
+        """
+        future = Future()
+        with self.lock:
+            self.waiting.append((future, containers))
+            admitted = self._admit()
+        for future_admitted in admitted:
+            future_admitted.set_result(True)
+        return future
+
+    def release(self, containers):
+        with self.lock:
+            self.drains -= 1
+            self.containers -= containers
+            admitted = self._admit()
+        for future in admitted:
+            future.set_result(True)
+
+    def _admit(self):
+        admitted = []
+        while self.waiting:
+            future, containers = self.waiting[0]
+            if self.max_drains is not None and self.drains >= self.max_drains:
+                break
+            if (self.max_containers is not None and self.drains and
+                    self.containers + containers > self.max_containers):
+                break
+            self.waiting.popleft()
+            self.drains += 1
+            self.containers += containers
+            admitted.append(future)
+        return admitted
+
+
+class RecycleScheduler(object):
+    """
+    Runs the recycle as two pipelined stages: replacements are created ahead
+    and an old node is only removed once a replacement for it exists, so the
+    pool never has less nodes than when the recycle started.
+
+    `parallel` bounds how many creations and how many removals run at once and
+    `create_ahead` how many extra nodes may be provisioned while old nodes are
+    still being removed. The number of nodes above the starting size (created
+    or being created) is never higher than `parallel + create_ahead`, not
+    counting jobs whose replacement was created beforehand (pre-provisioned
+    or resumed), for which only removals are run. When several pools are
+    recycled together, a shared NodeBudget also bounds the number of nodes in
+    flight across all of them. With a TemplateScheduler, the template of each
+    new node is chosen when its creation starts.
+    """
+
+    def __init__(self, pool_handler, parallel=1, create_ahead=0, max_retry=10,
+                 retry_interval=60, budget=None, journal=None, templates=None):
+        self.pool_handler = pool_handler
+        self.parallel = max(parallel, 1)
+        self.max_surge = self.parallel + max(create_ahead, 0)
+        self.max_retry = max_retry
+        self.retry_interval = retry_interval
+        self.cond = threading.Condition()
+        self.pending = collections.deque()
+        self.ready = collections.deque()
+        self.creating = 0
+        self.removing = 0
+        self.surge = 0
+        self.errors = []
+        self.budget = budget
+        self.admitted = set()
+        self.journal = journal
+        self.templates = templates
+        self.stats = pool_handler.stats
+
+    def run(self, jobs, created=()):
+        self._setup(jobs, created)
+        try:
+            with self.cond:
+                while not self._finished():
+                    if not self._dispatch():
+                        # wait with timeout so KeyboardInterrupt reaches the main thread
+                        self.cond.wait(1)
+        finally:
+            self._teardown()
+        if self.errors:
+            raise self.errors[0]
+
+    def _setup(self, jobs, created):
+        if self.budget is not None:
+            self.budget.add_listener(self._wake)
+        for job in jobs:
+            if job[0] in created:
+                self.ready.append(job)
+                self.surge += 1
+            else:
+                self.pending.append(job)
+        self.total = len(jobs)
+
+    def _record(self, state, node, new_node=None, event_id=None):
+        if self.journal is not None:
+            self.journal.record(self.pool_handler.pool, state, node, new_node, event_id=event_id)
+
+    def _creating(self, node):
+        if self.journal is None:
+            return None
+        return lambda event_id: self._record(Journal.CREATING, node, event_id=event_id)
+
+    def _finished(self):
+        in_flight = self.creating + self.removing
+        if self.errors:
+            return in_flight == 0
+        return in_flight == 0 and not self.pending and not self.ready
+
+    def _teardown(self):
+        if self.budget is not None:
+            self.budget.remove_listener(self._wake)
+
+    def _wake(self):
+        with self.cond:
+            self.cond.notify()
+
+    def _dispatch(self):
+        if self.budget is not None and self.budget.cancelled and not self.errors:
+            self.errors.append(Exception("Recycle interrupted"))
+        if self.errors:
+            return False
+        if self.ready and self.removing < self.parallel and self._admit(self.ready[0]):
+            self.removing += 1
+            self._start(self._remove, self.ready.popleft())
+            return True
+        if (self.pending and self.creating < self.parallel and
+                self.creating + self.surge < self.max_surge and
+                self._admit(self.pending[0])):
+            self.creating += 1
+            self._start(self._create, self.pending.popleft())
+            return True
+        return False
+
+    def _admit(self, job):
+        if self.budget is None or job[0] in self.admitted:
+            return True
+        if self.budget.acquire():
+            self.admitted.add(job[0])
+            return True
+        return False
+
+    def _release(self, job):
+        with self.cond:
+            if job[0] not in self.admitted:
+                return
+            self.admitted.remove(job[0])
+        self.budget.release()
+
+    def _start(self, target, job):
+        thread = threading.Thread(target=target, args=(job,))
+        thread.daemon = True
+        thread.start()
+
+    def _create(self, job):
+        idx, node, template = job
+        if self.templates is not None:
+            template = self.templates.choose()
+        sys.stdout.write('({}/{}) Creating new node on pool "{}" '
+                         'using "{}" template\n'
+                         .format(idx+1, self.total, self.pool_handler.pool, template))
+        self.stats.start_node(self.pool_handler.pool, node)
+        try:
+            with self.stats.timer("node.create", self.pool_handler.pool, node):
+                new_node = self.pool_handler.create_new_node(template, max_retry=self.max_retry,
+                                                             retry_interval=self.retry_interval,
+                                                             templates=self.templates,
+                                                             requested=self._creating(node))
+            sys.stdout.write('Node {} successfully created.\n'.format(new_node))
+            self.stats.update_node(self.pool_handler.pool, node, new_node=new_node)
+            self._record(Journal.CREATED, node, new_node)
+        except Exception as ex:
+            self._done(error=ex, creating=-1, release=job)
+            return
+        self._done(ready=job, creating=-1, surge=1)
+
+    def _remove(self, job):
+        idx, node, template = job
+        sys.stdout.write('Removing node "{}" from pool "{}"\n'
+                         .format(node, self.pool_handler.pool))
+        try:
+            self._record(Journal.REMOVAL_STARTED, node)
+            self.stats.start_node(self.pool_handler.pool, node)
+            with self.stats.timer("node.remove", self.pool_handler.pool, node):
+                self.pool_handler.remove_node(node, max_retry=self.max_retry,
+                                              retry_interval=self.retry_interval)
+            self.stats.finish_node(self.pool_handler.pool, node)
+            self._record(Journal.REMOVED, node)
+        except Exception as ex:
+            self._done(error=ex, removing=-1, release=job)
+            return
+        self._done(removing=-1, surge=-1, release=job)
+
+    def _done(self, error=None, ready=None, creating=0, removing=0, surge=0, release=None):
+        if release is not None:
+            self._release(release)
+        with self.cond:
+            if error is not None:
+                self.errors.append(error)
+            if ready is not None:
+                self.ready.append(ready)
+            self.creating += creating
+            self.removing += removing
+            self.surge += surge
+            self.cond.notify()
+
+
+class AsyncRecycleScheduler(RecycleScheduler):
+    """
+    RecycleScheduler running its creations and removals as coroutines on an
+    EventLoop instead of one thread each. `run` is a coroutine too.
+    """
+
+    def __init__(self, loop, pool_handler, **kwargs):
+        super(AsyncRecycleScheduler, self).__init__(pool_handler, **kwargs)
+        self.loop = loop
+        self.finished = Future()
+
+    def run(self, jobs, created=()):
+        self._setup(jobs, created)
+        self._schedule()
+        try:
+            yield self.finished
+        finally:
+            self._teardown()
+        if self.errors:
+            raise self.errors[0]
+
+    def _wake(self):
+        self.loop.call_soon(self._schedule)
+
+    def _schedule(self):
+        while self._dispatch():
+            pass
+        if self._finished() and not self.finished.done():
+            self.finished.set_result(None)
+
+    def _start(self, target, job):
+        self.loop.spawn(target(job))
+
+    def _create(self, job):
+        idx, node, template = job
+        if self.templates is not None:
+            template = self.templates.choose()
+        sys.stdout.write('({}/{}) Creating new node on pool "{}" '
+                         'using "{}" template\n'
+                         .format(idx+1, self.total, self.pool_handler.pool, template))
+        self.stats.start_node(self.pool_handler.pool, node)
+        try:
+            with self.stats.timer("node.create", self.pool_handler.pool, node):
+                new_node = yield self.pool_handler.create_new_node(template, max_retry=self.max_retry,
+                                                                   retry_interval=self.retry_interval,
+                                                                   templates=self.templates,
+                                                                   requested=self._creating(node))
+            sys.stdout.write('Node {} successfully created.\n'.format(new_node))
+            self.stats.update_node(self.pool_handler.pool, node, new_node=new_node)
+            self._record(Journal.CREATED, node, new_node)
+        except Exception as ex:
+            self._done(error=ex, creating=-1, release=job)
+            return
+        self._done(ready=job, creating=-1, surge=1)
+
+    def _remove(self, job):
+        idx, node, template = job
+        sys.stdout.write('Removing node "{}" from pool "{}"\n'
+                         .format(node, self.pool_handler.pool))
+        try:
+            self._record(Journal.REMOVAL_STARTED, node)
+            self.stats.start_node(self.pool_handler.pool, node)
+            with self.stats.timer("node.remove", self.pool_handler.pool, node):
+                yield self.pool_handler.remove_node(node, max_retry=self.max_retry,
+                                                    retry_interval=self.retry_interval)
+            self.stats.finish_node(self.pool_handler.pool, node)
+            self._record(Journal.REMOVED, node)
+        except Exception as ex:
+            self._done(error=ex, removing=-1, release=job)
+            return
+        self._done(removing=-1, surge=-1, release=job)
+
+    def _done(self, **kwargs):
+        super(AsyncRecycleScheduler, self)._done(**kwargs)
+        self._schedule()
+
+
+def pre_provision_nodes(pool_handler, jobs, max_retry=10, retry_interval=60, journal=None):
+    for idx, node, template in jobs:
+        sys.stdout.write('({}/{}) Creating new node on pool "{}" '
+                         'using "{}" template\n'
+                         .format(idx+1, len(jobs), pool_handler.pool, template))
+    started = time.time()
+    new_nodes = pool_handler.create_new_nodes([template for _, _, template in jobs],
+                                              max_retry=max_retry,
+                                              retry_interval=retry_interval,
+                                              requested=pre_provision_requested(pool_handler, jobs, journal))
+    pre_provisioned(pool_handler, jobs, new_nodes, started, journal)
+    return new_nodes
+
+
+def pre_provision_requested(pool_handler, jobs, journal=None):
+    """
+    Returns the callback journaling the creation events of pre-provisioned
+    nodes, by position in `jobs`.
+    """
+    if journal is None:
+        return None
+    return lambda idx, event_id: journal.record(pool_handler.pool, Journal.CREATING, jobs[idx][1],
+                                                event_id=event_id)
+
+
+def resume_creations(pool_handler, journal):
+    """
+    Resolves the node creations an interrupted run of the pool requested but
+    did not see finish, journaling the nodes they created as replacements.
+    """
+    for node, record in sorted(journal.replay(pool_handler.pool).items()):
+        if record["state"] == Journal.CREATING:
+            new_node = pool_handler.resume_creation(record["event_id"])
+            if new_node is not None:
+                journal.record(pool_handler.pool, Journal.CREATED, node, new_node)
+
+
+def resume_creations_async(pool_handler, journal):
+    for node, record in sorted(journal.replay(pool_handler.pool).items()):
+        if record["state"] == Journal.CREATING:
+            new_node = yield pool_handler.resume_creation(record["event_id"])
+            if new_node is not None:
+                journal.record(pool_handler.pool, Journal.CREATED, node, new_node)
+
+
+def pre_provisioned(pool_handler, jobs, new_nodes, started, journal=None):
+    """
+    Reports nodes created together, all of them taking the time of the batch.
+    """
+    pool_name = pool_handler.pool
+    for (idx, node, template), new_node in zip(jobs, new_nodes):
+        sys.stdout.write('Node {} successfully created.\n'.format(new_node))
+        pool_handler.stats.update_node(pool_name, node, started=started, new_node=new_node)
+        pool_handler.stats.add("node.create", time.time() - started, pool_name, node)
+        if journal is not None:
+            journal.record(pool_name, Journal.CREATED, node, new_node)
+
+
+DEFAULT_DURATIONS = {"create": 300, "delete": 300}
+
+
+class SimulatedPool(object):
+    """
+    Stand-in for an AsyncTsuruPool on a SimulatedEventLoop, whose nodes take
+    `create_duration` seconds to be created and `delete_duration` seconds to
+    be removed. It keeps track of the most nodes existing at once and of the
+    fewest nodes able to run containers: a node counts from the moment its
+    creation is requested until it is removed, and runs containers from the
+    end of its creation until its removal starts.
+    """
+
+    def __init__(self, pool, nodes, templates, create_duration, delete_duration):
+        self.pool = pool
+        self.nodes = list(nodes)
+        self.templates = list(templates)
+        self.create_duration = create_duration
+        self.delete_duration = delete_duration
+        self.stats = RunStats()
+        self.existing = self.capacity = len(self.nodes)
+        self.peak_nodes = self.min_capacity = len(self.nodes)
+        self.created = 0
+
+    @coroutine
+    def get_nodes(self):
+        return list(self.nodes)
+
+    @coroutine
+    def get_machines_templates(self):
+        return list(self.templates)
+
+    @coroutine
+    def disable_healing(self):
+        return lambda: None
+
+    def create_new_node(self, iaas_template, max_retry=10, retry_interval=60, templates=None,
+                        requested=None):
+        self.existing += 1
+        self.peak_nodes = max(self.peak_nodes, self.existing)
+        self.created += 1
+        new_node = "{}-new-{}".format(self.pool, self.created)
+        yield Sleep(self.create_duration)
+        self.capacity += 1
+        raise Return(new_node)
+
+    def create_new_nodes(self, iaas_templates, max_retry=10, retry_interval=60, requested=None):
+        new_nodes = yield [self.create_new_node(template) for template in iaas_templates]
+        raise Return(new_nodes)
+
+    def remove_node(self, node, max_retry=10, retry_interval=60):
+        self.capacity -= 1
+        self.min_capacity = min(self.min_capacity, self.capacity)
+        yield Sleep(self.delete_duration)
+        self.existing -= 1
+        raise Return(True)
+
+
+def simulate_recycle(pool_name, nodes, templates, create_duration, delete_duration,
+                     parallel=1, create_ahead=0, pre_provision=False):
+    """
+    Runs the recycle of `nodes` with the given settings on a simulated pool
+    and returns its predicted wall time, peak of extra nodes and minimum
+    capacity, as a dict.
+    """
+    loop = SimulatedEventLoop()
+    pool_handler = SimulatedPool(pool_name, nodes, templates, create_duration, delete_duration)
+    stdout = sys.stdout
+    sys.stdout = open(os.devnull, "w")
+    try:
+        loop.run_until_complete(recycle_async(loop, pool_handler, parallel=parallel,
+                                              create_ahead=create_ahead,
+                                              pre_provision=pre_provision))
+    finally:
+        sys.stdout.close()
+        sys.stdout = stdout
+    return {"parallel": parallel, "create_ahead": create_ahead, "pre_provision": pre_provision,
+            "wall_time": loop.now, "peak_extra_nodes": pool_handler.peak_nodes - len(nodes),
+            "min_capacity": pool_handler.min_capacity}
+
+
+def format_duration(seconds):
+    minutes, seconds = divmod(int(round(seconds)), 60)
+    hours, minutes = divmod(minutes, 60)
+    if hours:
+        return "{}h{:02d}m{:02d}s".format(hours, minutes, seconds)
+    if minutes:
+        return "{}m{:02d}s".format(minutes, seconds)
+    return "{}s".format(seconds)
+
+
+def history_durations(report_path):
+    """
+    Returns the mean node create and remove durations of the run recorded on
+    the report at `report_path`, None for the ones it has no sample of.
+    """
+    with open(report_path) as report_file:
+        phases = json.load(report_file).get("phases", {})
+    return tuple(phases[phase]["mean"] if phases.get(phase, {}).get("count") else None
+                 for phase in ("node.create", "node.remove"))
+
+
+def pools_simulate(patterns, regex=None, parallel=(1, 2, 4, 8), create_ahead=(0, 1, 2),
+                   create_duration=None, delete_duration=None, history_path=None):
+    """
+    Predicts, for every pool matching `patterns` or `regex`, how long the
+    recycle would take and how many nodes it would add and take away at
+    once, for every combination of the `parallel` and `create_ahead` values
+    with and without pre-provisioning. Nodes and templates are the real ones
+    of each pool. Durations are, in this order, the ones given, the means
+    of the run reported on `history_path` or DEFAULT_DURATIONS.
+    """
+    cluster = TsuruPool()
+    pool_names = select_pools(cluster.get_pools(), patterns, regex)
+    if pool_names == []:
+        raise Exception("No pool matches {}".format(", ".join((patterns or []) + filter(None, [regex]))))
+    history = history_durations(history_path) if history_path else (None, None)
+    if create_duration is None:
+        create_duration = history[0] or DEFAULT_DURATIONS["create"]
+    if delete_duration is None:
+        delete_duration = history[1] or DEFAULT_DURATIONS["delete"]
+    for pool_name in pool_names:
+        pool_handler = TsuruPool(pool_name, inventory=cluster.inventory, session=cluster.session)
+        nodes = pool_handler.get_nodes()
+        templates = pool_handler.get_machines_templates()
+        sys.stdout.write('Simulated recycle of {} node(s) from pool "{}", creating nodes in {} '
+                         'and removing them in {}:\n'
+                         .format(len(nodes), pool_name, format_duration(create_duration),
+                                 format_duration(delete_duration)))
+        if not nodes or not templates:
+            sys.stdout.write("Nothing to recycle.\n\n")
+            continue
+        sys.stdout.write("{:>8}  {:>12}  {:>13}  {:>11}  {:>16}  {:>12}\n"
+                         .format("parallel", "create-ahead", "pre-provision", "wall time",
+                                 "peak extra nodes", "min capacity"))
+        # create ahead makes no difference once every node is created upfront
+        settings = ([(concurrency, ahead, False) for ahead in create_ahead for concurrency in parallel] +
+                    [(concurrency, 0, True) for concurrency in parallel])
+        for concurrency, ahead, pre_provision in settings:
+            result = simulate_recycle(pool_name, nodes, templates, create_duration, delete_duration,
+                                      parallel=concurrency, create_ahead=ahead,
+                                      pre_provision=pre_provision)
+            sys.stdout.write("{:>8}  {:>12}  {:>13}  {:>11}  {:>16}  {:>12}\n"
+                             .format(concurrency, ahead, "yes" if pre_provision else "no",
+                                     format_duration(result["wall_time"]),
+                                     result["peak_extra_nodes"],
+                                     "{} ({:.0%})".format(result["min_capacity"],
+                                                          float(result["min_capacity"]) / len(nodes))))
+        sys.stdout.write("\n")
+
+
+def dry_run_recycle(pool_name, nodes_to_recycle, pool_templates):
+    recycle_len = len(nodes_to_recycle)
+    for idx, node in enumerate(nodes_to_recycle):
+        sys.stdout.write('({}/{}) Creating new node on pool "{}" '
+                         'using "{}" template\n'
+                         .format(idx+1, recycle_len,
+                                 pool_name, pool_templates[idx % len(pool_templates)]))
+        sys.stdout.write('Destroying node "{}\n'.format(node))
+        sys.stdout.write('\n')
+
+
+def plan_recycle(pool_name, nodes_to_recycle, pool_templates, journal=None, resume=False):
+    """
+    Returns the recycle jobs for `nodes_to_recycle`, as (index, node,
+    template) tuples, and the replacements already created for some of them
+    by a previous run, when resuming from `journal`.
+    """
+    replaced = {}
+    if journal is not None and resume:
+        total = len(nodes_to_recycle)
+        nodes_to_recycle, replaced = journal.resume(pool_name, nodes_to_recycle)
+        sys.stdout.write('Resuming recycle of pool "{}": {} node(s) already recycled, '
+                         '{} node(s) already replaced.\n'
+                         .format(pool_name, total - len(nodes_to_recycle), len(replaced)))
+    elif journal is not None:
+        journal.start(pool_name)
+    jobs = [(idx, node, pool_templates[idx % len(pool_templates)])
+            for idx, node in enumerate(nodes_to_recycle)]
+    return jobs, replaced
+
+
+def recycle(pool_handler, dry_mode=False, max_retry=10, retry_interval=60,
+            parallel=1, create_ahead=0, pre_provision=False, budget=None,
+            journal=None, resume=False, node_costs=None, template_min_share=None):
+    pool_name = pool_handler.pool
     pool_templates = pool_handler.get_machines_templates()
     if pool_templates == []:
         raise Exception('Pool "{}" does not contain any template associate'.format(pool_name))
-    templates_len = len(pool_templates)
-    template_idx = 0
+    if journal is not None and resume and not dry_mode:
+        resume_creations(pool_handler, journal)
     nodes_to_recycle = pool_handler.get_nodes()
-    recycle_len = len(nodes_to_recycle)
+    if node_costs:
+        nodes_to_recycle = order_nodes(pool_handler, nodes_to_recycle, node_costs, parallel)
     sys.stdout.write('Going to recycle {} node(s) from pool "{}" using {} templates.\n'
-                     .format(recycle_len, pool_name, len(pool_templates)))
+                     .format(len(nodes_to_recycle), pool_name, len(pool_templates)))
     enable_healing = pool_handler.disable_healing()
-    new_node = None
-    for idx, node in enumerate(nodes_to_recycle):
-        sys.stdout.write('({}/{}) Creating new node on pool "{}" '
-                         'using "{}" template\n'
-                         .format(idx+1, recycle_len,
-                                 pool_name, pool_templates[template_idx]))
 
-        if dry_mode:
-            sys.stdout.write('Destroying node "{}\n'.format(node))
-            template_idx = (template_idx + 1) % templates_len
-            sys.stdout.write('\n')
-            continue
+    if dry_mode:
+        dry_run_recycle(pool_name, nodes_to_recycle, pool_templates)
+        enable_healing()
+        sys.stdout.write('Done.\n')
+        return
 
-        try:
-            new_node = pool_handler.create_new_node(pool_templates[template_idx],
-                                                    retry_interval=retry_interval)
-            sys.stdout.write('Node {} successfully created.\n'.format(new_node))
-            sys.stdout.write('Removing node "{}" from pool "{}"\n'
-                             .format(node, pool_name))
-            pool_handler.remove_node(node, max_retry=max_retry,
-                                     retry_interval=retry_interval)
-            template_idx = (template_idx + 1) % templates_len
-            new_node = None
-        except (Exception, KeyboardInterrupt), e:
-            sys.stderr.write("Failed: {}\n".format(e))
-            enable_healing()
-            sys.exit(1)
+    templates = TemplateScheduler(pool_templates, min_share=template_min_share,
+                                  retry_interval=retry_interval)
+    try:
+        jobs, replaced = plan_recycle(pool_name, nodes_to_recycle, pool_templates,
+                                      journal=journal, resume=resume)
+        pool_handler.stats.plan(pool_name, len(jobs))
+        scheduler = RecycleScheduler(pool_handler, parallel=parallel,
+                                     create_ahead=create_ahead, max_retry=max_retry,
+                                     retry_interval=retry_interval, budget=budget,
+                                     journal=journal, templates=templates)
+        if pre_provision:
+            pre_provision_nodes(pool_handler, [(idx, node, templates.choose())
+                                               for idx, node, _ in jobs if node not in replaced],
+                                max_retry=max_retry, retry_interval=retry_interval,
+                                journal=journal)
+            replaced = dict((node, None) for _, node, _ in jobs)
+        scheduler.run(jobs, created=set(idx for idx, node, _ in jobs if node in replaced))
+    except (Exception, KeyboardInterrupt), e:
+        sys.stderr.write("Failed: {}\n".format(e))
+        if journal is not None:
+            sys.stderr.write('Progress saved to "{}", run again with --resume to continue.\n'
+                             .format(journal.path))
+        enable_healing()
+        raise PoolRecycleError(pool_name)
+
+    if journal is not None:
+        journal.finish(pool_name)
+    enable_healing()
+    sys.stdout.write('Done.\n')
+
+
+def recycle_async(loop, pool_handler, dry_mode=False, max_retry=10, retry_interval=60,
+                  parallel=1, create_ahead=0, pre_provision=False, budget=None,
+                  journal=None, resume=False, node_costs=None, template_min_share=None):
+    """
+    Coroutine version of recycle, running every node operation of an
+    AsyncTsuruPool on `loop`.
+    """
+    pool_name = pool_handler.pool
+    pool_templates = yield pool_handler.get_machines_templates()
+    if pool_templates == []:
+        raise Exception('Pool "{}" does not contain any template associate'.format(pool_name))
+    if journal is not None and resume and not dry_mode:
+        yield resume_creations_async(pool_handler, journal)
+    nodes_to_recycle = yield pool_handler.get_nodes()
+    if node_costs:
+        nodes_to_recycle = order_nodes(pool_handler, nodes_to_recycle, node_costs, parallel)
+    sys.stdout.write('Going to recycle {} node(s) from pool "{}" using {} templates.\n'
+                     .format(len(nodes_to_recycle), pool_name, len(pool_templates)))
+    enable_healing = yield pool_handler.disable_healing()
+
+    if dry_mode:
+        dry_run_recycle(pool_name, nodes_to_recycle, pool_templates)
+        enable_healing()
+        sys.stdout.write('Done.\n')
+        return
 
+    templates = TemplateScheduler(pool_templates, min_share=template_min_share,
+                                  retry_interval=retry_interval)
+    scheduler = AsyncRecycleScheduler(loop, pool_handler, parallel=parallel,
+                                      create_ahead=create_ahead, max_retry=max_retry,
+                                      retry_interval=retry_interval, budget=budget,
+                                      journal=journal, templates=templates)
+    try:
+        jobs, replaced = plan_recycle(pool_name, nodes_to_recycle, pool_templates,
+                                      journal=journal, resume=resume)
+        pool_handler.stats.plan(pool_name, len(jobs))
+        if pre_provision:
+            to_create = [(idx, node, templates.choose())
+                         for idx, node, _ in jobs if node not in replaced]
+            for idx, node, template in to_create:
+                sys.stdout.write('({}/{}) Creating new node on pool "{}" '
+                                 'using "{}" template\n'
+                                 .format(idx+1, len(jobs), pool_name, template))
+            started = time.time()
+            new_nodes = yield pool_handler.create_new_nodes(
+                [template for _, _, template in to_create], max_retry=max_retry,
+                retry_interval=retry_interval,
+                requested=pre_provision_requested(pool_handler, to_create, journal))
+            pre_provisioned(pool_handler, to_create, new_nodes, started, journal)
+            replaced = dict((node, None) for _, node, _ in jobs)
+        yield scheduler.run(jobs, created=set(idx for idx, node, _ in jobs if node in replaced))
+    except (Exception, KeyboardInterrupt), e:
+        sys.stderr.write("Failed: {}\n".format(e))
+        if journal is not None:
+            sys.stderr.write('Progress saved to "{}", run again with --resume to continue.\n'
+                             .format(journal.path))
+        enable_healing()
+        raise PoolRecycleError(pool_name)
+    if journal is not None:
+        journal.finish(pool_name)
     enable_healing()
     sys.stdout.write('Done.\n')
 
 
+def pool_recycle(pool_name, dry_mode=False, max_retry=10, retry_interval=60,
+                 parallel=1, create_ahead=0, pre_provision=False, wait_timeout=None,
+                 async_engine=False, journal_path=None, resume=False, order_by=None,
+                 template_min_share=None, report_path=None, metrics_port=None,
+                 metrics_textfile=None, max_connections=10, rate_limits=None,
+                 breaker_threshold=0.5, retry_budgets=None, max_drains=None,
+                 max_moving_containers=None, max_in_flight=None):
+    stats = RunStats()
+    exporter = None
+    if metrics_port is not None or metrics_textfile is not None:
+        exporter = MetricsExporter(stats, port=metrics_port, textfile=metrics_textfile).start()
+    options = {"dry_mode": dry_mode, "max_retry": max_retry, "retry_interval": retry_interval,
+               "parallel": parallel, "create_ahead": create_ahead,
+               "pre_provision": pre_provision, "budget": NodeBudget(max_in_flight),
+               "journal": Journal(journal_path) if journal_path else None, "resume": resume,
+               "node_costs": [NODE_COSTS[name] for name in order_by or []],
+               "template_min_share": template_min_share}
+    session = TsuruSession(max_connections, RateLimiter(rate_limits),
+                           CircuitBreaker(breaker_threshold, stats=stats), stats)
+    pool_options = {"polling_policy": PollingPolicy(deadline=wait_timeout), "stats": stats,
+                    "session": session, "retry_budgets": retry_budgets,
+                    "drain_budget": make_drain_budget(max_drains, max_moving_containers)}
+    try:
+        if async_engine:
+            loop = EventLoop()
+            loop.run_until_complete(pool_recycle_async(loop, pool_name, pool_options, options))
+        else:
+            pool_handler = TsuruPool(pool_name, **pool_options)
+            recycle(pool_handler, **options)
+    except PoolRecycleError:
+        sys.exit(1)
+    finally:
+        if exporter is not None:
+            exporter.stop()
+        if report_path:
+            stats.write_report(report_path)
+
+
+def pool_recycle_async(loop, pool_name, pool_options, options):
+    pool_handler = AsyncTsuruPool(pool_name, **pool_options)
+    task = loop.spawn(recycle_async(loop, pool_handler, **options))
+    while not task.done():
+        try:
+            yield task
+        except KeyboardInterrupt:
+            sys.stderr.write("Interrupted, waiting for node operations in flight.\n")
+            options["budget"].cancel()
+    raise Return(task.result())
+
+
+def make_drain_budget(max_drains=None, max_moving_containers=None):
+    if max_drains is None and max_moving_containers is None:
+        return None
+    return DrainBudget(max_drains, max_moving_containers)
+
+
+def select_pools(pool_names, patterns=None, regex=None):
+    """
+    Returns the names in `pool_names` matching any of the glob `patterns` or
+    the regular expression `regex`.
+    """
+    selected = []
+    for name in sorted(pool_names):
+        if any(fnmatch.fnmatchcase(name, pattern) for pattern in patterns or []):
+            selected.append(name)
+        elif regex is not None and re.search(regex, name):
+            selected.append(name)
+    return selected
+
+
+def pools_recycle(patterns, regex=None, dry_mode=False, max_retry=10, retry_interval=60,
+                  parallel=1, create_ahead=0, pre_provision=False, wait_timeout=None,
+                  async_engine=False, max_in_flight=None, journal_path=None, resume=False,
+                  order_by=None, template_min_share=None, report_path=None,
+                  metrics_port=None, metrics_textfile=None, max_connections=10,
+                  rate_limits=None, breaker_threshold=0.5, retry_budgets=None, max_drains=None,
+                  max_moving_containers=None):
+    """
+    Recycles every pool matching `patterns` or `regex` concurrently. Each pool
+    recycles at most `parallel` nodes at once and `max_in_flight` bounds the
+    nodes being recycled across all pools. Healing is disabled and restored
+    per pool. Every pool records its progress in the same journal, when
+    `journal_path` is given, and a single report of the run is written to
+    `report_path`. Progress is published as metrics on `metrics_port` or
+    `metrics_textfile`. Every pool shares a single event poller, at most
+    `max_connections` keep-alive connections to tsuru, the `rate_limits` of
+    each endpoint and a circuit breaker pausing every call when the ratio of
+    failed calls reaches `breaker_threshold`. Node creations and removals give up retrying after
+    the seconds of their `retry_budgets`. At most `max_drains` nodes, holding
+    at most `max_moving_containers` containers, are drained at once across
+    all pools. Exits with an error if any pool fails.
+    """
+    stats = RunStats()
+    session = TsuruSession(max_connections, RateLimiter(rate_limits),
+                           CircuitBreaker(breaker_threshold, stats=stats), stats)
+    polling_policy = PollingPolicy(deadline=wait_timeout)
+    cluster = TsuruPool(polling_policy=polling_policy, stats=stats, session=session)
+    pool_names = select_pools(cluster.get_pools(), patterns, regex)
+    if pool_names == []:
+        raise Exception("No pool matches {}".format(", ".join((patterns or []) + filter(None, [regex]))))
+    sys.stdout.write('Going to recycle {} pool(s): {}.\n'.format(len(pool_names), ", ".join(pool_names)))
+    budget = NodeBudget(max_in_flight)
+    options = {"dry_mode": dry_mode, "max_retry": max_retry, "retry_interval": retry_interval,
+               "parallel": parallel, "create_ahead": create_ahead,
+               "pre_provision": pre_provision, "budget": budget,
+               "journal": Journal(journal_path) if journal_path else None, "resume": resume,
+               "node_costs": [NODE_COSTS[name] for name in order_by or []],
+               "template_min_share": template_min_share}
+    pool_options = {"polling_policy": polling_policy,
+                    "inventory": cluster.inventory, "stats": cluster.stats,
+                    "session": cluster.session,
+                    "readiness": ReadinessWatcher(cluster.inventory, polling_policy, stats=cluster.stats),
+                    "retry_budgets": retry_budgets,
+                    "drain_budget": make_drain_budget(max_drains, max_moving_containers)}
+    if not dry_mode:
+        # a single event poller for every pool, dry runs never wait on events
+        pool_options["event_tracker"] = cluster.event_tracker
+    exporter = None
+    if metrics_port is not None or metrics_textfile is not None:
+        exporter = MetricsExporter(cluster.stats, port=metrics_port, textfile=metrics_textfile).start()
+    try:
+        if async_engine:
+            loop = EventLoop()
+            failed = loop.run_until_complete(
+                pools_recycle_async(loop, pool_names, budget, pool_options, options))
+        else:
+            failed = pools_recycle_threads(pool_names, budget, pool_options, options)
+    finally:
+        if exporter is not None:
+            exporter.stop()
+        if report_path:
+            cluster.stats.write_report(report_path)
+    if failed:
+        sys.stderr.write("Failed to recycle pool(s): {}\n".format(", ".join(failed)))
+        sys.exit(1)
+    sys.stdout.write('All pools done.\n')
+
+
+def pools_recycle_threads(pool_names, budget, pool_options, options):
+    failed = []
+
+    def run(pool_name):
+        try:
+            pool_handler = TsuruPool(pool_name, **pool_options)
+            recycle(pool_handler, **options)
+        except Exception as ex:
+            sys.stderr.write('Pool "{}" failed: {}\n'.format(pool_name, ex))
+            failed.append(pool_name)
+
+    threads = []
+    for pool_name in pool_names:
+        thread = threading.Thread(target=run, args=(pool_name,))
+        thread.daemon = True
+        thread.start()
+        threads.append(thread)
+    for thread in threads:
+        while thread.is_alive():
+            try:
+                # join with timeout so KeyboardInterrupt reaches the main thread
+                thread.join(1)
+            except KeyboardInterrupt:
+                sys.stderr.write("Interrupted, waiting for node operations in flight.\n")
+                budget.cancel()
+    return sorted(failed)
+
+
+def pools_recycle_async(loop, pool_names, budget, pool_options, options):
+    failed = []
+
+    def run(pool_name):
+        try:
+            pool_handler = AsyncTsuruPool(pool_name, **pool_options)
+            yield recycle_async(loop, pool_handler, **options)
+        except Exception as ex:
+            sys.stderr.write('Pool "{}" failed: {}\n'.format(pool_name, ex))
+            failed.append(pool_name)
+
+    tasks = [loop.spawn(run(pool_name)) for pool_name in pool_names]
+    for task in tasks:
+        while not task.done():
+            try:
+                yield task
+            except KeyboardInterrupt:
+                sys.stderr.write("Interrupted, waiting for node operations in flight.\n")
+                budget.cancel()
+    raise Return(sorted(failed))
+
+
+class NodeAges(object):
+    """
+    Ages of nodes, from the start of their node.create event on tsuru, looked
+    up with events.list queries of `limit` events, newest first. Nodes whose
+    creation is not among the events listed were created before all of them:
+    their age is unknown, but at least that of the oldest event listed.
+    """
+
+    def __init__(self, client, limit=1000, stats=None):
+        self.client = client
+        self.limit = limit
+        if stats is None:
+            stats = RunStats()
+        self.stats = stats
+        self.created = {}
+        self.oldest = None
+        self.complete = False
+
+    def refresh(self, addresses=(), max_age=None):
+        """
+        Lists the latest node.create events. While any node of `addresses` is
+        missing from them, it pages back with `skip` until the oldest event
+        listed started over `max_age` seconds ago, so the missing nodes are
+        known to be older than that.
+        """
+        self.oldest = None
+        self.complete = False
+        skip = 0
+        while True:
+            params = {"kindname": "node.create", "limit": self.limit}
+            if skip:
+                params["skip"] = skip
+            with self.stats.timer("api.events.list"):
+                events = self.client.events.list(**params)
+            for event in events:
+                try:
+                    created = parse_timestamp(event.get("StartTime") or "")
+                except ValueError:
+                    continue
+                self.oldest = created if self.oldest is None else min(self.oldest, created)
+                if not event["Error"]:
+                    self.created.setdefault(TsuruPool.get_address(event["Target"]["Value"]), created)
+            if len(events) < self.limit:
+                self.complete = True
+                return
+            if max_age is None or self.older_than(max_age) or \
+                    all(self.age(address) is not None for address in addresses):
+                return
+            skip += len(events)
+
+    def older_than(self, max_age):
+        """
+        Tells whether the nodes missing from the events listed are known to be
+        older than `max_age` seconds: they were created before all the events
+        tsuru keeps, or before one that started over `max_age` seconds ago.
+        """
+        return self.complete or (self.oldest is not None and time.time() - self.oldest >= max_age)
+
+    def age(self, address):
+        """
+        Returns the age, in seconds, of the node at `address`, or None if it
+        is unknown.
+        """
+        created = self.created.get(TsuruPool.get_address(address))
+        if created is None:
+            return None
+        return time.time() - created
+
+
+class RecycleDaemon(object):
+    """
+    Keeps recycling the nodes of the pools matching `patterns` or `regex`
+    that are older than `max_age` seconds, oldest first, so nodes are renewed
+    at a steady pace instead of all at once. Nodes of unknown age, created
+    before the events listed, are due first once those events go back
+    `max_age` seconds, and are left alone otherwise.
+    Recycles start at most `rate` times per hour and at most `parallel` run
+    at once. Pools and nodes are looked up again every `scan_interval`
+    seconds when no node is due.
+
+    Every pool shares the client, tsuru connections and inventory of
+    `cluster`, and each pool gets a single TsuruPool, built from
+    `pool_options`, for the whole run. Healing of a pool is disabled while
+    any of its nodes is being recycled. A node whose recycle failed is only
+    tried again after `FAILED_DELAY` seconds.
+    """
+
+    FAILED_DELAY = 3600
+
+    def __init__(self, cluster, patterns=None, regex=None, max_age=30 * 86400, rate=1, parallel=1,
+                 scan_interval=60, max_retry=10, retry_interval=60, pool_options=None):
+        self.cluster = cluster
+        self.patterns = patterns
+        self.regex = regex
+        self.max_age = max_age
+        self.spacing = 3600.0 / rate
+        self.parallel = max(parallel, 1)
+        self.scan_interval = scan_interval
+        self.max_retry = max_retry
+        self.retry_interval = retry_interval
+        self.pool_options = pool_options or {}
+        self.ages = NodeAges(cluster.client, stats=cluster.stats)
+        self.cond = threading.Condition()
+        self.stopped = False
+        self.running = {}
+        self.failed = {}
+        self.handlers = {}
+        self.templates = {}
+        self.healing = {}
+
+    def due_nodes(self):
+        """
+        Returns the (pool, node) pairs due for a recycle, oldest node first.
+        """
+        self.cluster.inventory.invalidate_nodes()
+        pools = select_pools(self.cluster.get_pools(), self.patterns, self.regex)
+        nodes = [(pool, node['Address']) for pool in pools
+                 for node in self.cluster.inventory.nodes(pool)]
+        self.ages.refresh([address for _, address in nodes], self.max_age)
+        now = time.time()
+        with self.cond:
+            nodes = [(pool, address) for pool, address in nodes
+                     if address not in self.running and
+                     now - self.failed.get(address, 0) >= self.FAILED_DELAY]
+        due = []
+        for pool, address in nodes:
+            age = self.ages.age(address)
+            if age is None and self.ages.older_than(self.max_age) or \
+                    age is not None and age >= self.max_age:
+                due.append((age is None, age, pool, address))
+        return [(pool, address) for _, _, pool, address in sorted(due, reverse=True)]
+
+    def run(self, max_recycles=None):
+        """
+        Recycles nodes until stopped, or until `max_recycles` recycles were
+        started and finished.
+        """
+        started = 0
+        next_start = time.time()
+        while max_recycles is None or started < max_recycles:
+            with self.cond:
+                while not self.stopped and (len(self.running) >= self.parallel or
+                                            time.time() < next_start):
+                    delay = next_start - time.time()
+                    self.cond.wait(min(1, delay) if delay > 0 else 1)
+                if self.stopped:
+                    break
+            try:
+                due = self.due_nodes()
+            except Exception as ex:
+                sys.stderr.write("Failed to look up nodes: {}.\n".format(ex))
+                due = []
+            if not due:
+                self.sleep(self.scan_interval)
+                continue
+            pool, node = due[0]
+            self.start(pool, node)
+            started += 1
+            next_start = time.time() + self.spacing
+        self.wait()
+
+    def sleep(self, seconds):
+        with self.cond:
+            deadline = time.time() + seconds
+            while not self.stopped and time.time() < deadline:
+                self.cond.wait(min(1, deadline - time.time()))
+
+    def stop(self):
+        with self.cond:
+            self.stopped = True
+            self.cond.notify_all()
+
+    def wait(self):
+        with self.cond:
+            threads = list(self.running.values())
+        for thread in threads:
+            while thread.is_alive():
+                thread.join(1)
+
+    def start(self, pool, node):
+        age = self.ages.age(node)
+        if age is not None:
+            created = "{} ago".format(format_duration(age))
+        elif self.ages.complete:
+            created = "before the events tsuru keeps"
+        else:
+            created = "over {} ago".format(format_duration(time.time() - self.ages.oldest))
+        sys.stdout.write('Recycling node "{}" from pool "{}", created {}.\n'.format(node, pool, created))
+        thread = threading.Thread(target=self.recycle, args=(pool, node))
+        thread.daemon = True
+        with self.cond:
+            self.running[node] = thread
+        thread.start()
+
+    def recycle(self, pool, node):
+        try:
+            pool_handler = self.pool_handler(pool)
+            self.disable_healing(pool_handler)
+            try:
+                templates = self.templates[pool]
+                template = templates.choose()
+                sys.stdout.write('Creating new node on pool "{}" using "{}" template\n'
+                                 .format(pool, template))
+                recycle_node(pool_handler, node, template, max_retry=self.max_retry,
+                             retry_interval=self.retry_interval, templates=templates)
+            finally:
+                self.enable_healing(pool_handler)
+        except Exception as ex:
+            sys.stderr.write('Failed to recycle node "{}" from pool "{}": {}\n'.format(node, pool, ex))
+            with self.cond:
+                self.failed[node] = time.time()
+        finally:
+            with self.cond:
+                del self.running[node]
+                self.cond.notify_all()
+
+    def pool_handler(self, pool):
+        with self.cond:
+            if pool not in self.handlers:
+                pool_handler = TsuruPool(pool, **self.pool_options)
+                pool_templates = pool_handler.get_machines_templates()
+                if pool_templates == []:
+                    raise Exception('Pool "{}" does not contain any template associate'.format(pool))
+                self.templates[pool] = TemplateScheduler(pool_templates,
+                                                         retry_interval=self.retry_interval)
+                self.handlers[pool] = pool_handler
+            return self.handlers[pool]
+
+    def disable_healing(self, pool_handler):
+        with self.cond:
+            count, enable_healing = self.healing.get(pool_handler.pool, (0, None))
+            if count == 0:
+                enable_healing = pool_handler.disable_healing()
+            self.healing[pool_handler.pool] = (count + 1, enable_healing)
+
+    def enable_healing(self, pool_handler):
+        with self.cond:
+            count, enable_healing = self.healing[pool_handler.pool]
+            self.healing[pool_handler.pool] = (count - 1, enable_healing)
+            if count == 1:
+                enable_healing()
+
+
+def pools_daemon(patterns, regex=None, max_age=30 * 86400, rate=1, parallel=1, scan_interval=60,
+                 max_retry=10, retry_interval=60, wait_timeout=None, metrics_port=None,
+                 metrics_textfile=None, max_connections=10, rate_limits=None, breaker_threshold=0.5,
+                 retry_budgets=None, max_drains=None, max_moving_containers=None):
+    """
+    Runs a RecycleDaemon on the pools matching `patterns` or `regex` until
+    interrupted, then waits for the node recycles in flight.
+    """
+    stats = RunStats()
+    session = TsuruSession(max_connections, RateLimiter(rate_limits),
+                           CircuitBreaker(breaker_threshold, stats=stats), stats)
+    polling_policy = PollingPolicy(deadline=wait_timeout)
+    cluster = TsuruPool(polling_policy=polling_policy, stats=stats, session=session)
+    pool_options = {"polling_policy": polling_policy,
+                    "inventory": cluster.inventory, "stats": cluster.stats,
+                    "session": cluster.session,
+                    "readiness": ReadinessWatcher(cluster.inventory, polling_policy, stats=cluster.stats),
+                    "retry_budgets": retry_budgets,
+                    "drain_budget": make_drain_budget(max_drains, max_moving_containers),
+                    "event_tracker": cluster.event_tracker}
+    daemon = RecycleDaemon(cluster, patterns, regex, max_age=max_age, rate=rate, parallel=parallel,
+                           scan_interval=scan_interval, max_retry=max_retry,
+                           retry_interval=retry_interval, pool_options=pool_options)
+    exporter = None
+    if metrics_port is not None or metrics_textfile is not None:
+        exporter = MetricsExporter(cluster.stats, port=metrics_port, textfile=metrics_textfile).start()
+    sys.stdout.write("Recycling nodes older than {}, {} node(s) per hour.\n"
+                     .format(format_duration(max_age), rate))
+    thread = threading.Thread(target=daemon.run)
+    thread.daemon = True
+    thread.start()
+    try:
+        while thread.is_alive():
+            try:
+                # join with timeout so KeyboardInterrupt reaches the main thread
+                thread.join(1)
+            except KeyboardInterrupt:
+                sys.stderr.write("Interrupted, waiting for node recycles in flight.\n")
+                daemon.stop()
+    finally:
+        if exporter is not None:
+            exporter.stop()
+
+
 def pool_recycle_parser(args):
     parser = argparse.ArgumentParser(description="Tsuru pool nodes recycle")
-    parser.add_argument("-p", "--pool", required=True,
-                        help="Tsuru pool")
+    parser.add_argument("-p", "--pool", required=False, action='append',
+                        help="Tsuru pool, may be a glob pattern and be used more than once")
+    parser.add_argument("--pool-regex", required=False, default=None,
+                        help="Recycle every pool whose name matches this regular expression")
     parser.add_argument("-d", "--dry-run", required=False, action='store_true',
                         help="Dry run all recycle actions")
     parser.add_argument("-m", "--max_retry", required=False, default=10, type=int,
                         help="Max retries attempts to move a node on failure")
     parser.add_argument("-i", "--retry-interval", required=False, default=60, type=int,
-                        help="Time, in seconds, between retry attempts.")
+                        help="Maximum time, in seconds, between retry attempts.")
+    parser.add_argument("--parallel", required=False, default=1, type=int,
+                        help="Number of nodes recycled concurrently on each pool")
+    parser.add_argument("--max-in-flight", required=False, default=None, type=int,
+                        help="Number of nodes recycled concurrently across all pools")
+    parser.add_argument("--create-ahead", required=False, default=0, type=int,
+                        help="Number of extra nodes that may be created while old "
+                             "nodes are still being removed")
+    parser.add_argument("--pre_provision", required=False, action='store_true',
+                        help="Pre-provision all nodes on IaaS before start moving")
+    parser.add_argument("--wait-timeout", required=False, default=None, type=int,
+                        help="Max time, in seconds, to wait for a node event to finish "
+                             "or for a new node to be ready")
+    parser.add_argument("--async", required=False, action='store_true', dest='async_engine',
+                        help="Run node operations as coroutines on a single thread")
+    parser.add_argument("--journal", required=False, default=None,
+                        help="File where the progress of the recycle is recorded")
+    parser.add_argument("--resume", required=False, action='store_true',
+                        help="Resume an interrupted recycle from its journal")
+    parser.add_argument("--order-by", required=False, default=None,
+                        help="Comma separated costs used to choose which nodes are recycled "
+                             "first, among: {}".format(", ".join(NODE_COSTS)))
+    parser.add_argument("--template-min-share", required=False, default=None, type=float,
+                        help="Minimum fraction of the new nodes created on each template, "
+                             "half an even split by default")
+    parser.add_argument("--report", required=False, default=None,
+                        help="File where a JSON report with the timings of the run is written")
+    parser.add_argument("--metrics-port", required=False, default=None, type=int,
+                        help="Serve Prometheus metrics of the run on this port")
+    parser.add_argument("--metrics-textfile", required=False, default=None,
+                        help="Write Prometheus metrics of the run to this node_exporter textfile")
+    parser.add_argument("--max-connections", required=False, default=10, type=int,
+                        help="Max keep-alive connections to the tsuru API shared by all pools")
+    parser.add_argument("--rate-limit", required=False, default=None,
+                        help="Comma separated max calls per second to the tsuru API, as "
+                             "create=0.5,events=5, for: {}".format(", ".join(RateLimiter.ENDPOINTS)))
+    parser.add_argument("--breaker-threshold", required=False, default=0.5, type=float,
+                        help="Ratio of failed tsuru API calls that pauses every call for a while")
+    parser.add_argument("--retry-budget", required=False, default=None,
+                        help="Comma separated max time, in seconds, spent retrying a node operation, "
+                             "as create=1800,delete=600")
+    parser.add_argument("--max-drains", required=False, default=None, type=int,
+                        help="Max nodes having their containers moved at once across all pools")
+    parser.add_argument("--max-moving-containers", required=False, default=None, type=int,
+                        help="Max containers being moved at once across all pools")
+    parser.add_argument("--daemon", required=False, action='store_true',
+                        help="Keep running, recycling nodes older than --max-age at a steady --rate")
+    parser.add_argument("--max-age", required=False, default=720, type=float,
+                        help="Age, in hours, from which the daemon recycles a node")
+    parser.add_argument("--rate", required=False, default=1, type=float,
+                        help="Max nodes per hour the daemon starts recycling")
+    parser.add_argument("--scan-interval", required=False, default=60, type=int,
+                        help="Time, in seconds, between daemon lookups for old nodes")
+    parser.add_argument("--plan", required=False, action='store_true',
+                        help="Simulate the recycle with several settings and predict its duration "
+                             "and capacity, instead of recycling")
+    parser.add_argument("--plan-parallel", required=False, default="1,2,4,8",
+                        help="Comma separated --parallel values to simulate")
+    parser.add_argument("--plan-create-ahead", required=False, default="0,1,2",
+                        help="Comma separated --create-ahead values to simulate")
+    parser.add_argument("--plan-history", required=False, default=None,
+                        help="Report of a previous run whose node create and remove durations "
+                             "are simulated")
+    parser.add_argument("--create-duration", required=False, default=None, type=float,
+                        help="Time, in seconds, to create a node in the simulation")
+    parser.add_argument("--delete-duration", required=False, default=None, type=float,
+                        help="Time, in seconds, to remove a node in the simulation")
     parsed = parser.parse_args(args)
-    pool_recycle(parsed.pool, parsed.dry_run, parsed.max_retry,
-                 parsed.retry_interval)
+    if not parsed.pool and parsed.pool_regex is None:
+        parser.error("at least one of -p/--pool or --pool-regex is required")
+    if parsed.resume and parsed.journal is None:
+        parser.error("--resume requires --journal")
+    order_by = parsed.order_by.split(",") if parsed.order_by else None
+    if any(name not in NODE_COSTS for name in order_by or []):
+        parser.error("--order-by costs must be among: {}".format(", ".join(NODE_COSTS)))
+    rate_limits = None
+    if parsed.rate_limit:
+        try:
+            rate_limits = dict((name, float(rate)) for name, rate in
+                               (item.split("=") for item in parsed.rate_limit.split(",")))
+        except ValueError:
+            parser.error("--rate-limit must be a comma separated list of endpoint=rate")
+        if any(name not in RateLimiter.ENDPOINTS for name in rate_limits):
+            parser.error("--rate-limit endpoints must be among: {}".format(", ".join(RateLimiter.ENDPOINTS)))
+    retry_budgets = None
+    if parsed.retry_budget:
+        try:
+            retry_budgets = dict((name, float(budget)) for name, budget in
+                                 (item.split("=") for item in parsed.retry_budget.split(",")))
+        except ValueError:
+            parser.error("--retry-budget must be a comma separated list of operation=seconds")
+        if any(name not in ("create", "delete") for name in retry_budgets):
+            parser.error("--retry-budget operations must be among: create, delete")
+    if parsed.plan:
+        try:
+            parallel = [int(value) for value in parsed.plan_parallel.split(",")]
+            create_ahead = [int(value) for value in parsed.plan_create_ahead.split(",")]
+        except ValueError:
+            parser.error("--plan-parallel and --plan-create-ahead must be comma separated numbers")
+        pools_simulate(parsed.pool, regex=parsed.pool_regex, parallel=parallel,
+                       create_ahead=create_ahead, create_duration=parsed.create_duration,
+                       delete_duration=parsed.delete_duration, history_path=parsed.plan_history)
+        return
+    if parsed.daemon:
+        if parsed.dry_run or parsed.journal or parsed.pre_provision or parsed.async_engine:
+            parser.error("--daemon can not be used with -d/--dry-run, --journal, --pre_provision "
+                         "or --async")
+        if parsed.rate <= 0:
+            parser.error("--rate must be positive")
+        pools_daemon(parsed.pool, regex=parsed.pool_regex, max_age=parsed.max_age * 3600,
+                     rate=parsed.rate, parallel=parsed.parallel, scan_interval=parsed.scan_interval,
+                     max_retry=parsed.max_retry, retry_interval=parsed.retry_interval,
+                     wait_timeout=parsed.wait_timeout, metrics_port=parsed.metrics_port,
+                     metrics_textfile=parsed.metrics_textfile, max_connections=parsed.max_connections,
+                     rate_limits=rate_limits, breaker_threshold=parsed.breaker_threshold,
+                     retry_budgets=retry_budgets, max_drains=parsed.max_drains,
+                     max_moving_containers=parsed.max_moving_containers)
+        return
+    options = {"parallel": parsed.parallel, "create_ahead": parsed.create_ahead,
+               "pre_provision": parsed.pre_provision, "wait_timeout": parsed.wait_timeout,
+               "async_engine": parsed.async_engine, "journal_path": parsed.journal,
+               "resume": parsed.resume, "order_by": order_by,
+               "template_min_share": parsed.template_min_share, "report_path": parsed.report,
+               "metrics_port": parsed.metrics_port, "metrics_textfile": parsed.metrics_textfile,
+               "max_connections": parsed.max_connections, "rate_limits": rate_limits,
+               "breaker_threshold": parsed.breaker_threshold, "retry_budgets": retry_budgets,
+               "max_drains": parsed.max_drains, "max_moving_containers": parsed.max_moving_containers,
+               "max_in_flight": parsed.max_in_flight}
+    if (parsed.pool_regex is None and len(parsed.pool) == 1 and
+            not any(char in parsed.pool[0] for char in "*?[")):
+        pool_recycle(parsed.pool[0], parsed.dry_run, parsed.max_retry,
+                     parsed.retry_interval, **options)
+        return
+    pools_recycle(parsed.pool, regex=parsed.pool_regex, dry_mode=parsed.dry_run,
+                  max_retry=parsed.max_retry, retry_interval=parsed.retry_interval, **options)
 
 
 def main(args=None):
@@ -0,0 +1,150 @@
+# Copyright 2015 tsuru-pool-recycle-plugin authors. All rights reserved.
+# Use of this source code is governed by a BSD-style
+# license that can be found in the LICENSE file.
+
+"""
+Runs a whole recycle against a local fake tsuru API and reports its wall
+time, tsuru API calls per node, connections opened to tsuru, the time no
+node operation was running and the most nodes removed at once.
+
+    $ python -m tests.benchmark --nodes 20 --parallel 4 --create-duration 2
+
+With --startup, it instead reports how long the plugin command takes to
+import and to dry run a pool, as tooling calling it often would see it.
+
+    $ python -m tests.benchmark --startup --runs 20
+"""
+
+import argparse
+import json
+import os
+import subprocess
+import sys
+import time
+
+from pool_recycle import plugin
+from tests.fake_tsuru import FakeTsuru
+
+
+def run_benchmark(nodes=10, parallel=1, create_ahead=0, pre_provision=False, async_engine=False,
+                  create_duration=1.0, delete_duration=1.0, create_failure_rate=0.0,
+                  delete_failure_rate=0.0, latency=0.0, ready_delay=0.0, poll_interval=0.1,
+                  max_poll_interval=1.0, retry_interval=1, max_drains=None, seed=0):
+    fake = FakeTsuru(pools={"benchmark": nodes}, create_duration=create_duration,
+                     delete_duration=delete_duration, create_failure_rate=create_failure_rate,
+                     delete_failure_rate=delete_failure_rate, latency=latency,
+                     ready_delay=ready_delay, seed=seed).start()
+    environ = dict(os.environ)
+    stdout, stderr = sys.stdout, sys.stderr
+    os.environ.update({"TSURU_TARGET": fake.target, "TSURU_TOKEN": "benchmark"})
+    polling_policy = plugin.PollingPolicy(initial_interval=poll_interval, max_interval=max_poll_interval,
+                                          kind_max_intervals={})
+    stats = plugin.RunStats()
+    pool_options = {"polling_policy": polling_policy, "stats": stats,
+                    "drain_budget": plugin.make_drain_budget(max_drains)}
+    options = {"max_retry": 10, "retry_interval": retry_interval, "parallel": parallel,
+               "create_ahead": create_ahead, "pre_provision": pre_provision}
+    error = None
+    started = time.time()
+    try:
+        sys.stdout = sys.stderr = open(os.devnull, "w")
+        if async_engine:
+            loop = plugin.EventLoop()
+            pool_handler = plugin.AsyncTsuruPool("benchmark", **pool_options)
+            loop.run_until_complete(plugin.recycle_async(loop, pool_handler, **options))
+        else:
+            pool_handler = plugin.TsuruPool("benchmark", **pool_options)
+            plugin.recycle(pool_handler, **options)
+    except plugin.PoolRecycleError as ex:
+        error = str(ex)
+    finally:
+        finished = time.time()
+        sys.stdout.close()
+        sys.stdout, sys.stderr = stdout, stderr
+        os.environ.clear()
+        os.environ.update(environ)
+        fake.stop()
+    api_calls = dict(fake.api_calls)
+    return {"nodes": nodes, "parallel": parallel, "create_ahead": create_ahead,
+            "pre_provision": pre_provision, "async": async_engine, "error": error,
+            "wall_time": finished - started,
+            "idle_time": fake.idle_time(started, finished),
+            "api_calls": api_calls,
+            "api_calls_per_node": float(sum(api_calls.values())) / max(nodes, 1),
+            "connections": fake.connections,
+            "max_running_removals": fake.max_running("node.delete"),
+            "recycled": [node["Address"] for node in fake.nodes],
+            "report": stats.report()}
+
+
+def run_startup_benchmark(nodes=10, runs=10, latency=0.0):
+    fake = FakeTsuru(pools={"benchmark": nodes}, latency=latency).start()
+    environ = dict(os.environ, TSURU_TARGET=fake.target, TSURU_TOKEN="benchmark")
+    commands = {"import": [sys.executable, "-c", "import pool_recycle.plugin"],
+                "dry_run": [sys.executable, "-m", "pool_recycle.plugin", "-p", "benchmark", "-d"]}
+    latencies = {}
+    try:
+        with open(os.devnull, "w") as devnull:
+            for name, command in sorted(commands.items()):
+                latencies[name] = []
+                for _ in range(runs):
+                    started = time.time()
+                    subprocess.check_call(command, env=environ, stdout=devnull, stderr=devnull)
+                    latencies[name].append(time.time() - started)
+    finally:
+        fake.stop()
+    return {"runs": runs,
+            "latency": dict((name, {"min": min(values), "median": sorted(values)[len(values) // 2],
+                                    "max": max(values)})
+                            for name, values in latencies.items()),
+            "api_calls_per_run": dict((name, float(count) / runs)
+                                      for name, count in fake.api_calls.items())}
+
+
+def main(args=None):
+    parser = argparse.ArgumentParser(description="Benchmark a pool recycle against a fake tsuru")
+    parser.add_argument("--nodes", default=10, type=int)
+    parser.add_argument("--parallel", default=1, type=int)
+    parser.add_argument("--create-ahead", default=0, type=int)
+    parser.add_argument("--pre_provision", action="store_true")
+    parser.add_argument("--async", action="store_true", dest="async_engine")
+    parser.add_argument("--create-duration", default=1.0, type=float)
+    parser.add_argument("--delete-duration", default=1.0, type=float)
+    parser.add_argument("--create-failure-rate", default=0.0, type=float)
+    parser.add_argument("--delete-failure-rate", default=0.0, type=float)
+    parser.add_argument("--latency", default=0.0, type=float,
+                        help="Time, in seconds, the fake tsuru takes to answer each request")
+    parser.add_argument("--ready-delay", default=0.0, type=float,
+                        help="Time, in seconds, new nodes take to be ready once created")
+    parser.add_argument("--poll-interval", default=0.1, type=float)
+    parser.add_argument("--max-poll-interval", default=1.0, type=float)
+    parser.add_argument("--retry-interval", default=1, type=int)
+    parser.add_argument("--max-drains", default=None, type=int)
+    parser.add_argument("--seed", default=0, type=int)
+    parser.add_argument("--full", action="store_true",
+                        help="Include the per phase and per node report of the run")
+    parser.add_argument("--startup", action="store_true",
+                        help="Measure the command startup and dry run latency instead")
+    parser.add_argument("--runs", default=10, type=int,
+                        help="Times each command is run with --startup")
+    parsed = vars(parser.parse_args(args))
+    full = parsed.pop("full")
+    runs = parsed.pop("runs")
+    if parsed.pop("startup"):
+        result = run_startup_benchmark(nodes=parsed["nodes"], runs=runs, latency=parsed["latency"])
+        json.dump(result, sys.stdout, indent=2, sort_keys=True)
+        sys.stdout.write("\n")
+        return
+    result = run_benchmark(**parsed)
+    del result["recycled"]
+    if not full:
+        result["phases"] = dict((phase, dict((key, summary[key]) for key in ("count", "total", "mean")))
+                                for phase, summary in result["report"]["phases"].items())
+        del result["report"]
+    json.dump(result, sys.stdout, indent=2, sort_keys=True)
+    sys.stdout.write("\n")
+    if result["error"]:
+        sys.exit(1)
+
+if __name__ == "__main__":
+    main()
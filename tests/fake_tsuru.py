@@ -0,0 +1,306 @@
+# Copyright 2015 tsuru-pool-recycle-plugin authors. All rights reserved.
+# Use of this source code is governed by a BSD-style
+# license that can be found in the LICENSE file.
+
+import BaseHTTPServer
+import SocketServer
+import collections
+import json
+import random
+import re
+import threading
+import time
+
+from urlparse import urlparse, parse_qs
+
+
+class FakeTsuru(object):
+    """
+    Local stand-in for the tsuru API endpoints used by the plugin.
+
+    `pools` maps each pool name to its number of nodes, every pool having
+    `templates` IaaS templates. Node creations and removals start a running
+    event that finishes `create_duration` or `delete_duration` seconds later,
+    failing with probability `create_failure_rate` or `delete_failure_rate`.
+    New nodes are listed as waiting for `ready_delay` seconds once created,
+    then as ready. Every request takes at least `latency` seconds and is
+    counted by endpoint, as is every connection opened to it. `fail` makes an
+    endpoint answer the next requests with an error. Like tsuru, node
+    creations and removals answer with the id of their event in the
+    X-Tsuru-Eventid header.
+    """
+
+    OWNER = "admin@example.com"
+
+    def __init__(self, pools=None, templates=2, create_duration=1.0, delete_duration=1.0,
+                 create_failure_rate=0.0, delete_failure_rate=0.0, latency=0.0, ready_delay=0.0,
+                 seed=None):
+        if pools is None:
+            pools = {"theonepool": 10}
+        self.create_duration = create_duration
+        self.delete_duration = delete_duration
+        self.create_failure_rate = create_failure_rate
+        self.delete_failure_rate = delete_failure_rate
+        self.latency = latency
+        self.ready_delay = ready_delay
+        self.random = random.Random(seed)
+        # one generator per event kind, so failures do not depend on how
+        # creations and removals interleave
+        self.failures = collections.defaultdict(lambda: random.Random(seed))
+        self.lock = threading.Lock()
+        self.api_calls = collections.Counter()
+        self.connections = 0
+        self.failing = collections.Counter()
+        self.events = []
+        self.healings = {}
+        self.nodes = []
+        self.templates = []
+        self.addresses = 0
+        self.server = None
+        for pool, size in sorted(pools.items()):
+            for idx in range(templates):
+                self.templates.append({"Name": "{}-template{}".format(pool, idx), "IaaSName": "fake",
+                                       "Data": [{"Name": "pool", "Value": pool}]})
+            for _ in range(size):
+                self.nodes.append(self._new_node(pool))
+
+    @property
+    def target(self):
+        return "http://127.0.0.1:{}".format(self.server.server_address[1])
+
+    def start(self):
+        fake = self
+
+        class Handler(BaseHTTPServer.BaseHTTPRequestHandler):
+            protocol_version = "HTTP/1.1"
+
+            def setup(self):
+                BaseHTTPServer.BaseHTTPRequestHandler.setup(self)
+                with fake.lock:
+                    fake.connections += 1
+
+            def handle_request(self):
+                url = urlparse(self.path)
+                length = int(self.headers.getheader("content-length") or 0)
+                form = parse_qs(self.rfile.read(length)) if length else {}
+                params = dict((key, values[-1]) for key, values in parse_qs(url.query).items())
+                params.update((key, values[-1]) for key, values in form.items())
+                status, body, headers = fake.handle(self.command, url.path, params)
+                body = json.dumps(body) if body is not None else ""
+                self.send_response(status)
+                for name, value in headers.items():
+                    self.send_header(name, value)
+                self.send_header("Content-Type", "application/json")
+                self.send_header("Content-Length", str(len(body)))
+                self.end_headers()
+                self.wfile.write(body)
+
+            do_GET = do_POST = do_PUT = do_DELETE = handle_request
+
+            def log_message(self, *args):
+                pass
+
+        class Server(SocketServer.ThreadingMixIn, BaseHTTPServer.HTTPServer):
+            daemon_threads = True
+
+            def handle_error(self, request, client_address):
+                # keep-alive connections closed by the client are expected
+                pass
+
+        self.server = Server(("127.0.0.1", 0), Handler)
+        thread = threading.Thread(target=self.server.serve_forever)
+        thread.daemon = True
+        thread.start()
+        return self
+
+    def stop(self):
+        self.server.shutdown()
+        self.server.server_close()
+
+    def fail(self, name, times=1):
+        """
+        Makes the next `times` requests to the endpoint `name`, as
+        "nodes.list", answer with an internal server error.
+        """
+        with self.lock:
+            self.failing[name] += times
+
+    ROUTES = [
+        ("GET", r"/users/info$", "users.info"),
+        ("GET", r"/1\.2/node$", "nodes.list"),
+        ("POST", r"/1\.2/node$", "nodes.create"),
+        ("DELETE", r"/1\.2/node/(?P<address>.+)$", "nodes.remove"),
+        ("GET", r"/docker/node/(?P<address>.+)/containers$", "nodes.containers"),
+        ("GET", r"/iaas/templates$", "templates.list"),
+        ("GET", r"/1\.1/events$", "events.list"),
+        ("GET", r"/1\.1/events/(?P<event_id>[^/]+)$", "events.get"),
+        ("GET", r"/1\.2/healing/node$", "healings.list"),
+        ("POST", r"/1\.2/healing/node$", "healings.update"),
+        ("DELETE", r"/1\.2/healing/node$", "healings.remove"),
+    ]
+
+    def handle(self, method, path, params):
+        if self.latency:
+            time.sleep(self.latency)
+        for route_method, pattern, name in self.ROUTES:
+            match = re.match(pattern, path)
+            if route_method == method and match:
+                with self.lock:
+                    self.api_calls[name] += 1
+                    if self.failing[name]:
+                        self.failing[name] -= 1
+                        return 500, {"Message": "{} failed".format(name)}, {}
+                    self._advance()
+                    result = getattr(self, "_" + name.replace(".", "_"))(params, **match.groupdict())
+                return result if len(result) == 3 else result + ({},)
+        return 404, {"Message": "{} {} not found".format(method, path)}, {}
+
+    def idle_time(self, started, finished):
+        """
+        Returns how long, between `started` and `finished`, no node creation
+        or removal was running.
+        """
+        with self.lock:
+            busy = 0
+            end = started
+            for event in sorted(self.events, key=lambda event: event["started"]):
+                event_start = max(event["started"], end)
+                event_end = min(event["ends"], finished)
+                if event_end > event_start:
+                    busy += event_end - event_start
+                    end = event_end
+            return max(0, finished - started - busy)
+
+    def max_running(self, kind):
+        """
+        Returns the most events of `kind`, as "node.delete", ever running at
+        once.
+        """
+        with self.lock:
+            edges = sorted([(event["started"], 1) for event in self.events if event["Kind"]["Name"] == kind] +
+                           [(event["ends"], -1) for event in self.events if event["Kind"]["Name"] == kind])
+        running = peak = 0
+        for _, delta in edges:
+            running += delta
+            peak = max(peak, running)
+        return peak
+
+    def _new_node(self, pool):
+        self.addresses += 1
+        octets = (self.addresses // 65536 % 256, self.addresses // 256 % 256, self.addresses % 256)
+        return {"Address": "http://10.{}.{}.{}:2375".format(*octets),
+                "Metadata": {"pool": pool,
+                             "LastSuccess": time.strftime("%Y-%m-%dT%H:%M:%SZ", time.gmtime())},
+                "Status": "ready",
+                "Containers": self.random.randint(0, 20)}
+
+    def _start_event(self, kind, target, duration, failure_rate, action):
+        now = time.time()
+        failed = self.failures[kind].random() < failure_rate
+        event_id = "{:024x}".format(len(self.events) + 1)
+        self.events.append({"UniqueID": event_id,
+                            "Kind": {"Type": "permission", "Name": kind},
+                            "Target": {"Type": "node", "Value": target},
+                            "Owner": {"Type": "user", "Name": self.OWNER},
+                            "StartTime": time.strftime("%Y-%m-%dT%H:%M:%SZ", time.gmtime(now)),
+                            "Running": True, "Error": "",
+                            "started": now, "ends": now + duration,
+                            "failed": failed, "action": action})
+        return {"X-Tsuru-Eventid": event_id}
+
+    def _advance(self):
+        now = time.time()
+        for event in self.events:
+            if event["Running"] and event["ends"] <= now:
+                event["Running"] = False
+                if event["failed"]:
+                    event["Error"] = "{} failed on IaaS".format(event["Kind"]["Name"])
+                else:
+                    event["action"]()
+        for node in self.nodes:
+            if node["Status"] == "waiting" and node["ready_at"] <= now:
+                node["Status"] = "ready"
+                node["Metadata"]["LastSuccess"] = time.strftime("%Y-%m-%dT%H:%M:%SZ", time.gmtime())
+
+    def _event_json(self, event):
+        return dict((key, value) for key, value in event.items()
+                    if key not in ("started", "ends", "failed", "action"))
+
+    def _find_node(self, address):
+        for node in self.nodes:
+            if node["Address"] == address or urlparse(node["Address"]).hostname == address:
+                return node
+        return None
+
+    def _users_info(self, params):
+        return 200, {"Email": self.OWNER}
+
+    def _nodes_list(self, params):
+        nodes = [dict((key, value) for key, value in node.items() if key not in ("Containers", "ready_at"))
+                 for node in self.nodes]
+        return 200, {"machines": [], "nodes": nodes}
+
+    def _nodes_create(self, params):
+        template = params.get("Metadata.template")
+        pools = [item["Value"] for tpl in self.templates if tpl["Name"] == template
+                 for item in tpl["Data"] if item["Name"] == "pool"]
+        if not pools:
+            return 400, {"Message": 'template "{}" not found'.format(template)}
+        node = self._new_node(pools[0])
+
+        def create():
+            if self.ready_delay:
+                node["Status"] = "waiting"
+                node["ready_at"] = time.time() + self.ready_delay
+            self.nodes.append(node)
+
+        headers = self._start_event("node.create", node["Address"], self.create_duration,
+                                    self.create_failure_rate, create)
+        return 200, None, headers
+
+    def _nodes_remove(self, params, address):
+        node = self._find_node(address)
+        if node is None:
+            return 404, {"Message": "node not found"}
+        headers = self._start_event("node.delete", node["Address"], self.delete_duration,
+                                    self.delete_failure_rate, lambda: self.nodes.remove(node))
+        return 200, None, headers
+
+    def _nodes_containers(self, params, address):
+        node = self._find_node(address)
+        if node is None or not node["Containers"]:
+            return 204, None
+        return 200, [{"ID": "{}-{}".format(address, idx)} for idx in range(node["Containers"])]
+
+    def _templates_list(self, params):
+        return 200, self.templates
+
+    def _events_list(self, params):
+        events = list(reversed(self.events))
+        if "kindname" in params:
+            events = [event for event in events if event["Kind"]["Name"] == params["kindname"]]
+        if "target.value" in params:
+            events = [event for event in events if event["Target"]["Value"] == params["target.value"]]
+        if "running" in params:
+            running = params["running"] == "true"
+            events = [event for event in events if event["Running"] == running]
+        skip = int(params.get("skip", 0))
+        limit = int(params.get("limit", 100))
+        return 200, [self._event_json(event) for event in events[skip:skip + limit]]
+
+    def _events_get(self, params, event_id):
+        for event in self.events:
+            if event["UniqueID"] == event_id:
+                return 200, self._event_json(event)
+        return 404, {"Message": "event not found"}
+
+    def _healings_list(self, params):
+        return 200, self.healings
+
+    def _healings_update(self, params):
+        self.healings[params["pool"]] = {"Enabled": params.get("Enabled") == "True"}
+        return 200, None
+
+    def _healings_remove(self, params):
+        self.healings.pop(params.get("pool"), None)
+        return 200, None
@@ -2,13 +2,45 @@
 # Use of this source code is governed by a BSD-style
 # license that can be found in the LICENSE file.
 
+import httplib
 import os
+import shutil
+import tempfile
+import threading
 import unittest
 import json
+import collections
 
-from mock import patch, Mock, call
+import requests
+from mock import patch, Mock, MagicMock, call
+from tsuruclient import base
 from pool_recycle import plugin
-from pool_recycle.plugin import (RemoveNodeFromPoolError, NewNodeError)
+from pool_recycle.plugin import (RemoveNodeFromPoolError, NewNodeError,
+                                 EventTimeoutError, PollingPolicy)
+from tests.benchmark import run_benchmark, run_startup_benchmark
+from tests.fake_tsuru import FakeTsuru
+
+
+def tsuru_event(unique_id, kind, target="", running=False, error=""):
+    return {"UniqueID": unique_id, "Kind": {"Type": "permission", "Name": kind},
+            "Target": {"Type": "node", "Value": target}, "Running": running,
+            "Error": error}
+
+
+def tsuru_response(body, chunk_size=7):
+    response = Mock(headers={}, status_code=200)
+    response.iter_content.side_effect = lambda size: (body[i:i + chunk_size]
+                                                      for i in range(0, len(body), chunk_size))
+    response.json.side_effect = lambda: json.loads(body)
+    return response
+
+
+def ready_watcher():
+    def watch(address, since):
+        future = plugin.Future()
+        future.set_result({"Address": address, "Status": "ready"})
+        return future
+    return Mock(**{"watch.side_effect": watch})
 
 
 class FakeTsuruPool(object):
@@ -26,13 +58,33 @@ class FakeTsuruPool(object):
         self.pre_provision_error = pre_provision_error
         self.call_count = 0
         self.raise_errors_on_call_counter = raise_errors_on_call_counter
+        self.used_templates = []
+        self.inventory = None
+        self.session = None
+        self.readiness = None
+        self.event_tracker = None
+        self.stats = plugin.RunStats()
+        self.nodes_info = {}
+        self.containers = {}
+        self.min_nodes = len(self.nodes_on_pool)
+        self.max_nodes = len(self.nodes_on_pool)
+        self.lock = threading.Lock()
 
     def get_machines_templates(self):
         return ['templateA', 'templateB']
 
+    def get_pools(self):
+        return ['foobar', 'infra', 'poolA', 'poolB', 'poolC']
+
     def get_nodes(self):
         return list(self.nodes_on_pool)
 
+    def get_node_info(self, address):
+        return self.nodes_info.get(address, {})
+
+    def get_node_containers(self, address):
+        return self.containers.get(address, [])
+
     def get_machines(self):
         return list(self.machines_on_pool)
 
@@ -42,14 +94,31 @@ class FakeTsuruPool(object):
         self.call_count += 1
         self.nodes_on_pool.remove(node)
 
-    def create_new_node(self, template):
-        if self.pre_provision_error and self.call_count >= self.raise_errors_on_call_counter:
-            raise NewNodeError("error adding new node on IaaS")
-        new_node = self.new_nodes.pop(0)
-        self.nodes_on_pool.append(new_node)
-        self.machines_on_pool.append(new_node)
-        self.call_count += 1
-        return new_node
+    def create_new_node(self, template, **kwargs):
+        with self.lock:
+            if self.pre_provision_error and self.call_count >= self.raise_errors_on_call_counter:
+                raise NewNodeError("error adding new node on IaaS")
+            new_node = self.new_nodes.pop(0)
+            self.nodes_on_pool.append(new_node)
+            self.machines_on_pool.append(new_node)
+            self.used_templates.append(template)
+            self.max_nodes = max(self.max_nodes, len(self.nodes_on_pool))
+            self.call_count += 1
+            return new_node
+
+    def create_new_nodes(self, templates, **kwargs):
+        new_nodes = [self.create_new_node(template) for template in templates]
+        self.pre_provisioned = len(new_nodes)
+        return new_nodes
+
+    def remove_node(self, node, **kwargs):
+        with self.lock:
+            if self.remove_node_from_pool_error and self.call_count >= self.raise_errors_on_call_counter:
+                raise RemoveNodeFromPoolError("error on node {}".format(node))
+            self.call_count += 1
+            self.nodes_on_pool.remove(node)
+            self.min_nodes = min(self.min_nodes, len(self.nodes_on_pool))
+            return True
 
     def add_node_to_pool(self, node_url, docker_port, docker_scheme, metadata):
         self.nodes_on_pool.append(node_url)
@@ -67,14 +136,28 @@ class FakeTsuruPool(object):
 
 class TsuruPoolTestCase(unittest.TestCase):
 
-    @patch('tsuruclient.users.Manager.info')
-    def setUp(self, users_mock):
-        users_mock.return_value = {"Email": "myuser"}
+    def setUp(self):
         os.environ["TSURU_TARGET"] = "https://cloud.tsuru.io/"
         os.environ["TSURU_TOKEN"] = "abc123"
         self.patcher = patch('urllib2.urlopen')
         self.urlopen_mock = self.patcher.start()
-        self.pool_handler = plugin.TsuruPool("foobar")
+        self.users_patcher = patch('tsuruclient.users.Manager.info', return_value={"Email": "myuser"})
+        self.users_mock = self.users_patcher.start()
+        self.addCleanup(self.users_patcher.stop)
+        plugin.TsuruPool.users.clear()
+        self.pool_handler = plugin.TsuruPool("foobar", readiness=ready_watcher())
+
+    def test_lazy_startup(self):
+        pool_handler = plugin.TsuruPool("foobar")
+        self.assertEqual(0, self.users_mock.call_count)
+        self.assertIsNone(pool_handler.client.client)
+        self.assertEqual("myuser", pool_handler.user["Email"])
+        self.assertEqual("myuser", plugin.TsuruPool("other").event_tracker.owner)
+        self.assertEqual(1, self.users_mock.call_count)
+        result = run_startup_benchmark(nodes=2, runs=1)
+        self.assertEqual(["dry_run", "import"], sorted(result["latency"]))
+        self.assertNotIn("users.info", result["api_calls_per_run"])
+        self.assertEqual(1, result["api_calls_per_run"]["nodes.list"])
 
     def test_missing_env_var(self):
         del os.environ['TSURU_TOKEN']
@@ -82,7 +165,7 @@ class TsuruPoolTestCase(unittest.TestCase):
                                 "TSURU_TARGET or TSURU_TOKEN envs not set",
                                 plugin.TsuruPool, "foobar")
 
-    @patch('tsuruclient.nodes.Manager.list')
+    @patch('requests.Session.request')
     def test_get_nodes_from_pool(self, mock):
         docker_nodes_json = '''
 {
@@ -143,29 +226,445 @@ class TsuruPoolTestCase(unittest.TestCase):
     ]
 }
         '''
-        mock.return_value = json.loads(docker_nodes_json)
+        mock.return_value = tsuru_response(docker_nodes_json)
         self.assertListEqual(self.pool_handler.get_nodes(),
                              ['http://10.23.26.76:4243',
                              'http://10.25.23.138:4243'])
+        self.assertListEqual(self.pool_handler.get_pools(), ['bilbo', 'foobar'])
+        self.assertEqual(1, mock.call_count)
+        mock.assert_called_with("get", "https://cloud.tsuru.io/1.2/node", stream=True,
+                                headers={"authorization": "bearer abc123"})
+        self.assertEqual({"Address": "http://10.25.23.138:4243", "Status": "ready",
+                          "Metadata": {"pool": "foobar", "LastSuccess": "2015-02-04T11:47:54-02:00"}},
+                         self.pool_handler.get_node_info("http://10.25.23.138:4243"))
 
         docker_nodes_null = '{ "machines": null, "nodes": null }'
-        mock.return_value = json.loads(docker_nodes_null)
+        mock.return_value = tsuru_response(docker_nodes_null)
+        self.pool_handler.inventory.invalidate_nodes()
         self.assertListEqual(self.pool_handler.get_nodes(), [])
 
+    @patch('sys.stdout')
     @patch('tsuruclient.nodes.Manager.create')
     @patch('tsuruclient.events.Manager.list')
-    def test_create_new_node(self, mock_list, mock_create):
-        mock_list.return_value = [{"Running": False, "Error": "", "Target": {"Value": "10.2.3.2"}}]
+    def test_create_new_node(self, mock_list, mock_create, stdout):
+        old_event = tsuru_event("1", "node.create", "10.2.3.1")
+        mock_list.side_effect = lambda **kwargs: \
+            [tsuru_event("2", "node.create", "10.2.3.2"), old_event] if mock_list.call_count > 1 \
+            else [old_event]
         mock_create.return_value = {}
-        self.pool_handler.get_nodes = Mock()
-        self.pool_handler.get_nodes.side_effect = [['192.168.1.1',
-                                                    'http://10.1.1.1:2723',
-                                                    '10.10.10.1'],
-                                                   ['192.168.1.1', '10.2.3.2',
-                                                    '10.10.10.1',
-                                                    'http://10.1.1.1:2723']]
         return_new_node = self.pool_handler.create_new_node("my_template")
         self.assertEqual(return_new_node, '10.2.3.2')
+        mock_list.assert_called_with(ownername="myuser", kindname="node.create", limit=100)
+
+    @patch('pool_recycle.plugin.time.sleep')
+    @patch('sys.stdout')
+    @patch('requests.request')
+    @patch('tsuruclient.events.Manager.get')
+    @patch('tsuruclient.events.Manager.list')
+    def test_create_new_node_exact_event(self, mock_list, mock_get, mock_request, stdout, sleep):
+        response = tsuru_response("")
+        response.headers = {"X-Tsuru-Eventid": "42"}
+        mock_request.return_value = response
+        # a creation from someone else finishes first, it must not be taken
+        mock_list.return_value = [tsuru_event("41", "node.create", "10.9.9.9")]
+        mock_get.side_effect = lambda event_id: tsuru_event(event_id, "node.create", "10.2.3.2",
+                                                            running=mock_get.call_count < 2)
+        self.assertEqual("10.2.3.2", self.pool_handler.create_new_node("my_template"))
+        mock_get.assert_called_with("42")
+
+    @patch('pool_recycle.plugin.time.sleep')
+    @patch('sys.stdout')
+    @patch('tsuruclient.nodes.Manager.create')
+    @patch('tsuruclient.events.Manager.list')
+    def test_create_new_nodes(self, mock_list, mock_create, stdout, sleep):
+        def list_events(**kwargs):
+            events = [tsuru_event("1", "node.create", "10.2.3.1")]
+            for n in range(2, mock_create.call_count + 2):
+                events.insert(0, tsuru_event(str(n), "node.create", "10.2.3.{}".format(n),
+                                             running=mock_list.call_count < 4))
+            return events
+
+        mock_list.side_effect = list_events
+        new_nodes = self.pool_handler.create_new_nodes(["templateA", "templateB"])
+        self.assertEqual(new_nodes, ["10.2.3.2", "10.2.3.3"])
+        self.assertEqual(mock_create.call_args_list,
+                         [call(**{"register": "false", "Metadata.template": "templateA"}),
+                          call(**{"register": "false", "Metadata.template": "templateB"})])
+
+    @patch('sys.stdout')
+    @patch('tsuruclient.nodes.Manager.create')
+    @patch('tsuruclient.events.Manager.list')
+    def test_create_new_nodes_event_error(self, mock_list, mock_create, stdout):
+        events = [tsuru_event("1", "node.create", error="quota exceeded"),
+                  tsuru_event("2", "node.create", "10.2.3.2")]
+        mock_list.side_effect = lambda **kwargs: list(reversed(events[:mock_create.call_count]))
+        self.assertRaisesRegexp(NewNodeError, 'quota exceeded',
+                                self.pool_handler.create_new_nodes, ["templateA", "templateB"])
+
+    @patch('pool_recycle.plugin.time.sleep')
+    @patch('sys.stdout')
+    def test_event_tracker_backoff(self, stdout, sleep):
+        client = Mock()
+        running = tsuru_event("1", "node.delete", "10.1.1.1", running=True)
+        client.events.list.side_effect = [[], [running], [running], [running], [running],
+                                          [tsuru_event("1", "node.delete", "10.1.1.1")]]
+        tracker = plugin.EventTracker(client, "myuser", PollingPolicy(jitter=0))
+        event = tracker.watch_delete("10.1.1.1").result()
+        self.assertEqual("1", event["UniqueID"])
+        self.assertEqual(sleep.call_args_list, [call(2), call(4), call(8), call(16)])
+
+    @patch('pool_recycle.plugin.time.sleep')
+    @patch('sys.stdout')
+    def test_event_tracker_single_query_for_all_operations(self, stdout, sleep):
+        client = Mock()
+        tracker = plugin.EventTracker(client, "myuser", PollingPolicy(jitter=0))
+        client.events.list.return_value = []
+        started = threading.Event()
+        sleep.side_effect = lambda interval: started.wait(5)
+        futures = [tracker.watch_delete("10.1.1.1"), tracker.watch_create(),
+                   tracker.watch_delete("10.1.1.2"), tracker.watch_create()]
+        client.events.list.return_value = [
+            tsuru_event("5", "node.create", "10.2.2.2"),
+            tsuru_event("4", "node.delete", "10.1.1.2"),
+            tsuru_event("3", "node.delete", "10.1.1.1", error="no such node"),
+            tsuru_event("2", "node.create", "10.2.2.1"),
+        ]
+        started.set()
+        self.assertRaisesRegexp(Exception, "no such node", futures[0].result)
+        self.assertEqual("10.2.2.1", futures[1].result()["Target"]["Value"])
+        self.assertEqual("10.1.1.2", futures[2].result()["Target"]["Value"])
+        self.assertEqual("10.2.2.2", futures[3].result()["Target"]["Value"])
+        self.assertLessEqual(client.events.list.call_count, 3)
+
+    @patch('pool_recycle.plugin.time.sleep')
+    @patch('sys.stderr')
+    @patch('sys.stdout')
+    def test_event_tracker_exact_lookup_failure(self, stdout, stderr, sleep):
+        client = Mock()
+        client.events.list.return_value = []
+        not_found = base.TsuruAPIError("404 Not Found", response=Mock(status_code=404))
+        lost = [requests.exceptions.ConnectionError("connection reset")]
+
+        def get_event(event_id):
+            if event_id == "bad":
+                raise not_found
+            if lost:
+                raise lost.pop()
+            return tsuru_event(event_id, "node.delete", "10.1.1.1")
+
+        client.events.get.side_effect = get_event
+        tracker = plugin.EventTracker(client, "myuser", PollingPolicy(jitter=0))
+        futures = [tracker.watch_delete("10.1.1.1", sending=True),
+                   tracker.watch_delete("10.1.1.2", sending=True)]
+        tracker.sent(futures[0], "good")
+        tracker.sent(futures[1], "bad")
+        self.assertEqual("good", futures[0].result()["UniqueID"])
+        self.assertRaisesRegexp(base.TsuruAPIError, "404 Not Found", futures[1].result)
+        stderr.write.assert_any_call("Failed to get event good: connection reset.\n")
+
+    @patch('pool_recycle.plugin.time.sleep')
+    @patch('sys.stdout')
+    def test_event_tracker_waits_for_request(self, stdout, sleep):
+        client = Mock()
+        client.events.list.return_value = []
+        tracker = plugin.EventTracker(client, "myuser", PollingPolicy(jitter=0))
+        future = tracker.watch_create(sending=True)
+        client.events.list.return_value = [tsuru_event("1", "node.create", "10.2.2.1")]
+        tracker.tick()
+        self.assertFalse(future.done())
+        tracker.sent(future)
+        tracker.tick()
+        self.assertEqual("10.2.2.1", future.result()["Target"]["Value"])
+        client.events.list.assert_called_with(ownername="myuser", kindname="node.create", limit=100)
+        client.events.list.reset_mock()
+        client.events.get.return_value = tsuru_event("7", "node.delete", "10.1.1.1")
+        future = tracker.watch_delete("10.1.1.1", sending=True)
+        tracker.sent(future, "7")
+        self.assertEqual("7", future.result()["UniqueID"])
+        client.events.get.assert_called_with("7")
+        client.events.get.reset_mock()
+        client.events.list.return_value = [tsuru_event("8", "node.delete", "10.1.1.2")]
+        future = tracker.watch_delete("10.1.1.2", sending=True)
+        tracker.sent(future, "8")
+        self.assertEqual("8", future.result()["UniqueID"])
+        self.assertEqual(0, client.events.get.call_count)
+
+    @patch('pool_recycle.plugin.time.sleep')
+    @patch('pool_recycle.plugin.time.time')
+    @patch('sys.stdout')
+    def test_readiness_watcher(self, stdout, mock_time, sleep):
+        def node(address, status, last_success=None):
+            return {"Address": "http://{}:2375".format(address), "Status": status,
+                    "Metadata": {"pool": "foobar", "LastSuccess": last_success}}
+
+        listings = [
+            [node("10.2.2.1", "waiting")],
+            [node("10.2.2.1", "ready", "2016-01-01T00:00:00Z"),
+             node("10.2.2.2", "ready", "2016-01-01T00:10:00Z")],
+            [node("10.2.2.1", "ready", "2016-01-01T00:10:00Z"),
+             node("10.2.2.2", "ready", "2016-01-01T00:10:00Z")],
+        ]
+
+        def list_nodes(method, path, handle_response, **kwargs):
+            listing = listings.pop(0) if len(listings) > 1 else listings[0]
+            return handle_response(tsuru_response(json.dumps({"nodes": listing})))
+
+        client = Mock()
+        client.nodes.request.side_effect = list_nodes
+        since = 1451606700  # 2016-01-01T00:05:00Z
+        mock_time.return_value = since
+        stats = plugin.RunStats()
+        watcher = plugin.ReadinessWatcher(plugin.Inventory(client), PollingPolicy(deadline=60),
+                                          stats=stats)
+        with watcher.cond:
+            futures = [watcher.watch("10.2.2.1", since), watcher.watch("http://10.2.2.2:2375", since)]
+        self.assertEqual("2016-01-01T00:10:00Z", futures[0].result()["Metadata"]["LastSuccess"])
+        self.assertEqual("http://10.2.2.2:2375", futures[1].result()["Address"])
+        self.assertEqual(3, client.nodes.request.call_count)
+        self.assertEqual(2, stats.report()["phases"]["wait.node.ready"]["count"])
+        future = watcher.watch("10.9.9.9", since)
+        mock_time.return_value = since + 60
+        self.assertRaisesRegexp(EventTimeoutError, "Node 10.9.9.9 not ready after 60 seconds",
+                                future.result)
+
+    @patch('sys.stderr')
+    @patch('sys.stdout')
+    def test_create_new_nodes_removes_nodes_of_failed_batch(self, stdout, stderr):
+        fake = FakeTsuru(pools={"foobar": 1}, create_duration=0.05, delete_duration=0.05).start()
+        self.addCleanup(fake.stop)
+        old_nodes = [node["Address"] for node in fake.nodes]
+        policy = PollingPolicy(initial_interval=0.01, max_interval=0.05, kind_max_intervals={})
+        templates = ["foobar-template0", "foobar-template1", "bad"]
+        with patch.dict(os.environ, {"TSURU_TARGET": fake.target}):
+            for pool_class in [plugin.TsuruPool, plugin.AsyncTsuruPool]:
+                pool_handler = pool_class("foobar", polling_policy=policy, readiness=ready_watcher())
+                if pool_class is plugin.AsyncTsuruPool:
+                    self.assertRaises(NewNodeError, plugin.EventLoop().run_until_complete,
+                                      pool_handler.create_new_nodes(templates))
+                else:
+                    self.assertRaises(NewNodeError, pool_handler.create_new_nodes, templates)
+                # the nodes created before the batch failed are not left in the pool
+                self.assertEqual(old_nodes, [node["Address"] for node in fake.nodes])
+        self.assertEqual(4, fake.api_calls["nodes.remove"])
+
+    @patch('sys.stderr')
+    @patch('sys.stdout')
+    def test_create_new_node_not_retried_after_timeout(self, stdout, stderr):
+        fake = FakeTsuru(pools={"foobar": 1}, create_duration=0.3, delete_duration=0.05).start()
+        self.addCleanup(fake.stop)
+        old_nodes = [node["Address"] for node in fake.nodes]
+        policy = PollingPolicy(initial_interval=0.01, max_interval=0.05, kind_max_intervals={},
+                               deadline=0.2)
+        with patch.dict(os.environ, {"TSURU_TARGET": fake.target}):
+            for pool_class in [plugin.TsuruPool, plugin.AsyncTsuruPool]:
+                pool_handler = pool_class("foobar", polling_policy=policy)
+                if pool_class is plugin.AsyncTsuruPool:
+                    create = lambda: plugin.EventLoop().run_until_complete(
+                        pool_handler.create_new_node("foobar-template0", max_retry=2, retry_interval=0))
+                else:
+                    create = lambda: pool_handler.create_new_node("foobar-template0", max_retry=2,
+                                                                  retry_interval=0)
+                self.assertRaisesRegexp(NewNodeError, "Not retrying: Timeout waiting for event", create)
+                self.assertEqual(1, pool_handler.stats.counters["fatal.node.create"])
+                # the node created after the timeout is removed once its event finishes
+                self.assertEqual(old_nodes, [node["Address"] for node in fake.nodes])
+        # the node still being created is not requested again
+        self.assertEqual(2, fake.api_calls["nodes.create"])
+        self.assertEqual(2, fake.api_calls["nodes.remove"])
+
+    @patch('sys.stderr')
+    @patch('sys.stdout')
+    def test_create_new_node_removes_node_never_ready(self, stdout, stderr):
+        fake = FakeTsuru(pools={"foobar": 1}, create_duration=0.05, delete_duration=0.05,
+                         ready_delay=60).start()
+        self.addCleanup(fake.stop)
+        old_nodes = [node["Address"] for node in fake.nodes]
+        policy = PollingPolicy(initial_interval=0.01, max_interval=0.05, kind_max_intervals={},
+                               deadline=0.5)
+        with patch.dict(os.environ, {"TSURU_TARGET": fake.target}):
+            for pool_class in [plugin.TsuruPool, plugin.AsyncTsuruPool]:
+                pool_handler = pool_class("foobar", polling_policy=policy)
+                if pool_class is plugin.AsyncTsuruPool:
+                    self.assertRaises(NewNodeError, plugin.EventLoop().run_until_complete,
+                                      pool_handler.create_new_node("foobar-template0", max_retry=0))
+                else:
+                    self.assertRaises(NewNodeError, pool_handler.create_new_node, "foobar-template0",
+                                      max_retry=0)
+                # the new node never got ready, so it is not left in the pool
+                self.assertEqual(old_nodes, [node["Address"] for node in fake.nodes])
+        self.assertEqual(2, fake.api_calls["nodes.create"])
+        self.assertEqual(2, fake.api_calls["nodes.remove"])
+
+    @patch('pool_recycle.plugin.time.time')
+    @patch('pool_recycle.plugin.time.sleep')
+    @patch('sys.stdout')
+    def test_event_tracker_deadline(self, stdout, sleep, mock_time):
+        client = Mock()
+        client.events.list.side_effect = [[], [tsuru_event("1", "node.create", running=True)],
+                                          [tsuru_event("1", "node.create", running=True)]]
+        mock_time.side_effect = [0, 5, 11, 11]
+        tracker = plugin.EventTracker(client, "myuser", PollingPolicy(deadline=10), stats=MagicMock())
+        future = tracker.watch_create()
+        self.assertRaisesRegexp(EventTimeoutError, 'Node create still running after 10 seconds',
+                                future.result)
+        self.assertEqual(3, client.events.list.call_count)
+
+    @patch('sys.stderr')
+    @patch('pool_recycle.plugin.time.time')
+    def test_retry(self, mock_time, stderr):
+        mock_time.return_value = 0
+        stats = plugin.RunStats()
+        retry = plugin.Retry("create", "Node creation", NewNodeError, max_retry=2, retry_interval=60,
+                             polling_policy=PollingPolicy(jitter=0), stats=stats)
+        self.assertEqual(2, retry.backoff(Exception("IaaS unavailable")))
+        self.assertEqual(4, retry.backoff(requests.exceptions.ConnectionError("timed out")))
+        self.assertRaisesRegexp(NewNodeError, "Maximum number of retries exceeded: IaaS unavailable",
+                                retry.backoff, Exception("IaaS unavailable"))
+        self.assertEqual(2, stats.counters["retries.node.create"])
+        stderr.write.assert_called_with("Node creation failed: timed out. Retrying in 4.0 seconds.\n")
+        retry = plugin.Retry("delete", "Node delete", RemoveNodeFromPoolError, budget=5,
+                             polling_policy=PollingPolicy(jitter=0), stats=stats)
+        rejected = base.TsuruAPIError("400 Client Error", response=Mock(status_code=400))
+        self.assertRaisesRegexp(RemoveNodeFromPoolError, "Not retrying: 400 Client Error",
+                                retry.backoff, rejected)
+        throttled = base.TsuruAPIError("429 Too Many Requests", response=Mock(status_code=429))
+        self.assertEqual(2, retry.backoff(throttled))
+        mock_time.return_value = 2
+        self.assertRaisesRegexp(RemoveNodeFromPoolError, "Retry budget of 5 seconds exceeded",
+                                retry.backoff, throttled)
+
+    @patch('pool_recycle.plugin.time.sleep')
+    @patch('sys.stderr')
+    @patch('sys.stdout')
+    @patch('tsuruclient.events.Manager.list')
+    @patch('requests.request')
+    def test_create_new_node_recovers_timed_out_request(self, mock_request, mock_list, stdout, stderr,
+                                                        sleep):
+        old_event = tsuru_event("1", "node.create", "10.2.3.1")
+        mock_list.return_value = [old_event]
+
+        def timeout(*args, **kwargs):
+            # tsuru got the request but the answer was lost
+            mock_list.return_value = [tsuru_event("2", "node.create", "10.2.3.2"), old_event]
+            raise requests.exceptions.ReadTimeout("read timed out")
+
+        mock_request.side_effect = timeout
+        self.assertEqual("10.2.3.2", self.pool_handler.create_new_node("my_template", max_retry=0))
+        self.assertEqual(1, mock_request.call_count)
+
+    def test_drain_budget(self):
+        budget = plugin.DrainBudget(max_drains=2, max_containers=30)
+        first, second, third = budget.admit(20), budget.admit(10), budget.admit(5)
+        self.assertEqual([True, True, False], [first.done(), second.done(), third.done()])
+        budget.release(20)
+        self.assertTrue(third.done())
+        # too big to go along other drains, it waits for them all
+        big, small = budget.admit(50), budget.admit(1)
+        budget.release(10)
+        self.assertFalse(big.done())
+        budget.release(5)
+        self.assertEqual([True, False], [big.done(), small.done()])
+        budget.release(50)
+        self.assertTrue(small.done())
+
+    @patch('sys.stderr')
+    @patch('sys.stdout')
+    @patch('tsuruclient.events.Manager.list')
+    @patch('tsuruclient.nodes.Manager.remove')
+    def test_remove_node_waits_for_drain_budget(self, mock_delete, mock_events, stdout, stderr):
+        node = 'http://127.0.0.1:4243'
+        mock_events.side_effect = lambda **kwargs: \
+            [tsuru_event("1", "node.delete", node)] if mock_events.call_count > 1 else []
+        mock_delete.return_value = {}
+        budget = plugin.DrainBudget(max_drains=1, max_containers=10)
+        held = budget.admit(1)
+        self.pool_handler.drain_budget = budget
+        with patch.object(self.pool_handler, "get_node_containers", return_value=[{}] * 4):
+            thread = threading.Thread(target=self.pool_handler.remove_node, args=(node,))
+            thread.daemon = True
+            thread.start()
+            thread.join(0.2)
+            self.assertTrue(thread.is_alive())
+            self.assertEqual(0, mock_delete.call_count)
+            budget.release(1)
+            thread.join(10)
+        self.assertFalse(thread.is_alive())
+        self.assertEqual(1, mock_delete.call_count)
+        self.assertTrue(held.done())
+        self.assertEqual((0, 0), (budget.drains, budget.containers))
+
+    @patch('pool_recycle.plugin.time.sleep')
+    @patch('pool_recycle.plugin.time.time')
+    def test_rate_limiter(self, mock_time, sleep):
+        mock_time.return_value = 100
+        limiter = plugin.RateLimiter({"create": 2, "events": 0.5})
+        self.assertEqual(["create", "delete", "events", None],
+                         [limiter.endpoint("post", "/node"), limiter.endpoint("delete", "/node/10.1.1.1"),
+                          limiter.endpoint("get", "/events/42"), limiter.endpoint("get", "/node")])
+        self.assertEqual([0, 0, 0.5, 1.0], [limiter.acquire("create") for _ in range(4)])
+        self.assertEqual([0, 2.0], [limiter.acquire("events") for _ in range(2)])
+        self.assertEqual([0, 0], [limiter.acquire("delete"), limiter.acquire(None)])
+        self.assertEqual([call(0.5), call(1.0), call(2.0)], sleep.call_args_list)
+        mock_time.return_value = 110
+        self.assertEqual([0, 0, 0.5], [limiter.acquire("create") for _ in range(3)])
+
+    @patch('sys.stderr')
+    def test_circuit_breaker(self, stderr):
+        stats = plugin.RunStats()
+        breaker = plugin.CircuitBreaker(threshold=0.5, window=60, min_calls=4, cooldown=30, stats=stats)
+        with patch('pool_recycle.plugin.time.time') as mock_time:
+            mock_time.return_value = 100
+            for failed in [True, True, True]:
+                self.assertFalse(breaker.acquire())
+                breaker.record(failed)
+            # failures out of the window are forgotten
+            mock_time.return_value = 200
+            for failed in [False, True, False]:
+                breaker.record(failed)
+            self.assertEqual("closed", breaker.state)
+            breaker.record(True)
+            self.assertEqual("open", breaker.state)
+            mock_time.return_value = 230
+            self.assertTrue(breaker.acquire())
+            breaker.record(True, probe=True)
+            self.assertEqual("open", breaker.state)
+            mock_time.return_value = 260
+            self.assertTrue(breaker.acquire())
+            breaker.record(False, probe=True)
+            self.assertFalse(breaker.acquire())
+        self.assertEqual(2, stats.counters["breaker.opened"])
+
+        breaker = plugin.CircuitBreaker(min_calls=1, cooldown=0.05, stats=stats)
+        breaker.record(True)
+        probes = []
+        threads = [threading.Thread(target=lambda: probes.append(breaker.acquire())) for _ in range(2)]
+        for thread in threads:
+            thread.start()
+        for _ in range(100):
+            if probes:
+                break
+            threading.Event().wait(0.01)
+        self.assertEqual([True], probes)
+        breaker.record(False, probe=True)
+        for thread in threads:
+            thread.join(5)
+        self.assertEqual([True, False], probes)
+
+    def test_polling_policy_interval(self):
+        policy = PollingPolicy(initial_interval=1, multiplier=3, max_interval=10,
+                               kind_max_intervals={"node.delete": 50}, jitter=0)
+        self.assertEqual([1, 3, 9, 10], [policy.interval(n) for n in range(4)])
+        self.assertEqual([1, 3, 9, 27, 50], [policy.interval(n, "node.delete") for n in range(5)])
+        self.assertEqual(5, policy.interval(4, "node.delete", max_interval=5))
+        policy = PollingPolicy(initial_interval=10, jitter=0.5)
+        for _ in range(20):
+            self.assertTrue(5 <= policy.interval(0) <= 15)
+
+    def test_polling_policy_expired(self):
+        self.assertFalse(PollingPolicy().expired(0))
+        policy = PollingPolicy(deadline=60)
+        self.assertTrue(policy.expired(plugin.time.time() - 61))
+        self.assertFalse(policy.expired(plugin.time.time()))
 
     @patch('tsuruclient.templates.Manager.list')
     def test_return_machines_templates(self, mock):
@@ -264,21 +763,74 @@ class TsuruPoolTestCase(unittest.TestCase):
         mock.return_value = json.loads(machines_templates_json)
         self.assertListEqual(self.pool_handler.get_machines_templates(),
                              ['template_red', 'template_yellow'])
+        self.pool_handler.pool = "infra"
+        self.assertListEqual(self.pool_handler.get_machines_templates(), ['template_blue'])
+        self.assertEqual(1, mock.call_count)
+        self.pool_handler.inventory.invalidate_templates()
         mock.side_effect = Exception()
         self.assertRaisesRegexp(Exception, 'Error getting machines templates',
                                 self.pool_handler.get_machines_templates)
 
+    @patch('pool_recycle.plugin.time.time')
+    def test_inventory_ttl(self, mock_time):
+        client = Mock()
+        body = json.dumps({"nodes": [{"Address": "10.1.1.1", "Metadata": {"pool": "a"}},
+                                     {"Address": "10.1.1.2", "Metadata": {"pool": "b"}},
+                                     {"Address": "10.1.1.3", "Metadata": {}}]})
+        client.nodes.request.side_effect = lambda method, path, handle_response, **kwargs: \
+            handle_response(tsuru_response(body))
+        inventory = plugin.Inventory(client, ttl=60)
+        mock_time.return_value = 1000
+        self.assertEqual(["10.1.1.1"], [node["Address"] for node in inventory.nodes("a")])
+        mock_time.return_value = 1059
+        self.assertEqual(["10.1.1.2"], [node["Address"] for node in inventory.nodes("b")])
+        self.assertEqual([], inventory.nodes("c"))
+        self.assertEqual(["a", "b"], inventory.pools())
+        self.assertEqual(1, client.nodes.request.call_count)
+        mock_time.return_value = 1060
+        inventory.nodes("a")
+        self.assertEqual(2, client.nodes.request.call_count)
+        inventory.invalidate_nodes()
+        inventory.nodes("a")
+        self.assertEqual(3, client.nodes.request.call_count)
+
+    @patch('sys.stdout')
+    @patch('requests.Session.request')
+    @patch('tsuruclient.nodes.Manager.create')
+    @patch('tsuruclient.events.Manager.list')
+    def test_create_new_node_invalidates_inventory(self, mock_events, mock_create, mock_nodes, stdout):
+        mock_nodes.return_value = tsuru_response(json.dumps(
+            {"nodes": [{"Address": "10.1.1.1", "Metadata": {"pool": "foobar"}}]}))
+        self.assertEqual(["10.1.1.1"], self.pool_handler.get_nodes())
+        mock_events.side_effect = lambda **kwargs: [
+            tsuru_event(str(n), "node.create", "10.2.2.2") for n in range(mock_create.call_count)]
+        self.pool_handler.create_new_node("my_template")
+        mock_nodes.return_value = tsuru_response(json.dumps(
+            {"nodes": [{"Address": "10.1.1.1", "Metadata": {"pool": "foobar"}},
+                       {"Address": "10.2.2.2", "Metadata": {"pool": "foobar"}}]}))
+        self.assertEqual(["10.1.1.1", "10.2.2.2"], self.pool_handler.get_nodes())
+        self.assertEqual(2, mock_nodes.call_count)
+
+    @patch('requests.Session.request')
     @patch('tsuruclient.events.Manager.list')
     @patch('tsuruclient.nodes.Manager.remove')
-    def test_remove_node(self, mock_delete, mock_events):
+    def test_remove_node(self, mock_delete, mock_events, mock_nodes):
         node = 'http://127.0.0.1:4243'
-        mock_events.return_value = [{"Running": False, "Error": ""}]
+        mock_nodes.return_value = tsuru_response(json.dumps(
+            {"nodes": [{"Address": node, "Metadata": {"pool": "foobar"}}]}))
+        mock_events.side_effect = lambda **kwargs: \
+            [tsuru_event("1", "node.delete", node)] if mock_events.call_count > 1 else []
         mock_delete.return_value = {}
         return_remove_node = self.pool_handler.remove_node(node, max_retry=0)
         self.assertEqual(return_remove_node, True)
+        mock_events.side_effect = None
+        mock_events.return_value = [tsuru_event("1", "node.delete", node)]
         mock_delete.side_effect = Exception("No such node in storage")
         self.assertRaisesRegexp(Exception, 'No such node in storage',
                                 self.pool_handler.remove_node, node, 0, 0)
+        # the node is gone, the removal did happen
+        mock_nodes.return_value = tsuru_response(json.dumps({"nodes": []}))
+        self.assertTrue(self.pool_handler.remove_node(node, max_retry=0))
 
     @patch('tsuruclient.healings.Manager.remove')
     @patch('tsuruclient.healings.Manager.update')
@@ -359,13 +911,808 @@ class TsuruPoolTestCase(unittest.TestCase):
                             call('\n')]
         stdout.write.assert_has_calls(call_stdout_list)
 
+    @patch("sys.stdout")
+    @patch('pool_recycle.plugin.TsuruPool')
+    def test_pool_recycle_parallel(self, tsuru_pool_mock, stdout):
+        fake_pool = FakeTsuruPool('foobar')
+        tsuru_pool_mock.return_value = fake_pool
+        plugin.pool_recycle('foobar', parallel=2)
+        self.assertItemsEqual(fake_pool.get_nodes(), ['1.2.3.4', '5.6.7.8', '9.10.11.12'])
+        self.assertItemsEqual(fake_pool.used_templates, ['templateA', 'templateB', 'templateA'])
+        self.assertEqual(fake_pool.min_nodes, 3)
+        stdout.write.assert_has_calls([call('Done.\n')])
+
+    @patch("sys.stderr")
+    @patch("sys.stdout")
+    @patch('pool_recycle.plugin.TsuruPool')
+    def test_pool_recycle_parallel_failure(self, tsuru_pool_mock, stdout, stderr):
+        fake_pool = FakeTsuruPool('foobar', remove_node_from_pool_error=True)
+        fake_pool.disable_healing = Mock()
+        enable_healing = fake_pool.disable_healing.return_value
+        tsuru_pool_mock.return_value = fake_pool
+        self.assertRaises(SystemExit, plugin.pool_recycle, 'foobar', parallel=3)
+        self.assertEqual(1, enable_healing.call_count)
+        self.assertEqual(['127.0.0.1', '10.10.1.1', '10.1.1.2'], fake_pool.get_nodes()[:3])
+
+    @patch("sys.stdout")
+    @patch('pool_recycle.plugin.TsuruPool')
+    def test_pool_recycle_create_ahead_overlaps_removal(self, tsuru_pool_mock, stdout):
+        fake_pool = FakeTsuruPool('foobar')
+        next_created = threading.Event()
+        overlapped = []
+        create_new_node = fake_pool.create_new_node
+        remove_node = fake_pool.remove_node
+
+        def create(template, **kwargs):
+            new_node = create_new_node(template, **kwargs)
+            if fake_pool.call_count > 1:
+                next_created.set()
+            return new_node
+
+        def remove(node, **kwargs):
+            if node == '127.0.0.1':
+                overlapped.append(next_created.wait(5))
+            return remove_node(node, **kwargs)
+
+        fake_pool.create_new_node = create
+        fake_pool.remove_node = remove
+        tsuru_pool_mock.return_value = fake_pool
+        plugin.pool_recycle('foobar', create_ahead=1)
+        self.assertEqual([True], overlapped)
+        self.assertItemsEqual(fake_pool.get_nodes(), ['1.2.3.4', '5.6.7.8', '9.10.11.12'])
+        self.assertEqual(fake_pool.min_nodes, 3)
+        self.assertLessEqual(fake_pool.max_nodes, 5)
+
+    @patch("sys.stdout")
+    @patch('pool_recycle.plugin.TsuruPool')
+    def test_pool_recycle_pre_provision(self, tsuru_pool_mock, stdout):
+        fake_pool = FakeTsuruPool('foobar')
+        remove_node = fake_pool.remove_node
+        nodes_before_removal = []
+
+        def remove(node, **kwargs):
+            nodes_before_removal.append(len(fake_pool.get_nodes()))
+            return remove_node(node, **kwargs)
+
+        fake_pool.remove_node = remove
+        tsuru_pool_mock.return_value = fake_pool
+        plugin.pool_recycle('foobar', pre_provision=True, parallel=2)
+        self.assertEqual(3, fake_pool.pre_provisioned)
+        self.assertEqual(6, max(nodes_before_removal))
+        self.assertItemsEqual(fake_pool.get_nodes(), ['1.2.3.4', '5.6.7.8', '9.10.11.12'])
+        self.assertEqual(['templateA', 'templateB', 'templateA'], fake_pool.used_templates)
+
+    @patch('sys.stdout')
+    def test_recycle_scheduler_limits_surge(self, stdout):
+        fake_pool = FakeTsuruPool('foobar')
+        fake_pool.new_nodes.extend(['13.14.15.16', '17.18.19.20'])
+        fake_pool.nodes_on_pool.extend(['10.1.1.3', '10.1.1.4'])
+        fake_pool.min_nodes = fake_pool.max_nodes = 5
+        jobs = [(idx, node, 'templateA') for idx, node in enumerate(fake_pool.get_nodes())]
+        plugin.RecycleScheduler(fake_pool, parallel=2, create_ahead=1).run(jobs)
+        self.assertEqual(fake_pool.min_nodes, 5)
+        self.assertLessEqual(fake_pool.max_nodes, 8)
+        self.assertEqual(5, len(fake_pool.get_nodes()))
+
+    @patch("sys.stdout")
+    @patch('pool_recycle.plugin.AsyncTsuruPool')
+    def test_pool_recycle_async(self, tsuru_pool_mock, stdout):
+        for options in [{}, {"parallel": 2}, {"create_ahead": 1}, {"pre_provision": True}]:
+            fake_pool = FakeTsuruPool('foobar')
+            tsuru_pool_mock.return_value = fake_pool
+            plugin.pool_recycle('foobar', async_engine=True, **options)
+            self.assertItemsEqual(fake_pool.get_nodes(), ['1.2.3.4', '5.6.7.8', '9.10.11.12'])
+            self.assertEqual(['templateA', 'templateB', 'templateA'], fake_pool.used_templates)
+            self.assertEqual(fake_pool.min_nodes, 3)
+            stdout.write.assert_called_with('Done.\n')
+
+    @patch("sys.stdout")
+    @patch('pool_recycle.plugin.AsyncTsuruPool')
+    def test_pool_recycle_async_dry_mode(self, tsuru_pool_mock, stdout):
+        tsuru_pool_mock.return_value = FakeTsuruPool('foobar')
+        plugin.pool_recycle('foobar', True, async_engine=True)
+        stdout.write.assert_has_calls([
+            call('(2/3) Creating new node on pool "foobar" using "templateB" template\n'),
+            call('Destroying node "10.10.1.1\n'),
+            call('\n')])
+        self.assertEqual(['templateA', 'templateB'], tsuru_pool_mock.return_value.get_machines_templates())
+        self.assertEqual([], tsuru_pool_mock.return_value.used_templates)
+
+    @patch("sys.stderr")
+    @patch("sys.stdout")
+    @patch('pool_recycle.plugin.AsyncTsuruPool')
+    def test_pool_recycle_async_failure(self, tsuru_pool_mock, stdout, stderr):
+        fake_pool = FakeTsuruPool('foobar', remove_node_from_pool_error=True)
+        fake_pool.disable_healing = Mock()
+        enable_healing = fake_pool.disable_healing.return_value
+        tsuru_pool_mock.return_value = fake_pool
+        self.assertRaises(SystemExit, plugin.pool_recycle, 'foobar', parallel=2, async_engine=True)
+        self.assertEqual(1, enable_healing.call_count)
+        stderr.write.assert_called_once_with(
+            'Failed: Error removing node from pool: "error on node 127.0.0.1"\n')
+
+    @patch("sys.stderr")
+    @patch("sys.stdout")
+    @patch('pool_recycle.plugin.AsyncTsuruPool')
+    def test_pool_recycle_async_interrupted(self, tsuru_pool_mock, stdout, stderr):
+        fake_pool = FakeTsuruPool('foobar')
+        fake_pool.disable_healing = Mock()
+        enable_healing = fake_pool.disable_healing.return_value
+        tsuru_pool_mock.return_value = fake_pool
+        run_once = plugin.EventLoop._run_once
+        calls = []
+
+        def interrupt(loop):
+            calls.append(None)
+            if len(calls) == 3:
+                raise KeyboardInterrupt()
+            run_once(loop)
+
+        with patch.object(plugin.EventLoop, "_run_once", interrupt):
+            self.assertRaises(SystemExit, plugin.pool_recycle, 'foobar', async_engine=True)
+        self.assertEqual(1, enable_healing.call_count)
+        stderr.write.assert_any_call("Interrupted, waiting for node operations in flight.\n")
+        stderr.write.assert_any_call("Failed: Recycle interrupted\n")
+
+    @patch('sys.stderr')
+    @patch('sys.stdout')
+    @patch('tsuruclient.nodes.Manager.remove')
+    @patch('tsuruclient.nodes.Manager.create')
+    @patch('tsuruclient.events.Manager.list')
+    @patch('tsuruclient.users.Manager.info')
+    def test_async_tsuru_pool(self, users, mock_list, mock_create, mock_remove, stdout, stderr):
+        users.return_value = {"Email": "myuser"}
+        mock_create.side_effect = [Exception("IaaS unavailable"), {}]
+
+        def list_events(**kwargs):
+            events = [tsuru_event("0", "node.delete", "10.1.1.1")]
+            if mock_create.call_count == 2:
+                events.insert(0, tsuru_event("1", "node.create", "10.2.3.1"))
+            if mock_remove.call_count:
+                events.insert(0, tsuru_event("2", "node.delete", "10.1.1.1"))
+            return events
+
+        mock_list.side_effect = list_events
+        pool_handler = plugin.AsyncTsuruPool("foobar", readiness=ready_watcher())
+        loop = plugin.EventLoop()
+        new_node = loop.run_until_complete(pool_handler.create_new_node("my_template",
+                                                                        retry_interval=0))
+        self.assertEqual("10.2.3.1", new_node)
+        self.assertTrue(loop.run_until_complete(pool_handler.remove_node("10.1.1.1")))
+        mock_remove.assert_called_once_with(**{"remove-iaas": "true", "address": "10.1.1.1"})
+
+    def test_event_loop(self):
+        loop = plugin.EventLoop()
+        order = []
+
+        def worker(name, delay):
+            yield plugin.Sleep(delay)
+            order.append(name)
+            raise plugin.Return(name.upper())
+
+        def failing():
+            yield plugin.Sleep(0)
+            raise ValueError("boom")
+
+        def main():
+            result = yield [worker("b", 0.02), worker("a", 0.01), "c"]
+            try:
+                yield failing()
+            except ValueError as ex:
+                result.append(str(ex))
+            raise plugin.Return(result)
+
+        self.assertEqual(["B", "A", "c", "boom"], loop.run_until_complete(main()))
+        self.assertEqual(["a", "b"], order)
+
+    def _interrupted_journal(self):
+        tmpdir = tempfile.mkdtemp()
+        self.addCleanup(shutil.rmtree, tmpdir)
+        journal = plugin.Journal(os.path.join(tmpdir, "recycle.journal"))
+        journal.start("foobar")
+        journal.record("foobar", plugin.Journal.CREATED, "127.0.0.1", "1.2.3.4")
+        journal.record("foobar", plugin.Journal.REMOVAL_STARTED, "127.0.0.1")
+        journal.record("foobar", plugin.Journal.REMOVED, "127.0.0.1")
+        journal.record("foobar", plugin.Journal.CREATED, "10.10.1.1", "5.6.7.8")
+        journal.record("other", plugin.Journal.CREATED, "10.1.1.2", "9.9.9.9")
+        with open(journal.path, "a") as journal_file:
+            journal_file.write('{"pool": "foobar", "sta')
+        return journal
+
+    def test_journal_resume(self):
+        journal = self._interrupted_journal()
+        nodes = ['10.10.1.1', '10.1.1.2', '1.2.3.4', '5.6.7.8']
+        self.assertEqual((['10.10.1.1', '10.1.1.2'], {'10.10.1.1': '5.6.7.8'}),
+                         journal.resume("foobar", nodes))
+        self.assertEqual((['10.10.1.1', '10.1.1.2'], {}),
+                         journal.resume("foobar", ['10.10.1.1', '10.1.1.2', '1.2.3.4']))
+        self.assertEqual({}, journal.replay("poolA"))
+        journal.finish("foobar")
+        self.assertEqual((nodes, {}), journal.resume("foobar", nodes))
+
+    @patch("sys.stderr")
+    @patch("sys.stdout")
+    def test_recycle_resumes_requested_creation(self, stdout, stderr):
+        policy = PollingPolicy(initial_interval=0.01, max_interval=0.05, kind_max_intervals={})
+        for async_engine in [False, True]:
+            fake = FakeTsuru(pools={"foobar": 2}, create_duration=0.05, delete_duration=0.05).start()
+            self.addCleanup(fake.stop)
+            old_nodes = [node["Address"] for node in fake.nodes]
+            journal = plugin.Journal(os.path.join(tempfile.mkdtemp(), "recycle.journal"))
+            self.addCleanup(shutil.rmtree, os.path.dirname(journal.path))
+            with patch.dict(os.environ, {"TSURU_TARGET": fake.target}):
+                pool_class = plugin.AsyncTsuruPool if async_engine else plugin.TsuruPool
+                pool_handler = pool_class("foobar", polling_policy=policy)
+                # a run interrupted while the replacement of the first node was being created
+                journal.start("foobar")
+                future = plugin.TsuruPool.start_create(pool_handler, "foobar-template0")
+                pool_handler.event_tracker.cancel(future)
+                journal.record("foobar", plugin.Journal.CREATING, old_nodes[0], event_id=future.event_id)
+                options = {"journal": journal, "resume": True, "retry_interval": 0}
+                if async_engine:
+                    loop = plugin.EventLoop()
+                    loop.run_until_complete(plugin.recycle_async(loop, pool_handler, **options))
+                else:
+                    plugin.recycle(pool_handler, **options)
+            new_nodes = [node["Address"] for node in fake.nodes]
+            self.assertEqual(2, len(new_nodes))
+            self.assertFalse(set(old_nodes) & set(new_nodes))
+            # the node of the interrupted creation replaced the first node, it was not recycled
+            self.assertEqual(2, fake.api_calls["nodes.create"])
+            with open(journal.path) as journal_file:
+                creating = [entry for entry in map(json.loads, journal_file)
+                            if entry["state"] == plugin.Journal.CREATING]
+            self.assertEqual([old_nodes[0], old_nodes[1]], [entry["node"] for entry in creating])
+            self.assertTrue(all(entry["event_id"] for entry in creating))
+
+    @patch("sys.stdout")
+    @patch('pool_recycle.plugin.AsyncTsuruPool')
+    @patch('pool_recycle.plugin.TsuruPool')
+    def test_pool_recycle_resume(self, tsuru_pool_mock, async_tsuru_pool_mock, stdout):
+        for options in [{}, {"parallel": 2}, {"pre_provision": True}, {"async_engine": True}]:
+            journal = self._interrupted_journal()
+            fake_pool = FakeTsuruPool('foobar')
+            fake_pool.nodes_on_pool = ['10.10.1.1', '10.1.1.2', '1.2.3.4', '5.6.7.8']
+            fake_pool.new_nodes = ['9.10.11.12']
+            tsuru_pool_mock.return_value = fake_pool
+            async_tsuru_pool_mock.return_value = fake_pool
+            plugin.pool_recycle('foobar', journal_path=journal.path, resume=True, **options)
+            self.assertItemsEqual(['1.2.3.4', '5.6.7.8', '9.10.11.12'], fake_pool.get_nodes())
+            self.assertEqual(['templateA'], fake_pool.used_templates)
+            stdout.write.assert_any_call('Resuming recycle of pool "foobar": 2 node(s) already '
+                                         'recycled, 1 node(s) already replaced.\n')
+            stdout.write.assert_called_with('Done.\n')
+            self.assertEqual({}, journal.replay("foobar"))
+
+    def test_iter_json_items(self):
+        document = json.dumps(collections.OrderedDict([
+            ("machines", [{"nodes": [1], "Address": "a\\\"]}[,:"}, None, 1.5]),
+            ("count", 12345),
+            ("nodes", [{"Address": u"n\u00e9 \"1\"", "Metadata": {"pool": "p]"}}, 42, [], "x"]),
+            ("after", {"nodes": ["ignored"]})]))
+        expected = [{"Address": u"n\u00e9 \"1\"", "Metadata": {"pool": "p]"}}, 42, [], "x"]
+        for chunk_size in [1, 2, 3, 7, 64, len(document)]:
+            chunks = (document[i:i + chunk_size] for i in range(0, len(document), chunk_size))
+            self.assertEqual(expected, list(plugin.iter_json_items(chunks, "nodes")))
+        self.assertEqual([], list(plugin.iter_json_items(['{"nodes": null}'], "nodes")))
+        self.assertEqual([], list(plugin.iter_json_items(['{"machines": []}'], "nodes")))
+        self.assertEqual([1, 23], list(plugin.iter_json_items(['{"nodes": [1, 2', '3]}'], "nodes")))
+        self.assertRaises(ValueError, list, plugin.iter_json_items(['{"nodes": [{"Address": "a"'], "nodes"))
+
+    def test_parse_timestamp(self):
+        self.assertEqual(1423057674, plugin.parse_timestamp("2015-02-04T11:47:54-02:00"))
+        self.assertEqual(1423050474, plugin.parse_timestamp("2015-02-04T11:47:54.123456Z"))
+        self.assertRaises(ValueError, plugin.parse_timestamp, "yesterday")
+
+    @patch('requests.Session.request')
+    def test_node_costs(self, mock_request):
+        nodes = json.dumps({"nodes": [
+            {"Address": "http://10.0.0.1:2375", "Metadata": {"pool": "foobar"}, "Status": "ready"},
+            {"Address": "http://10.0.0.2:2375", "Status": "waiting",
+             "Metadata": {"pool": "foobar", "LastSuccess": "2015-02-04T11:47:54-02:00"}}]})
+        mock_request.side_effect = lambda method, url, **kwargs: tsuru_response(
+            nodes if url.endswith("/node") else
+            '[{"ID": "a"}, {"ID": "b"}]' if "10.0.0.1" in url else "")
+        costs = [(plugin.node_status_cost, [1, 0]),
+                 (plugin.node_age_cost, [0, 1423057674]),
+                 (plugin.node_containers_cost, [2, 0])]
+        for cost, expected in costs:
+            self.assertEqual(expected, [cost(self.pool_handler, node)
+                                        for node in self.pool_handler.get_nodes()])
+        mock_request.assert_any_call("get", "https://cloud.tsuru.io/docker/node/10.0.0.1/containers",
+                                     headers={"authorization": "bearer abc123"})
+
+    def test_order_nodes(self):
+        fake_pool = FakeTsuruPool('foobar')
+        nodes = ['n{}'.format(i) for i in range(6)]
+        fake_pool.containers = dict((node, [{}] * count)
+                                    for node, count in zip(nodes, [5, 0, 3, 1, 4, 2]))
+        fake_pool.nodes_info = dict((node, {'Status': 'ready'}) for node in nodes)
+        fake_pool.nodes_info['n4'] = {'Status': 'waiting'}
+        costs = [plugin.node_containers_cost]
+        self.assertEqual(['n1', 'n3', 'n5', 'n2', 'n4', 'n0'],
+                         plugin.order_nodes(fake_pool, nodes, costs))
+        self.assertEqual(['n1', 'n0', 'n3', 'n4', 'n5', 'n2'],
+                         plugin.order_nodes(fake_pool, nodes, costs, 2))
+        costs = [plugin.node_status_cost, plugin.node_containers_cost]
+        self.assertEqual(['n4', 'n1', 'n0', 'n3', 'n2', 'n5'],
+                         plugin.order_nodes(fake_pool, nodes, costs, 2))
+
+    @patch("sys.stdout")
+    @patch('pool_recycle.plugin.TsuruPool')
+    def test_pool_recycle_order_by(self, tsuru_pool_mock, stdout):
+        fake_pool = FakeTsuruPool('foobar')
+        fake_pool.containers = {'127.0.0.1': [{}] * 3, '10.1.1.2': [{}]}
+        tsuru_pool_mock.return_value = fake_pool
+        plugin.pool_recycle('foobar', True, order_by=["containers"])
+        call_stdout_list = [call('Destroying node "10.10.1.1\n'),
+                            call('\n'),
+                            call('(2/3) Creating new node on pool "foobar" using "templateB" template\n'),
+                            call('Destroying node "10.1.1.2\n'),
+                            call('\n'),
+                            call('(3/3) Creating new node on pool "foobar" using "templateA" template\n'),
+                            call('Destroying node "127.0.0.1\n')]
+        stdout.write.assert_has_calls(call_stdout_list)
+
+    def test_template_scheduler(self):
+        templates = plugin.TemplateScheduler(['templateA', 'templateB', 'templateC'], min_share=0.1)
+        self.assertEqual(['templateA', 'templateB', 'templateC', 'templateA'],
+                         [templates.choose() for _ in range(4)])
+        templates = plugin.TemplateScheduler(['templateA', 'templateB'], min_share=0.1)
+        templates.record(templates.choose(), 30)
+        templates.record(templates.choose(), 90)
+        chosen = [templates.choose() for _ in range(20)]
+        self.assertGreater(chosen.count('templateA'), 2 * chosen.count('templateB'))
+        self.assertGreaterEqual(chosen.count('templateB'), 2)
+        templates.min_share = 0.45
+        self.assertEqual('templateB', templates.choose())
+        templates = plugin.TemplateScheduler(['templateA', 'templateB'])
+        templates.record(templates.choose(), 30, failed=True)
+        self.assertEqual('templateB', templates.choose())
+
+    @patch('sys.stderr')
+    @patch('time.sleep')
+    @patch('tsuruclient.nodes.Manager.create')
+    @patch('tsuruclient.events.Manager.list')
+    def test_create_new_node_switches_template(self, mock_list, mock_create, sleep, stderr):
+        mock_list.return_value = []
+        templates = plugin.TemplateScheduler(['templateA', 'templateB'])
+        mock_create.side_effect = [Exception("IaaS error"), {}]
+
+        def events(**kwargs):
+            if mock_create.call_count < 2:
+                return []
+            return [tsuru_event("1", "node.create", "10.2.3.4")]
+        mock_list.side_effect = events
+        template = templates.choose()
+        self.assertEqual('10.2.3.4', self.pool_handler.create_new_node(template, templates=templates))
+        self.assertEqual([call(**{"register": "false", "Metadata.template": "templateA"}),
+                          call(**{"register": "false", "Metadata.template": "templateB"})],
+                         mock_create.call_args_list)
+        self.assertEqual({'templateA': 1, 'templateB': 0}, templates.failures)
+        self.assertEqual({'templateA': 0, 'templateB': 1}, templates.assigned)
+
+    @patch('pool_recycle.plugin.time.time')
+    def test_run_stats_report(self, mock_time):
+        mock_time.return_value = 100
+        stats = plugin.RunStats()
+        for duration in [0.05, 0.3, 0.3, 40, 7200]:
+            stats.add("api.events.list", duration)
+        stats.count("retries.node.create", 2)
+        stats.start_node("foobar", "10.1.1.1")
+        stats.add("node.create", 30, "foobar", "10.1.1.1")
+        stats.add("node.create", 10, "foobar", "10.1.1.1")
+        stats.update_node("foobar", "10.1.1.1", new_node="10.2.2.2")
+        mock_time.return_value = 160
+        stats.finish_node("foobar", "10.1.1.1")
+        with self.assertRaises(ValueError):
+            with stats.timer("api.nodes.create"):
+                raise ValueError()
+        report = stats.report()
+        self.assertEqual(60, report["wall_time"])
+        self.assertEqual({"retries.node.create": 2, "api.nodes.create.errors": 1}, report["counters"])
+        polls = report["phases"]["api.events.list"]
+        self.assertEqual((5, 0.05, 7200, 0.3, 7200), (polls["count"], polls["min"], polls["max"],
+                                                      polls["p50"], polls["p90"]))
+        histogram = dict((bucket["le"], bucket["count"]) for bucket in polls["histogram"])
+        self.assertEqual((1, 2, 1, 1), (histogram[0.1], histogram[0.5], histogram[60], histogram["+Inf"]))
+        self.assertEqual(40, report["phases"]["node.create"]["total"])
+        self.assertEqual([{"pool": "foobar", "node": "10.1.1.1", "new_node": "10.2.2.2",
+                           "started": 100, "finished": 160,
+                           "phases": {"node.create": 40, "node.recycle": 60}}], report["nodes"])
+
+    @patch("sys.stdout")
+    @patch('pool_recycle.plugin.AsyncTsuruPool')
+    @patch('pool_recycle.plugin.TsuruPool')
+    def test_pool_recycle_report(self, tsuru_pool_mock, async_tsuru_pool_mock, stdout):
+        tmpdir = tempfile.mkdtemp()
+        self.addCleanup(shutil.rmtree, tmpdir)
+        report_path = os.path.join(tmpdir, "report.json")
+        for options in [{}, {"parallel": 2}, {"pre_provision": True}, {"async_engine": True}]:
+            fake_pool = FakeTsuruPool('foobar')
+
+            def tsuru_pool(pool, stats=None, **kwargs):
+                fake_pool.stats = stats
+                return fake_pool
+            tsuru_pool_mock.side_effect = async_tsuru_pool_mock.side_effect = tsuru_pool
+            plugin.pool_recycle('foobar', report_path=report_path, **options)
+            with open(report_path) as report_file:
+                report = json.load(report_file)
+            self.assertEqual(3, report["phases"]["node.recycle"]["count"])
+            self.assertEqual(3, report["phases"]["node.remove"]["count"])
+            self.assertItemsEqual(['1.2.3.4', '5.6.7.8', '9.10.11.12'],
+                                  [node["new_node"] for node in report["nodes"]])
+
+    @patch('pool_recycle.plugin.time.time')
+    def test_run_stats_progress(self, mock_time):
+        mock_time.return_value = 0
+        stats = plugin.RunStats()
+        stats.plan("poolA", 5)
+        stats.plan("poolB", 1)
+        self.assertEqual(({"poolA": {"planned": 5, "recycled": 0, "in_flight": 0},
+                           "poolB": {"planned": 1, "recycled": 0, "in_flight": 0}}, None), stats.progress())
+        for node in ["10.1.1.1", "10.1.1.2", "10.1.1.3"]:
+            stats.start_node("poolA", node)
+        mock_time.return_value = 100
+        stats.finish_node("poolA", "10.1.1.1")
+        stats.finish_node("poolA", "10.1.1.2")
+        pools, eta = stats.progress()
+        self.assertEqual({"planned": 5, "recycled": 2, "in_flight": 1}, pools["poolA"])
+        # 2 nodes recycled at once, 100 seconds each, 4 nodes left
+        self.assertAlmostEqual(200, eta)
+
+    def test_metrics_exporter(self):
+        tmpdir = tempfile.mkdtemp()
+        self.addCleanup(shutil.rmtree, tmpdir)
+        stats = plugin.RunStats()
+        stats.plan("foobar", 3)
+        stats.start_node("foobar", "10.1.1.1")
+        stats.add("api.nodes.create", 0.3)
+        stats.count("api.nodes.create.errors")
+        stats.count("retries.node.create", 2)
+        textfile = os.path.join(tmpdir, "pool_recycle.prom")
+        exporter = plugin.MetricsExporter(stats, port=0, textfile=textfile).start()
+        try:
+            self.assertEqual("127.0.0.1", exporter.server.server_address[0])
+            connection = httplib.HTTPConnection("127.0.0.1", exporter.server.server_address[1])
+            connection.request("GET", "/metrics")
+            response = connection.getresponse()
+            self.assertEqual(200, response.status)
+            metrics = response.read()
+        finally:
+            exporter.stop()
+        with open(textfile) as metrics_file:
+            self.assertEqual(metrics, metrics_file.read())
+        for line in ['pool_recycle_nodes_planned{pool="foobar"} 3',
+                     'pool_recycle_nodes_remaining{pool="foobar"} 3',
+                     'pool_recycle_nodes_in_flight{pool="foobar"} 1',
+                     'pool_recycle_eta_seconds NaN',
+                     'pool_recycle_phase_duration_seconds_bucket{phase="api.nodes.create",le="0.25"} 0',
+                     'pool_recycle_phase_duration_seconds_bucket{phase="api.nodes.create",le="0.5"} 1',
+                     'pool_recycle_phase_duration_seconds_bucket{phase="api.nodes.create",le="+Inf"} 1',
+                     'pool_recycle_phase_duration_seconds_count{phase="api.nodes.create"} 1',
+                     'pool_recycle_errors_total{phase="api.nodes.create"} 1',
+                     'pool_recycle_retries_total{kind="node.create"} 2']:
+            self.assertIn(line, metrics.split("\n"))
+
+    def test_benchmark_against_fake_tsuru(self):
+        for async_engine in [False, True]:
+            result = run_benchmark(nodes=4, parallel=2, async_engine=async_engine, create_duration=0.05,
+                                   delete_duration=0.05, create_failure_rate=0.3, ready_delay=0.05,
+                                   poll_interval=0.01, max_poll_interval=0.05, retry_interval=0, max_drains=1,
+                                   seed=1)
+            self.assertIsNone(result["error"])
+            self.assertEqual(4, len(result["recycled"]))
+            self.assertEqual(4, result["api_calls"]["nodes.remove"])
+            # events are matched by id in the shared listing, never looked up one by one
+            self.assertNotIn("events.get", result["api_calls"])
+            self.assertGreater(result["api_calls"]["nodes.create"], 4)
+            self.assertEqual(4, result["report"]["phases"]["node.recycle"]["count"])
+            self.assertEqual(4, result["report"]["phases"]["wait.node.ready"]["count"])
+            self.assertEqual(1, result["max_running_removals"])
+            self.assertLess(result["idle_time"], result["wall_time"])
+            # streamed node creations open their own connection, everything else is pooled
+            self.assertLessEqual(result["connections"], 10 + result["api_calls"]["nodes.create"])
+            self.assertLess(result["connections"], sum(result["api_calls"].values()))
+        self.assertEqual("https://cloud.tsuru.io/", os.environ["TSURU_TARGET"])
+
+    @patch('tsuruclient.users.Manager.info')
+    def test_tsuru_session(self, users_mock):
+        users_mock.return_value = {"Email": "myuser"}
+        session = plugin.TsuruSession(max_connections=2)
+        adapter = session.session.get_adapter("https://cloud.tsuru.io")
+        self.assertEqual(2, adapter.poolmanager.connection_pool_kw["maxsize"])
+        pool_handler = plugin.TsuruPool("foobar", session=session)
+        self.assertIs(session, pool_handler.session)
+        response = Mock(headers={"content-type": "application/json"})
+        response.json.return_value = {"nodes": []}
+        with patch.object(session.session, "request", return_value=response) as session_request, \
+                patch("requests.request") as plain_request:
+            self.assertEqual({"nodes": []}, pool_handler.client.nodes.list())
+            session_request.assert_called_once_with("get", "https://cloud.tsuru.io/1.2/node",
+                                                    headers={"authorization": "bearer abc123"})
+            pool_handler.client.nodes.request("post", "/1.2/node", stream=True)
+            self.assertEqual(1, session_request.call_count)
+            self.assertEqual(1, plain_request.call_count)
+
+    def test_tsuru_session_releases_failed_streamed_responses(self):
+        fake = FakeTsuru(pools={"foobar": 2}).start()
+        self.addCleanup(fake.stop)
+        fake.fail("nodes.list", 3)
+        with patch.dict(os.environ, {"TSURU_TARGET": fake.target}):
+            session = plugin.TsuruSession(max_connections=2)
+            self.addCleanup(session.session.close)
+            pool_handler = plugin.TsuruPool("foobar", session=session)
+            result = []
+
+            def list_nodes():
+                # more failed listings than pooled connections
+                for _ in range(3):
+                    self.assertRaises(Exception, pool_handler.get_nodes)
+                result.append(pool_handler.get_nodes())
+
+            thread = threading.Thread(target=list_nodes)
+            thread.daemon = True
+            thread.start()
+            thread.join(5)
+        self.assertEqual([[node["Address"] for node in fake.nodes]], result)
+
+    def test_select_pools(self):
+        pools = ['infra', 'poolB', 'poolA', 'dev-pool', 'poolC']
+        self.assertEqual(['poolA', 'poolB', 'poolC'], plugin.select_pools(pools, ['pool*']))
+        self.assertEqual(['dev-pool', 'infra'], plugin.select_pools(pools, ['infra'], regex='^dev-'))
+        self.assertEqual(['poolA', 'poolB'], plugin.select_pools(pools, regex='pool[AB]'))
+        self.assertEqual([], plugin.select_pools(pools, ['nothing']))
+
+    def test_simulate_recycle(self):
+        nodes = ['n{}'.format(n) for n in range(10)]
+        results = [plugin.simulate_recycle('foobar', nodes, ['templateA', 'templateB'], 300, 120, **settings)
+                   for settings in [{}, {"parallel": 2, "create_ahead": 2},
+                                    {"parallel": 2, "pre_provision": True}]]
+        self.assertEqual([(4200, 1, 10), (1620, 4, 10), (900, 10, 10)],
+                         [(result["wall_time"], result["peak_extra_nodes"], result["min_capacity"])
+                          for result in results])
+        self.assertEqual(["0s", "5m00s", "1h10m05s"], [plugin.format_duration(seconds)
+                                                       for seconds in [0, 300, 4205]])
+
+    @patch('sys.stdout')
+    @patch('pool_recycle.plugin.TsuruPool')
+    def test_pools_simulate(self, tsuru_pool_mock, stdout):
+        fakes = {None: FakeTsuruPool(None), 'foobar': FakeTsuruPool('foobar')}
+        tsuru_pool_mock.side_effect = lambda pool=None, **kwargs: fakes[pool]
+        directory = tempfile.mkdtemp()
+        self.addCleanup(shutil.rmtree, directory)
+        history = os.path.join(directory, "report.json")
+        with open(history, "w") as report_file:
+            json.dump({"phases": {"node.create": {"count": 2, "mean": 600},
+                                  "node.remove": {"count": 0, "mean": 0}}}, report_file)
+        plugin.pools_simulate(['foo*'], parallel=[1, 3], create_ahead=[0], history_path=history)
+        output = "".join(args[0] for args, _ in stdout.write.call_args_list).splitlines()
+        self.assertEqual('Simulated recycle of 3 node(s) from pool "foobar", creating nodes in 10m00s '
+                         'and removing them in 5m00s:', output[0])
+        self.assertEqual([["1", "0", "no", "45m00s", "1", "3", "(100%)"],
+                          ["3", "0", "no", "15m00s", "3", "3", "(100%)"],
+                          ["1", "0", "yes", "25m00s", "3", "3", "(100%)"],
+                          ["3", "0", "yes", "15m00s", "3", "3", "(100%)"]],
+                         [line.split() for line in output[2:6]])
+        self.assertEqual(0, len(fakes['foobar'].used_templates))
+
+    @patch('sys.stderr')
+    @patch('sys.stdout')
+    @patch('pool_recycle.plugin.pools_simulate')
+    @patch('pool_recycle.plugin.pool_recycle')
+    def test_pool_recycle_parser_plan(self, pool_recycle, pools_simulate, stdout, stderr):
+        plugin.pool_recycle_parser(["-p", "foobar", "--plan", "--plan-parallel", "1,4",
+                                    "--create-duration", "90"])
+        pools_simulate.assert_called_once_with(["foobar"], regex=None, parallel=[1, 4],
+                                               create_ahead=[0, 1, 2], create_duration=90,
+                                               delete_duration=None, history_path=None)
+        self.assertEqual(0, pool_recycle.call_count)
+        self.assertRaises(SystemExit, plugin.pool_recycle_parser, ["-p", "foobar", "--plan",
+                                                                   "--plan-parallel", "many"])
+
+    @patch('sys.stderr')
+    @patch('sys.stdout')
+    @patch('pool_recycle.plugin.pools_daemon')
+    @patch('pool_recycle.plugin.pools_recycle')
+    def test_pool_recycle_parser_daemon(self, pools_recycle, pools_daemon, stdout, stderr):
+        plugin.pool_recycle_parser(["-p", "prod-*", "--daemon", "--max-age", "48", "--rate", "2",
+                                    "--parallel", "2"])
+        pools_daemon.assert_called_once_with(["prod-*"], regex=None, max_age=48 * 3600, rate=2,
+                                             parallel=2, scan_interval=60, max_retry=10,
+                                             retry_interval=60, wait_timeout=None, metrics_port=None,
+                                             metrics_textfile=None, max_connections=10,
+                                             rate_limits=None, breaker_threshold=0.5,
+                                             retry_budgets=None, max_drains=None,
+                                             max_moving_containers=None)
+        self.assertEqual(0, pools_recycle.call_count)
+        self.assertRaises(SystemExit, plugin.pool_recycle_parser, ["-p", "prod-*", "--daemon", "-d"])
+        self.assertRaises(SystemExit, plugin.pool_recycle_parser,
+                          ["-p", "prod-*", "--daemon", "--rate", "0"])
+
+    def test_node_ages_pages_back_to_max_age(self):
+        def created(address, hours):
+            event = tsuru_event(address, "node.create", address)
+            event["StartTime"] = plugin.time.strftime(
+                "%Y-%m-%dT%H:%M:%SZ", plugin.time.gmtime(plugin.time.time() - hours * 3600))
+            return event
+
+        pages = [[created("10.0.0.1", 1), created("10.0.0.2", 2)],
+                 [created("10.0.0.3", 3), created("10.0.0.4", 5)], []]
+        client = Mock()
+        client.events.list.side_effect = lambda **params: pages[params.get("skip", 0) // 2]
+        ages = plugin.NodeAges(client, limit=2)
+        # every node is among the latest events, so no page back is needed
+        ages.refresh(["10.0.0.1", "10.0.0.2"], max_age=4 * 3600)
+        self.assertEqual([call(kindname="node.create", limit=2)], client.events.list.call_args_list)
+        # a missing node is not known to be older than the events listed
+        self.assertFalse(ages.older_than(4 * 3600))
+        client.events.list.reset_mock()
+        ages.refresh(["10.0.0.9"], max_age=4 * 3600)
+        self.assertEqual([call(kindname="node.create", limit=2),
+                          call(kindname="node.create", limit=2, skip=2)],
+                         client.events.list.call_args_list)
+        self.assertTrue(ages.older_than(4 * 3600))
+        self.assertIsNone(ages.age("10.0.0.9"))
+        self.assertTrue(4 * 3600 < ages.age("10.0.0.4") < 6 * 3600)
+        # without events that old, the listing goes back as far as tsuru keeps them
+        client.events.list.reset_mock()
+        ages.refresh(["10.0.0.9"], max_age=10 * 3600)
+        self.assertEqual(3, client.events.list.call_count)
+        self.assertTrue(ages.complete)
+        self.assertTrue(ages.older_than(10 * 3600))
+
+    @patch('sys.stderr')
+    @patch('sys.stdout')
+    def test_recycle_daemon(self, stdout, stderr):
+        fake = FakeTsuru(pools={"poolA": 2, "poolB": 1, "other": 1}, create_duration=0.02,
+                         delete_duration=0.02).start()
+        self.addCleanup(fake.stop)
+        old_nodes = dict((node["Address"], node["Metadata"]["pool"]) for node in fake.nodes)
+        with patch.dict(os.environ, {"TSURU_TARGET": fake.target, "TSURU_TOKEN": "daemon"}):
+            polling_policy = PollingPolicy(initial_interval=0.01, max_interval=0.05, kind_max_intervals={})
+            cluster = plugin.TsuruPool(polling_policy=polling_policy)
+            pool_options = {"polling_policy": polling_policy, "inventory": cluster.inventory,
+                            "stats": cluster.stats, "session": cluster.session}
+            daemon = plugin.RecycleDaemon(cluster, ["pool*"], max_age=3600, rate=36000, parallel=2,
+                                          retry_interval=0, pool_options=pool_options)
+            # nodes created before the events tsuru still has are of unknown age, and due
+            self.assertEqual(sorted((pool, address) for address, pool in old_nodes.items()
+                                    if pool != "other"), sorted(daemon.due_nodes()))
+            self.assertTrue(all(daemon.ages.age(address) is None for address in old_nodes))
+            daemon.run(max_recycles=3)
+        pools = dict((node["Address"], node["Metadata"]["pool"]) for node in fake.nodes)
+        self.assertEqual(["other"], [pool for address, pool in pools.items() if address in old_nodes])
+        self.assertEqual(["poolA", "poolA", "poolB"],
+                         sorted(pool for address, pool in pools.items() if address not in old_nodes))
+        self.assertTrue(all(daemon.ages.age(address) < 3600 for address in pools
+                            if address not in old_nodes))
+        self.assertEqual([], daemon.due_nodes())
+        # the user is looked up once for the whole run
+        self.assertEqual(1, self.users_mock.call_count)
+        self.assertEqual({}, fake.healings)
+
+    def _multi_pool_fakes(self):
+        fakes = {None: FakeTsuruPool(None)}
+        in_flight = [0]
+        max_in_flight = [0]
+        lock = threading.Lock()
+        for pool in ['poolA', 'poolB', 'poolC']:
+            fake_pool = FakeTsuruPool(pool)
+            fake_pool.nodes_on_pool = ['{}-{}'.format(pool, n) for n in range(3)]
+            fake_pool.new_nodes = ['{}-new-{}'.format(pool, n) for n in range(3)]
+
+            def create(template, create_new_node=fake_pool.create_new_node, **kwargs):
+                with lock:
+                    in_flight[0] += 1
+                    max_in_flight[0] = max(max_in_flight[0], in_flight[0])
+                return create_new_node(template, **kwargs)
+
+            def remove(node, remove_node=fake_pool.remove_node, **kwargs):
+                result = remove_node(node, **kwargs)
+                with lock:
+                    in_flight[0] -= 1
+                return result
+
+            fake_pool.create_new_node = create
+            fake_pool.remove_node = remove
+            fakes[pool] = fake_pool
+        return fakes, max_in_flight
+
+    @patch('sys.stderr')
+    @patch("sys.stdout")
+    def test_pools_recycle(self, stdout, stderr):
+        for async_engine in [False, True]:
+            fakes, max_in_flight = self._multi_pool_fakes()
+            fakes[None].event_tracker = Mock()
+            trackers = []
+
+            def factory(pool=None, **kwargs):
+                trackers.append(kwargs.get("event_tracker"))
+                return fakes[pool]
+
+            with patch('pool_recycle.plugin.TsuruPool', side_effect=factory), \
+                    patch('pool_recycle.plugin.AsyncTsuruPool', side_effect=factory):
+                plugin.pools_recycle(['pool*'], parallel=2, max_in_flight=2,
+                                     async_engine=async_engine)
+            for pool in ['poolA', 'poolB', 'poolC']:
+                self.assertEqual(['{}-new-{}'.format(pool, n) for n in range(3)],
+                                 sorted(fakes[pool].get_nodes()))
+                self.assertEqual(3, fakes[pool].min_nodes)
+            self.assertLessEqual(max_in_flight[0], 2)
+            # every pool waits on the events of the run's single tracker
+            self.assertEqual([fakes[None].event_tracker] * 3, trackers[1:])
+            stdout.write.assert_any_call('Going to recycle 3 pool(s): poolA, poolB, poolC.\n')
+            stdout.write.assert_called_with('All pools done.\n')
+
+    @patch('sys.stderr')
+    @patch("sys.stdout")
+    @patch('pool_recycle.plugin.TsuruPool')
+    def test_pools_recycle_failure(self, tsuru_pool_mock, stdout, stderr):
+        fakes, _ = self._multi_pool_fakes()
+        fakes['poolB'].remove_node_from_pool_error = True
+        fakes['poolB'].disable_healing = Mock()
+        tsuru_pool_mock.side_effect = lambda pool=None, **kwargs: fakes[pool]
+        self.assertRaises(SystemExit, plugin.pools_recycle, ['poolA', 'poolB'], parallel=3)
+        self.assertEqual(1, fakes['poolB'].disable_healing.return_value.call_count)
+        self.assertEqual(['poolA-new-0', 'poolA-new-1', 'poolA-new-2'], sorted(fakes['poolA'].get_nodes()))
+        stderr.write.assert_called_with('Failed to recycle pool(s): poolB\n')
+
+    @patch('sys.stderr')
+    @patch('sys.stdout')
+    @patch('pool_recycle.plugin.pools_recycle')
+    @patch('pool_recycle.plugin.pool_recycle')
+    def test_pool_recycle_parser_multiple_pools(self, pool_recycle, pools_recycle, stdout, stderr):
+        plugin.pool_recycle_parser(["-p", "poolA", "-p", "pool[BC]", "--max-in-flight", "10"])
+        pools_recycle.assert_called_once_with(['poolA', 'pool[BC]'], regex=None, dry_mode=False,
+                                              max_retry=10, retry_interval=60, max_in_flight=10,
+                                              parallel=1, create_ahead=0, pre_provision=False,
+                                              wait_timeout=None, async_engine=False,
+                                              journal_path=None, resume=False, order_by=None,
+                                              template_min_share=None, report_path=None,
+                                              metrics_port=None, metrics_textfile=None,
+                                              max_connections=10, rate_limits=None,
+                                              breaker_threshold=0.5, retry_budgets=None,
+                                              max_drains=None, max_moving_containers=None)
+        pools_recycle.reset_mock()
+        plugin.pool_recycle_parser(["--pool-regex", "^pool"])
+        self.assertEqual((None,), pools_recycle.call_args[0])
+        self.assertEqual("^pool", pools_recycle.call_args[1]["regex"])
+        self.assertRaises(SystemExit, plugin.pool_recycle_parser, ["-d"])
+        self.assertEqual(0, pool_recycle.call_count)
+
     @patch('sys.stderr')
     @patch('sys.stdout')
     @patch('pool_recycle.plugin.pool_recycle')
     def test_pool_recycle_parser_with_all_options_set(self, pool_recycle, stdout, stderr):
-        args = ["-p", "foobar", "-d", "-m", "100", "-i", "30"]
+        args = ["-p", "foobar", "-d", "-m", "100", "-i", "30", "--parallel", "4",
+                "--create-ahead", "2", "--pre_provision", "--wait-timeout", "3600",
+                "--async", "--journal", "recycle.journal", "--resume",
+                "--order-by", "status,containers", "--template-min-share", "0.3",
+                "--report", "report.json", "--metrics-port", "9090",
+                "--metrics-textfile", "pool_recycle.prom", "--max-connections", "4",
+                "--rate-limit", "create=0.5,events=5", "--breaker-threshold", "0.8",
+                "--retry-budget", "create=1800", "--max-drains", "3",
+                "--max-moving-containers", "200", "--max-in-flight", "3"]
         plugin.pool_recycle_parser(args)
-        pool_recycle.assert_called_once_with('foobar', True, 100, 30)
+        pool_recycle.assert_called_once_with('foobar', True, 100, 30, parallel=4,
+                                             create_ahead=2, pre_provision=True,
+                                             wait_timeout=3600, async_engine=True,
+                                             journal_path="recycle.journal", resume=True,
+                                             order_by=["status", "containers"],
+                                             template_min_share=0.3, report_path="report.json",
+                                             metrics_port=9090, metrics_textfile="pool_recycle.prom",
+                                             max_connections=4,
+                                             rate_limits={"create": 0.5, "events": 5},
+                                             breaker_threshold=0.8, retry_budgets={"create": 1800},
+                                             max_drains=3, max_moving_containers=200,
+                                             max_in_flight=3)
+        self.assertRaises(SystemExit, plugin.pool_recycle_parser, ["-p", "foobar", "--resume"])
+        self.assertRaises(SystemExit, plugin.pool_recycle_parser, ["-p", "foobar", "--order-by", "size"])
+        self.assertRaises(SystemExit, plugin.pool_recycle_parser, ["-p", "foobar", "--rate-limit", "list=1"])
+        self.assertRaises(SystemExit, plugin.pool_recycle_parser,
+                          ["-p", "foobar", "--retry-budget", "move=1"])
+        self.assertRaises(SystemExit, plugin.pool_recycle_parser, ["-p", "foobar", "--rate-limit", "create"])
 
     def tearDown(self):
         self.patcher.stop()